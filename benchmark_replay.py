@@ -0,0 +1,442 @@
+# ========================================
+# generate_reply 離線回放基準測試
+# ========================================
+# 功能：
+# - 回放錄低嘅粵語對話（benchmark_corpus.jsonl）
+# - 用本地假後端代替 Gemini（可設定延遲分佈同失敗率），完全唔使網絡
+# - 報告快速路由命中率、各階段延遲百分位（經 core_logic 追蹤 sink）、
+#   N 個並發對話嘅吞吐量、每輪記憶體分配、時間解析每句耗時
+# - 用標註好嘅問題對（semantic_cache_pairs.jsonl）校準相似度快取門檻
+# - 可以設定門檻，唔達標就 exit 1（用嚟把關發佈）
+#
+# 用法：
+#   python benchmark_replay.py --concurrency 1 8 32 --llm-median-ms 800 --fail-rate 0.02
+#   python benchmark_replay.py --gate-quick-rate 0.5 --gate-p99-ms 2000
+
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+import sys
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import core_logic
+from cantonese_text import normalize_utterance
+from cantonese_time import parse_booking_time
+
+DEFAULT_CORPUS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark_corpus.jsonl")
+DEFAULT_SEMANTIC_PAIRS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "semantic_cache_pairs.jsonl")
+
+# 建議門檻 = 最似嘅「唔應該命中」問題對 + 呢個餘量（寧願問多次 LLM，都唔好答錯）
+SEMANTIC_THRESHOLD_MARGIN = 0.02
+
+# 假後端回覆（故意包含會被硬規則刪走嘅重複提問）
+FAKE_REPLIES = (
+    "有呀，我哋樓下有停車場，泊車可以有優惠。你想幾時嚟呢？",
+    "做完之後記得做好保濕同防曬。三日內唔好焗桑拿。",
+    "明白你嘅擔心，我哋會先幫你做皮膚測試。你想做邊款療程？",
+    "我哋有新客優惠，第一次嚟可以有折。詳情到時同你講。",
+    "可以嘅，我哋收信用卡同八達通。",
+)
+
+
+# ==================== 假後端 ====================
+
+class FakeModelError(RuntimeError):
+    """假後端模擬嘅上游錯誤"""
+
+
+class FakeLLMBackend:
+    """
+    本地假 LLM 後端（符合 llm_backends.LLMBackend 介面，同步 / 非同步 / 串流都有），
+    延遲用 log-normal 分佈（中位數 + sigma），按 fail_rate 隨機拋錯。
+    """
+
+    name = "fake"
+
+    def __init__(self, median_ms: float, sigma: float, fail_rate: float, seed: int = 0, timeout_s: float = 5.0):
+        self.median_s = median_ms / 1000.0
+        self.sigma = sigma
+        self.fail_rate = fail_rate
+        self.timeout_s = timeout_s
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.failures = 0
+        self.latencies = []
+
+    def _plan(self, prompt: str):
+        with self._lock:
+            self.calls += 1
+            delay = self._rng.lognormvariate(math.log(self.median_s), self.sigma) if self.median_s > 0 else 0.0
+            fail = self._rng.random() < self.fail_rate
+            if fail:
+                self.failures += 1
+            self.latencies.append(delay)
+        reply = FAKE_REPLIES[sum(map(ord, prompt)) % len(FAKE_REPLIES)]
+        return delay, fail, reply
+
+    @staticmethod
+    def _pieces(reply: str) -> list:
+        step = max(1, len(reply) // 6)
+        return [reply[i:i + step] for i in range(0, len(reply), step)]
+
+    def generate(self, prompt: str) -> str:
+        delay, fail, reply = self._plan(prompt)
+        time.sleep(delay)
+        if fail:
+            raise FakeModelError("fake upstream error")
+        return reply
+
+    def stream(self, prompt: str):
+        # 第一段用大部分延遲，之後逐段吐字
+        delay, fail, reply = self._plan(prompt)
+        time.sleep(delay * 0.7)
+        if fail:
+            raise FakeModelError("fake upstream error")
+        for piece in self._pieces(reply):
+            time.sleep(delay * 0.05)
+            yield piece
+
+    async def agenerate(self, prompt: str) -> str:
+        delay, fail, reply = self._plan(prompt)
+        await asyncio.sleep(delay)
+        if fail:
+            raise FakeModelError("fake upstream error")
+        return reply
+
+    async def astream(self, prompt: str):
+        delay, fail, reply = self._plan(prompt)
+        await asyncio.sleep(delay * 0.7)
+        if fail:
+            raise FakeModelError("fake upstream error")
+        for piece in self._pieces(reply):
+            await asyncio.sleep(delay * 0.05)
+            yield piece
+
+    def count_tokens(self, text: str) -> int:
+        return len(text)
+
+
+# ==================== 量度 ====================
+
+class TraceCollector:
+    """追蹤 sink：收集每輪嘅出口路線、各階段耗時同總耗時。"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.records = []
+
+    def record(self, trace, total: float) -> None:
+        with self._lock:
+            self.records.append((trace.outcome, dict(trace.stages), total))
+
+
+# 出口路線 → 報告分類
+ROUTE_OF_OUTCOME = {
+    "empty_input": "empty",
+    "quick_rule": "quick",
+    "cache_hit": "cache",
+    "semantic_cache_hit": "cache",
+}
+
+
+def _disable_caches() -> None:
+    core_logic.response_cache.max_size = 0
+    core_logic.semantic_cache.capacity = 0
+
+
+def percentile(values: list, p: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    k = (len(ordered) - 1) * p / 100.0
+    lo, hi = math.floor(k), math.ceil(k)
+    return ordered[lo] + (ordered[hi] - ordered[lo]) * (k - lo)
+
+
+def _summary_ms(values: list) -> dict:
+    return {
+        "n": len(values),
+        "p50_ms": round(percentile(values, 50) * 1000, 3),
+        "p95_ms": round(percentile(values, 95) * 1000, 3),
+        "p99_ms": round(percentile(values, 99) * 1000, 3),
+        "max_ms": round(max(values) * 1000, 3) if values else 0.0,
+    }
+
+
+def load_corpus(path: str) -> list:
+    conversations = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                conversations.append(json.loads(line)["turns"])
+    return conversations
+
+
+def load_semantic_pairs(path: str) -> list:
+    """每行 {"a": 已審核問題, "b": 客人講法, "match": 應唔應該用返 a 嘅回覆}。"""
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def calibrate_semantic_threshold(pairs: list, threshold: float = None) -> dict:
+    """
+    將所有 a 當已審核問題放入一個新嘅相似度快取，再逐個 b 查詢：
+    報告答錯（唔應該用 a 嘅回覆但用咗）同應該命中嘅命中數（其他 a 本身就係 b 嘅講法唔計），
+    仲有建議門檻（最似嘅、過到否定詞 / 內容類別檢查嘅「唔應該命中」對 + 餘量）。
+    """
+    if threshold is None:
+        threshold = core_logic.SEMANTIC_CACHE_THRESHOLD
+    cache = core_logic.SemanticCache(
+        len(pairs), core_logic.SEMANTIC_CACHE_DIM, threshold, core_logic.SEMANTIC_CACHE_TOP_K
+    )
+    for pair in pairs:
+        cache.add(normalize_utterance(pair["a"]), None, pair["a"])
+
+    hits = wrong = closest_negative = 0
+    for pair in pairs:
+        a, b = normalize_utterance(pair["a"]), normalize_utterance(pair["b"])
+        served = cache.lookup(b, ()) == pair["a"]
+        if pair["match"]:
+            hits += served
+        else:
+            wrong += served
+            if cache.matches(a, b):
+                closest_negative = max(closest_negative, cache.similarity(a, b))
+    matches = sum(pair["match"] for pair in pairs)
+    return {
+        "pairs": len(pairs),
+        "threshold": threshold,
+        "wrong": wrong,
+        "hits": hits,
+        "matches": matches,
+        "suggested_threshold": math.ceil((closest_negative + SEMANTIC_THRESHOLD_MARGIN) * 100) / 100,
+    }
+
+
+# ==================== 回放 ====================
+
+def _replay_conversation(turns: list) -> None:
+    state = core_logic.reset_memory()
+    for user_text in turns:
+        _, state = core_logic.generate_reply(user_text, state)
+
+
+async def _areplay_conversation(turns: list) -> None:
+    state = core_logic.reset_memory()
+    for user_text in turns:
+        _, state = await core_logic.agenerate_reply(user_text, state)
+
+
+def run_load(conversations: list, concurrency: int, rounds: int, mode: str) -> dict:
+    """N 個並發對話，每個對話流程回放 rounds 次，返回吞吐量同每輪追蹤記錄。"""
+    jobs = [conv for _ in range(rounds) for conv in conversations]
+    collector = TraceCollector()
+    core_logic.set_trace_sink(collector)
+
+    t0 = time.perf_counter()
+    if mode == "async":
+        async def _main():
+            sem = asyncio.Semaphore(concurrency)
+
+            async def _one(conv):
+                async with sem:
+                    await _areplay_conversation(conv)
+
+            await asyncio.gather(*(_one(conv) for conv in jobs))
+
+        asyncio.run(_main())
+    else:
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            list(pool.map(_replay_conversation, jobs))
+    wall = time.perf_counter() - t0
+    core_logic.set_trace_sink(None)
+    records = collector.records
+
+    return {
+        "concurrency": concurrency,
+        "turns": len(records),
+        "wall_s": round(wall, 3),
+        "turns_per_s": round(len(records) / wall, 1) if wall else 0.0,
+        "records": records,
+    }
+
+
+def measure_allocations(conversations: list) -> dict:
+    """單線程、零延遲回放一次，用 tracemalloc 量每輪峰值記憶體同淨分配 block 數。"""
+    peaks = []
+    blocks = []
+    tracemalloc.start()
+    try:
+        for turns in conversations:
+            state = core_logic.reset_memory()
+            for user_text in turns:
+                tracemalloc.reset_peak()
+                base = tracemalloc.get_traced_memory()[0]
+                before_blocks = sys.getallocatedblocks()
+                _, state = core_logic.generate_reply(user_text, state)
+                peaks.append(tracemalloc.get_traced_memory()[1] - base)
+                blocks.append(sys.getallocatedblocks() - before_blocks)
+    finally:
+        tracemalloc.stop()
+    return {
+        "turns": len(peaks),
+        "peak_bytes_mean": round(sum(peaks) / len(peaks)) if peaks else 0,
+        "peak_bytes_p95": round(percentile(peaks, 95)) if peaks else 0,
+        "net_blocks_mean": round(sum(blocks) / len(blocks), 1) if blocks else 0.0,
+    }
+
+
+def _per_call_us(fn, inputs: list, repeat: int) -> list:
+    per_call = []
+    for x in inputs:
+        t0 = time.perf_counter()
+        for _ in range(repeat):
+            fn(x)
+        per_call.append((time.perf_counter() - t0) / repeat * 1e6)
+    return per_call
+
+
+def measure_time_parser(conversations: list, repeat: int = 200) -> dict:
+    """語料每句重複標準化 / 解析 repeat 次，返回每句耗時（微秒）。"""
+    utterances = [u for turns in conversations for u in turns]
+    canonical = [normalize_utterance(u) for u in utterances]
+    now = datetime(2026, 1, 5, 12, 0)
+    normalize_us = _per_call_us(normalize_utterance, utterances, repeat)
+    parse_us = _per_call_us(lambda text: parse_booking_time(text, now), canonical, repeat)
+    return {
+        "utterances": len(utterances),
+        "parsed": sum(parse_booking_time(u, now) is not None for u in canonical),
+        "normalize_mean_us": round(sum(normalize_us) / len(normalize_us), 2) if utterances else 0.0,
+        "mean_us": round(sum(parse_us) / len(parse_us), 2) if utterances else 0.0,
+        "p99_us": round(percentile(parse_us, 99), 2) if utterances else 0.0,
+    }
+
+
+def build_report(
+    runs: list, model: FakeLLMBackend, allocations: dict, time_parser: dict, semantic_cache: dict
+) -> dict:
+    records = [r for run in runs for r in run["records"]]
+    routes = {}
+    outcomes = {}
+    stages = {}
+    totals = {}
+    for outcome, turn_stages, total in records:
+        route = ROUTE_OF_OUTCOME.get(outcome, "llm")
+        routes[route] = routes.get(route, 0) + 1
+        outcomes[outcome] = outcomes.get(outcome, 0) + 1
+        for stage, seconds in turn_stages.items():
+            stages.setdefault(stage, []).append(seconds)
+        totals.setdefault(route, []).append(total)
+    answered = sum(n for route, n in routes.items() if route != "empty")
+
+    latency = {stage: _summary_ms(values) for stage, values in stages.items()}
+    latency["model"] = _summary_ms(model.latencies)
+    latency["total"] = _summary_ms([t for _, _, t in records])
+    for route, values in totals.items():
+        latency[f"total_{route}"] = _summary_ms(values)
+
+    return {
+        "turns": len(records),
+        "routes": routes,
+        "outcomes": outcomes,
+        "quick_path_rate": round(routes.get("quick", 0) / answered, 4) if answered else 0.0,
+        "llm_rate": round(routes.get("llm", 0) / answered, 4) if answered else 0.0,
+        "latency": latency,
+        "throughput": [
+            {k: v for k, v in run.items() if k != "records"} for run in runs
+        ],
+        "model": {"calls": model.calls, "failures": model.failures},
+        "allocations": allocations,
+        "time_parser": time_parser,
+        "semantic_cache": semantic_cache,
+    }
+
+
+def _print_report(report: dict) -> None:
+    print(f"回放輪數：{report['turns']}  路由：{report['routes']}")
+    print(f"出口路線：{report['outcomes']}")
+    print(f"快速路由命中率：{report['quick_path_rate']:.1%}  LLM 比例：{report['llm_rate']:.1%}")
+    for stage, s in report["latency"].items():
+        print(f"  {stage:<12} n={s['n']:<6} p50={s['p50_ms']:>9.3f}ms  p95={s['p95_ms']:>9.3f}ms  p99={s['p99_ms']:>9.3f}ms")
+    for t in report["throughput"]:
+        print(f"  並發 {t['concurrency']:>4}：{t['turns_per_s']:>8.1f} 輪/秒（{t['turns']} 輪，{t['wall_s']}s）")
+    a = report["allocations"]
+    print(f"每輪記憶體：峰值平均 {a['peak_bytes_mean']} bytes，p95 {a['peak_bytes_p95']} bytes，淨 block {a['net_blocks_mean']}")
+    p = report["time_parser"]
+    print(
+        f"時間解析：{p['parsed']}/{p['utterances']} 句有時間，平均 {p['mean_us']}µs/句，p99 {p['p99_us']}µs"
+        f"（標準化平均 {p['normalize_mean_us']}µs/句）"
+    )
+    s = report["semantic_cache"]
+    print(
+        f"相似度快取：門檻 {s['threshold']}，{s['pairs']} 對標註，答錯 {s['wrong']}，"
+        f"應該命中 {s['hits']}/{s['matches']}（建議門檻 {s['suggested_threshold']}）"
+    )
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="generate_reply 離線回放基準測試")
+    parser.add_argument("--corpus", default=DEFAULT_CORPUS)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 32])
+    parser.add_argument("--rounds", type=int, default=3, help="每個並發設定回放成個語料幾多次")
+    parser.add_argument("--mode", choices=["sync", "async"], default="sync")
+    parser.add_argument("--llm-median-ms", type=float, default=600.0)
+    parser.add_argument("--llm-sigma", type=float, default=0.5, help="log-normal 延遲嘅 sigma（越大長尾越長）")
+    parser.add_argument("--fail-rate", type=float, default=0.01)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--with-cache", action="store_true", help="保留 LLM 回覆快取（預設關閉，避免重複回放全部命中）")
+    parser.add_argument("--json", dest="json_path", help="將報告寫入 JSON 檔")
+    parser.add_argument("--gate-quick-rate", type=float, help="快速路由命中率低過呢個值就失敗")
+    parser.add_argument("--gate-p99-ms", type=float, help="整體 p99 延遲高過呢個值就失敗")
+    parser.add_argument("--gate-parse-us", type=float, help="時間解析 p99 高過呢個值（微秒）就失敗")
+    parser.add_argument("--semantic-pairs", default=DEFAULT_SEMANTIC_PAIRS, help="相似度快取門檻校準用嘅標註問題對")
+    args = parser.parse_args(argv)
+
+    conversations = load_corpus(args.corpus)
+    if not args.with_cache:
+        _disable_caches()
+
+    model = FakeLLMBackend(args.llm_median_ms, args.llm_sigma, args.fail_rate, args.seed)
+    core_logic.set_llm_backend(model)
+
+    runs = [run_load(conversations, n, args.rounds, args.mode) for n in args.concurrency]
+    load_latencies = list(model.latencies)
+
+    # 記憶體量度用零延遲後端，唔計入延遲統計
+    core_logic.set_llm_backend(FakeLLMBackend(0.0, 0.0, 0.0, args.seed))
+    allocations = measure_allocations(conversations)
+
+    model.latencies = load_latencies
+    semantic = calibrate_semantic_threshold(load_semantic_pairs(args.semantic_pairs))
+    report = build_report(runs, model, allocations, measure_time_parser(conversations), semantic)
+    _print_report(report)
+
+    if args.json_path:
+        with open(args.json_path, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+    failed = []
+    if args.gate_quick_rate is not None and report["quick_path_rate"] < args.gate_quick_rate:
+        failed.append(f"快速路由命中率 {report['quick_path_rate']:.1%} < {args.gate_quick_rate:.1%}")
+    if args.gate_p99_ms is not None and report["latency"]["total"]["p99_ms"] > args.gate_p99_ms:
+        failed.append(f"p99 {report['latency']['total']['p99_ms']}ms > {args.gate_p99_ms}ms")
+    if args.gate_parse_us is not None and report["time_parser"]["p99_us"] > args.gate_parse_us:
+        failed.append(f"時間解析 p99 {report['time_parser']['p99_us']}µs > {args.gate_parse_us}µs")
+    if report["semantic_cache"]["wrong"]:
+        failed.append(f"相似度快取答錯 {report['semantic_cache']['wrong']} 對標註問題")
+    for msg in failed:
+        print(f"❌ 門檻唔達標：{msg}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
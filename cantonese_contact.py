@@ -0,0 +1,112 @@
+# ========================================
+# 客人聯絡資料抽取（名字 / 香港電話）
+# ========================================
+# 功能：
+# - 8 位香港電話號碼：容許空格、「-」、「+852」字頭，同埋逐個讀嘅中文數字（「九一二三 四五六七」）
+# - 常見自我介紹講法：「我叫陳大文」、「叫我 Amy」、「我係陳小姐」、「我姓歐陽，歐陽太」
+# - 要有自稱（子句開頭嘅「我叫 / 叫我」、「我係 / 我姓 + 稱呼」），
+#   「叫我等幾耐」「係陳小姐介紹我嚟」「我想搵何生」都唔當名；啱啱問完名先認淨係稱呼（「陳小姐」）
+# - 所有正則喺 import 時編譯，每句只掃描一次，唔使問 LLM
+# - 輸入係 cantonese_text.normalize_utterance 之後嘅標準文字（大部分數字已經係阿拉伯數字、英文細楷）
+
+import re
+from typing import NamedTuple
+
+# ==================== 詞表 ====================
+
+# 逐個讀嘅數字（normalize_utterance 唔會轉兩個字一組嘅「九一 二三」，所以呢度再認一次）
+_SPOKEN_DIGITS = {"零": "0", "一": "1", "二": "2", "兩": "2", "三": "3", "四": "4",
+                  "五": "5", "六": "6", "七": "7", "八": "8", "九": "9"}
+
+# 香港常見姓氏（複姓排先）；稱呼模式只認呢啲姓，避免「好小姐」之類誤中
+SURNAMES = (
+    "歐陽", "司徒", "上官", "諸葛", "尉遲", "端木", "司馬", "公孫",
+    "陳", "李", "張", "黃", "何", "林", "吳", "劉", "梁", "鄭", "謝", "郭", "羅", "蔡", "許",
+    "曾", "鄧", "馮", "蕭", "楊", "朱", "胡", "麥", "盧", "葉", "余", "潘", "袁", "蘇", "馬",
+    "唐", "譚", "周", "王", "趙", "方", "江", "莫", "姚", "廖", "鍾", "鄺", "文", "孔", "邱",
+    "丘", "石", "伍", "徐", "冼", "岑", "范", "杜", "游", "顏", "甘", "關", "侯", "韋",
+)
+
+# 稱呼：「生」「太」後面唔可以係常見詞尾（「陳生日」「江太古」唔係人名）
+HONORIFICS = ("小姐", "先生", "太太", "女士", "姑娘", "生(?![日意活果氣])", "太(?![古子陽空多])")
+
+# 名字到此為止：標點、語氣詞、「電話」
+_NAME_END = r"(?=[\s,.!?，。！？、~～呀啊啦喇囉㗎嘅喎吖嗎呢]|電話|手機|$)"
+
+
+# ==================== 編譯正則 ====================
+
+_PHONE_DIGIT = "[0-9" + "".join(_SPOKEN_DIGITS) + "]"
+# 香港號碼唔會以 0 / 1 開頭
+_PHONE_FIRST = "[2-9二兩三四五六七八九]"
+
+# 前後唔可以再有數字（避免喺信用卡號之類中間截 8 位）
+_PHONE_RE = re.compile(
+    rf"(?<![0-9])(?<![0-9][\s-])(?:\+?852[\s-]?)?(?P<phone>{_PHONE_FIRST}(?:[\s-]?{_PHONE_DIGIT}){{7}})"
+    rf"(?![\s-]?{_PHONE_DIGIT})"
+)
+
+_SURNAME_ALT = "|".join(sorted(SURNAMES, key=len, reverse=True))
+
+_TITLE = rf"(?:{_SURNAME_ALT})(?:{'|'.join(HONORIFICS)})"
+
+# 「陳小姐」「歐陽生」：淨係啱啱問完名先可以喺句中任何位置認
+_TITLED_RE = re.compile(_TITLE)
+
+# 自稱 + 稱呼：「我係陳小姐」「我姓陳，陳小姐」「叫我陳生得喇」
+_SELF_TITLED_RE = re.compile(rf"(?:我係|我姓|我叫|叫我|我個名係)\s*(?:(?:{_SURNAME_ALT})[,，\s]*)?(?P<title>{_TITLE})")
+
+# 子句開頭（可以先打招呼）
+_CLAUSE_START = r"(?:^|(?<=[\s,.!?;~，。！？、；～]))(?:你好|喂|hello|hi)?\s*"
+
+_INTRO_RE = re.compile(
+    _CLAUSE_START
+    + r"(?:我叫|叫我|我個名係|我個名叫|名字係|my name is)\s*"
+    + "(?:"
+    # 「我叫陳大文」「叫我阿欣」：一定要姓或者「阿」開頭
+    + rf"(?P<given>(?:{_SURNAME_ALT}|阿)[一-鿿]{{1,3}}?){_NAME_END}"
+    # 英文名：「my name is amy」「叫我 amy」「我叫 amy wong」
+    + r"|(?P<english>[a-z]{2,}(?: [a-z]{2,})?)(?![a-z])"
+    + ")"
+)
+
+
+# ==================== 抽取 ====================
+
+class ContactInfo(NamedTuple):
+    customer_name: str  # 冇就係 None
+    phone: str  # 「9123 4567」格式；冇就係 None
+
+
+def extract_phone(text: str) -> str:
+    """搵第一個 8 位香港電話號碼，返回「9123 4567」格式；冇就返回 None。"""
+    m = _PHONE_RE.search(text or "")
+    if m is None:
+        return None
+    digits = "".join(_SPOKEN_DIGITS.get(ch, ch) for ch in m.group("phone") if ch not in " -")
+    return f"{digits[:4]} {digits[4:]}"
+
+
+def extract_name(text: str, asked_for_name: bool = False) -> str:
+    """
+    搵客人自稱嘅名字；稱呼（「陳小姐」）優先過單純自我介紹（「我叫陳大文」）。
+    「陳大文，叫我陳生得喇」返回「陳生」。冇就返回 None。
+    asked_for_name=True（啱啱問咗客人名）先會認冇自稱嘅稱呼，例如淨係答「陳小姐」。
+    """
+    text = text or ""
+    m = _SELF_TITLED_RE.search(text)
+    if m is not None:
+        return m.group("title")
+    if asked_for_name:
+        m = _TITLED_RE.search(text)
+        if m is not None:
+            return m.group()
+    m = _INTRO_RE.search(text)
+    if m is None:
+        return None
+    return m.group("given") or m.group("english").title()
+
+
+def extract_contact(text: str, asked_for_name: bool = False) -> ContactInfo:
+    """一次過抽名字同電話（標準化咗嘅文字）。"""
+    return ContactInfo(extract_name(text, asked_for_name), extract_phone(text))
@@ -0,0 +1,139 @@
+# ========================================
+# 說話文字標準化（每輪只做一次）
+# ========================================
+# 功能：
+# - 一個預先計好嘅 str.translate 表：全形 → 半形、英文轉細楷、常見簡體字 → 繁體
+# - 細數字自動機：中文數字 → 阿拉伯數字（「三點半」→「3點半」、「一千八」→「1800」、
+#   「九一二三 四五六七」→「9123 4567」），只喺有上文下理嘅位置先轉，唔會搞亂「一齊」「萬一」
+# - 之後所有匹配（關鍵字、時間解析、快取）都直接用標準化後嘅文字，唔使各自再 .lower()
+
+import re
+
+# ==================== 字元對照表 ====================
+
+# ASR 有時會出簡體字；只收關鍵字表 / 時間解析會用到嘅字
+_SIMPLIFIED = {
+    "点": "點", "号": "號", "约": "約", "预": "預", "礼": "禮", "钱": "錢", "价": "價",
+    "费": "費", "几": "幾", "时": "時", "间": "間", "营": "營", "业": "業", "开": "開",
+    "边": "邊", "后": "後", "听": "聽", "个": "個", "层": "層", "洁": "潔", "这": "這",
+    "电": "電", "话": "話", "码": "碼", "两": "兩", "万": "萬",
+}
+# 「周」本身都係繁體字（仲係常見姓氏），唔好轉做「週」；時間解析兩個都認
+
+
+def _build_canonical_table() -> dict:
+    table = {}
+    # 全形 ASCII（！到～）→ 半形，全形空格 → 半形空格
+    for code in range(0xFF01, 0xFF5F):
+        table[code] = code - 0xFEE0
+    table[0x3000] = " "
+    # 英文一律細楷（全形英文轉咗半形之後亦要細楷）
+    for code in range(ord("A"), ord("Z") + 1):
+        table[code] = code + 32
+        table[code + 0xFEE0] = code + 32
+    for simplified, traditional in _SIMPLIFIED.items():
+        table[ord(simplified)] = traditional
+    table[ord("〇")] = "零"
+    return table
+
+
+CANONICAL_TABLE = _build_canonical_table()
+
+# ==================== 中文數字自動機 ====================
+
+_DIGITS = {"零": 0, "一": 1, "二": 2, "兩": 2, "三": 3, "四": 4, "五": 5, "六": 6, "七": 7, "八": 8, "九": 9}
+_UNITS = {"十": 10, "百": 100, "千": 1000, "萬": 10000}
+_TENS = {"廿": 20, "卅": 30}
+
+_NUMERAL_RUN_RE = re.compile("[零一二兩三四五六七八九十百千萬廿卅]+")
+
+# 單個中文數字字只喺呢啲字前後先轉（「三點」「五號」「兩點三」「星期二」），
+# 其他情況（「一齊」「一定」「十分好」）保持原樣
+_NEXT_MARKERS = frozenset("點號月蚊元時")
+_PREV_MARKERS = frozenset("點")
+_WEEKDAY_MARKERS = frozenset("期拜週周")
+
+
+def numeral_value(run: str) -> int:
+    """
+    由左至右逐字行嘅小自動機，將有單位嘅中文數字轉 int（0 – 99,999,999）；唔合法返回 -1。
+    口語省略尾單位：「一千八」= 1800、「三百五」= 350、「兩萬五」= 25000。
+    """
+    total = 0  # 萬以上
+    section = 0  # 萬以下已完成部分
+    digit = -1  # 未配單位嘅數字
+    last_unit = 1
+    after_zero = False
+    for ch in run:
+        if ch == "零":
+            after_zero = True  # 「一千零五十」：之後嘅數字唔再省略單位
+            continue
+        if ch in _DIGITS:
+            if digit >= 0:
+                return -1  # 兩個數字相連（「兩三」）唔係單一個數
+            digit = _DIGITS[ch]
+        elif ch in _TENS:
+            if digit >= 0 or section:
+                return -1
+            section, last_unit = _TENS[ch], 10
+        elif ch == "萬":
+            section += max(digit, 0)
+            if not section:
+                return -1
+            total, section, digit, last_unit, after_zero = (total + section) * 10000, 0, -1, 10000, False
+        else:
+            unit = _UNITS[ch]
+            if unit >= last_unit and section:
+                return -1
+            section += (digit if digit >= 0 else 1) * unit
+            digit, last_unit, after_zero = -1, unit, False
+    if digit > 0 and last_unit >= 100 and not after_zero:
+        digit *= last_unit // 10
+    return total + section + max(digit, 0)
+
+
+def _convert_run(run: str, prev: str, nxt: str, before_ampm: bool) -> str:
+    """按前後文決定一串中文數字要唔要轉，要就返回阿拉伯數字。"""
+    # 「星期二十點」：第一個字係星期幾，餘下另計
+    if prev in _WEEKDAY_MARKERS and 0 < _DIGITS.get(run[0], 0) < 8:
+        head, rest = str(_DIGITS[run[0]]), run[1:]
+        if not rest:
+            return head
+        rest = _convert_run(rest, "", nxt, before_ampm)
+        return f"{head} {rest}" if rest[0].isdigit() else head + rest
+
+    if run[0] in "百千萬":
+        return run  # 「萬一」「千祈」
+    has_unit = any(ch in _UNITS or ch in _TENS for ch in run)
+    if not has_unit:
+        if len(run) >= 3:
+            # 逐個讀嘅數字（電話）
+            return "".join(str(_DIGITS[ch]) for ch in run)
+        if len(run) == 2:
+            if run[0] == "零" and prev in _PREV_MARKERS:
+                return "0" + str(_DIGITS[run[1]])  # 「三點零五」嘅分鐘
+            return run  # 「兩三日」
+    if len(run) == 1 and not (nxt in _NEXT_MARKERS or prev in _PREV_MARKERS or before_ampm):
+        return run  # 「一齊」「十分好」
+    value = numeral_value(run)
+    return str(value) if value >= 0 else run
+
+
+def _convert_match(text: str, m: re.Match) -> str:
+    start, end = m.span()
+    prev = text[start - 1] if start else ""
+    nxt = text[end] if end < len(text) else ""
+    return _convert_run(m.group(), prev, nxt, text.startswith(("am", "pm"), end))
+
+
+def normalize_utterance(text: str) -> str:
+    """
+    將客人說話轉成標準文字，每輪只做一次，之後所有匹配共用：
+    全形轉半形、英文細楷、常見簡體轉繁體、去頭尾空白，中文數字喺有上文下理時轉阿拉伯數字。
+    """
+    if not text:
+        return ""
+    text = text.translate(CANONICAL_TABLE).strip()
+    if not _NUMERAL_RUN_RE.search(text):
+        return text
+    return _NUMERAL_RUN_RE.sub(lambda m: _convert_match(text, m), text)
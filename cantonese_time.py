@@ -0,0 +1,311 @@
+# ========================================
+# 粵語日期 / 時間解析
+# ========================================
+# 功能：
+# - 由客人說話抽取預約時間（「聽日下晝三點半」、「下個禮拜二十點」、「12月25號夜晚七點」）
+# - 相對日子 / 星期 / 月日 + 時段 + 鐘點（包括「兩點三」、「三點半」、「3:30pm」、「三點至五點」）
+# - 對住參考時鐘返回標準化 datetime（或者時間範圍），唔使問 LLM
+# - 所有詞表喺 import 時編譯成一條正則，每句只掃描一次
+# - 輸入係 cantonese_text.normalize_utterance 之後嘅標準文字（阿拉伯數字、細楷），
+#   所以呢度唔使再處理中文數字、全形或者大細楷
+
+import re
+from datetime import date, datetime, time, timedelta
+from typing import NamedTuple
+
+# ==================== 詞表 ====================
+
+# 相對日子：詞 → (日數偏移, 隱含時段)
+DAY_WORDS = {
+    "今日": (0, None),
+    "今天": (0, None),
+    "今朝": (0, "morning"),
+    "今晚": (0, "evening"),
+    "聽日": (1, None),
+    "明日": (1, None),
+    "明天": (1, None),
+    "聽朝": (1, "morning"),
+    "聽晚": (1, "evening"),
+    "後日": (2, None),
+    "後天": (2, None),
+    "大後日": (3, None),
+    "大後天": (3, None),
+}
+
+# 星期前綴：詞 → 隔幾多個禮拜（None = 最近一個，今日都計）
+WEEK_PREFIXES = {
+    "今個": 0,
+    "呢個": 0,
+    "這個": 0,
+    "下個": 1,
+    "下": 1,
+    "下下個": 2,
+}
+# 月份前綴（「下個月25號」）：詞 → 隔幾多個月
+MONTH_PREFIXES = {
+    "今個月": 0,
+    "呢個月": 0,
+    "這個月": 0,
+    "下個月": 1,
+    "下月": 1,
+    "下下個月": 2,
+}
+WEEKDAYS = {"1": 0, "2": 1, "3": 2, "4": 3, "5": 4, "6": 5, "7": 6, "日": 6, "天": 6}
+
+# 時段：詞 → 時段名
+PERIOD_WORDS = {
+    "朝早": "morning",
+    "早上": "morning",
+    "上晝": "morning",
+    "上午": "morning",
+    "am": "morning",
+    "中午": "noon",
+    "晏晝": "noon",
+    "下晝": "afternoon",
+    "下午": "afternoon",
+    "pm": "afternoon",
+    "夜晚": "evening",
+    "晚上": "evening",
+    "晚頭": "evening",
+}
+
+# 只講時段冇講鐘點時嘅範圍（時）
+PERIOD_RANGES = {
+    "morning": (9, 12),
+    "noon": (12, 14),
+    "afternoon": (14, 18),
+    "evening": (18, 21),
+}
+
+# 只講日子冇講時間 → 成日營業時間
+BUSINESS_HOURS = (11, 21)
+
+# 冇講上下晝時，呢個範圍嘅鐘點當下晝（營業時間 11am–9pm）
+ASSUME_PM_HOURS = range(1, 9)
+
+PERIOD_LABELS = {"morning": "上晝", "noon": "中午", "afternoon": "下晝", "evening": "夜晚"}
+WEEKDAY_LABELS = ("星期一", "星期二", "星期三", "星期四", "星期五", "星期六", "星期日")
+
+# 一至兩位阿拉伯數字（前面唔可以係數字，避免喺電話號碼中間搵到「67點」）
+_NUM = r"(?<!\d)\d{1,2}"
+
+
+# ==================== 編譯正則 ====================
+
+def _alt(words) -> str:
+    # 長詞排先，避免「下」搶咗「下下個」
+    return "|".join(re.escape(w) for w in sorted(words, key=len, reverse=True))
+
+
+def _clock(suffix: str) -> str:
+    return (
+        rf"(?P<hour{suffix}>{_NUM})\s*(?P<sep{suffix}>[點:])(?!點)\s*"
+        rf"(?:(?P<half{suffix}>半)|(?P<minute{suffix}>{_NUM})\s*(?P<unit{suffix}>分|個字)?)?"
+    )
+
+
+_TOKEN_RE = re.compile(
+    "|".join((
+        rf"(?P<day_word>{_alt(DAY_WORDS)})",
+        rf"(?P<week_prefix>{_alt(WEEK_PREFIXES)})?(?:星期|禮拜|週|周)(?P<weekday>[{''.join(WEEKDAYS)}])",
+        rf"(?:(?P<month_prefix>{_alt(MONTH_PREFIXES)})\s*|(?P<month>{_NUM})\s*月\s*)?(?P<mday>{_NUM})\s*號",
+        _clock("") + rf"(?:\s*(?:至|到|-|~|－)\s*{_clock('_end')})?",
+        rf"(?P<ap_hour>{_NUM})\s*(?P<ap>am|pm)(?![a-z])",
+        # 英文時段要成個字（「amy」唔係 am）
+        rf"(?P<period>{_alt(w for w in PERIOD_WORDS if not w.isascii())}|(?<![a-z])(?:am|pm)(?![a-z]))",
+    ))
+)
+
+
+# ==================== 解析結果 ====================
+
+class BookingTime(NamedTuple):
+    start: datetime
+    end: datetime  # 準確時間 = start；範圍就係結束時間
+    has_date: bool  # 客人有冇講日子（冇就係按鐘點推算今日 / 聽日）
+    has_clock: bool  # 客人有冇講準確鐘點（冇就係時段 / 成日範圍）
+
+    @property
+    def is_range(self) -> bool:
+        return self.end != self.start
+
+
+def _minutes(m: re.Match, suffix: str) -> int:
+    if m.group("half" + suffix):
+        return 30
+    raw = m.group("minute" + suffix)
+    if not raw:
+        return 0
+    value = int(raw)
+    # 「2點3」「10點10」（即「兩點三」「十點十」）：用「點」而且冇「分」，細過 12 就係幾個字（每個字 5 分鐘）；
+    # 「3點05」（「三點零五」）有前置零就係分鐘
+    unit = m.group("unit" + suffix)
+    if unit == "個字" or (
+        unit is None and m.group("sep" + suffix) == "點" and 0 < value < 12 and not raw.startswith("0")
+    ):
+        value *= 5
+    return value
+
+
+def _hour_24(hour: int, period: str) -> int:
+    if period in ("afternoon", "evening") and hour < 12:
+        return hour + 12
+    if period == "noon" and hour < 3:
+        return hour + 12 if hour else 12
+    if period == "morning" and hour == 12:
+        return 0
+    if period is None and hour in ASSUME_PM_HOURS:
+        return hour + 12
+    return hour
+
+
+def _resolve_date(today: date, m_day: tuple, m_week: tuple, m_date: tuple):
+    if m_day is not None:
+        return today + timedelta(days=m_day[0])
+    if m_week is not None:
+        prefix, weekday = m_week
+        weeks = WEEK_PREFIXES.get(prefix) if prefix else None
+        if weeks is None:
+            return today + timedelta(days=(weekday - today.weekday()) % 7)
+        monday = today - timedelta(days=today.weekday())
+        return monday + timedelta(days=7 * weeks + weekday)
+    if m_date is not None:
+        month, mday, months_ahead = m_date
+        if months_ahead is not None:
+            # 「下個月25號」：月份固定，冇呢日（例如 2 月 30 號）就當冇講日子
+            year, month = divmod(today.month - 1 + months_ahead, 12)
+            try:
+                return date(today.year + year, month + 1, mday)
+            except ValueError:
+                return None
+        explicit_month = month is not None
+        month = month if explicit_month else today.month
+        year = today.year
+        for _ in range(13):
+            try:
+                d = date(year, month, mday)
+            except ValueError:
+                d = None
+            if d is not None and d >= today:
+                return d
+            # 過咗 / 無效 → 有講月份就睇下年，冇講就睇下個月
+            if explicit_month:
+                year += 1
+            else:
+                month, year = (1, year + 1) if month == 12 else (month + 1, year)
+    return None
+
+
+def parse_booking_time(text: str, now: datetime = None) -> BookingTime:
+    """
+    由一句標準化咗嘅說話（normalize_utterance）抽取預約時間，
+    對住參考時鐘 now（預設而家）返回 BookingTime；搵唔到日子、時段或者鐘點就返回 None。
+
+    規則：
+    - 冇講日子：鐘點 / 時段未過就當今日，過咗就當聽日
+    - 有講日子但成段時間已經過咗（星期四講「呢個禮拜二」、下晝四點講「今日三點」）：返回 None
+    - 冇講上下晝：1–8 點當下晝
+    - 「N點M」冇「分」而 M 細過 12：M 個字（M × 5 分鐘）
+    - 只有時段：返回時段範圍；只有日子：返回營業時間範圍
+    """
+    if not text:
+        return None
+    now = now or datetime.now()
+    today = now.date()
+
+    m_day = m_week = m_date = None
+    period = None
+    clock = None
+    for m in _TOKEN_RE.finditer(text):
+        if m.group("day_word"):
+            m_day = DAY_WORDS[m.group("day_word")]
+            period = period or m_day[1]
+        elif m.group("weekday"):
+            m_week = (m.group("week_prefix"), WEEKDAYS[m.group("weekday")])
+        elif m.group("mday"):
+            month = int(m.group("month")) if m.group("month") else None
+            mday = int(m.group("mday"))
+            if 1 <= mday <= 31 and (month is None or 1 <= month <= 12):
+                m_date = (month, mday, MONTH_PREFIXES.get(m.group("month_prefix")))
+        elif m.group("hour") and clock is None:
+            clock = m
+        elif m.group("ap_hour") and clock is None:
+            clock = m
+            period = PERIOD_WORDS[m.group("ap")]
+        elif m.group("period"):
+            period = PERIOD_WORDS[m.group("period")]
+
+    day = _resolve_date(today, m_day, m_week, m_date)
+
+    if clock is not None:
+        if clock.group("ap_hour"):
+            hour, minute, end = int(clock.group("ap_hour")), 0, None
+        else:
+            hour, minute = int(clock.group("hour")), _minutes(clock, "")
+            end = (int(clock.group("hour_end")), _minutes(clock, "_end")) if clock.group("hour_end") else None
+        if not (0 <= hour <= 23 and 0 <= minute <= 59):
+            return None
+        start = datetime.combine(day or today, time(_hour_24(hour, period), minute))
+        if day is None and start < now:
+            start += timedelta(days=1)
+        finish = start
+        if end is not None and 0 <= end[0] <= 23 and 0 <= end[1] <= 59:
+            # 結束鐘點跟開始嘅時段推算（「下晝三點至五點」）
+            end_hour = _hour_24(end[0], period or ("afternoon" if start.hour >= 12 else None))
+            finish = start.replace(hour=end_hour, minute=end[1])
+            if finish < start:
+                finish = start
+        if day is not None and finish < now:
+            return None
+        return BookingTime(start, finish, day is not None, True)
+
+    if period is not None:
+        first, last = PERIOD_RANGES[period]
+    elif day is not None:
+        first, last = BUSINESS_HOURS
+    else:
+        return None
+
+    base = day or today
+    start = datetime.combine(base, time(first))
+    finish = datetime.combine(base, time(last))
+    if finish <= now:
+        if day is not None:
+            return None
+        start += timedelta(days=1)
+        finish += timedelta(days=1)
+    return BookingTime(start, finish, day is not None, False)
+
+
+# ==================== 輸出 ====================
+
+def _spoken_clock(dt: datetime) -> str:
+    hour = dt.hour % 12 or 12
+    if dt.minute == 0:
+        return f"{hour}點"
+    if dt.minute == 30:
+        return f"{hour}點半"
+    return f"{hour}點{dt.minute:02d}分"
+
+
+def _period_of(dt: datetime) -> str:
+    if dt.hour < 12:
+        return "morning"
+    if dt.hour < 14:
+        return "noon"
+    if dt.hour < 18:
+        return "afternoon"
+    return "evening"
+
+
+def format_booking_time(bt: BookingTime) -> str:
+    """轉做 TTS 讀得出嘅標準寫法，例如「10月19號 星期日 下晝3點半」。"""
+    day = f"{bt.start.month}月{bt.start.day}號 {WEEKDAY_LABELS[bt.start.weekday()]}"
+    if not bt.has_clock:
+        if (bt.start.hour, bt.end.hour) == BUSINESS_HOURS:
+            return day
+        return f"{day} {PERIOD_LABELS[_period_of(bt.start)]}"
+    text = f"{day} {PERIOD_LABELS[_period_of(bt.start)]}{_spoken_clock(bt.start)}"
+    if bt.is_range:
+        text += f"至{_spoken_clock(bt.end)}"
+    return text
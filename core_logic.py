@@ -3,37 +3,120 @@
 # ========================================
 # 功能：
 # - 智能對話管理（狀態追蹤）
-# - 「快速路由」優化（70% 對話無需 LLM）
+# - 「快速路由」優化（回放語料 benchmark_corpus.jsonl 約 63% 輪次無需 LLM，見 benchmark_replay.py）
 # - 硬規則層（避免重複提問）
 # - Gemini LLM 集成（複雜情況使用）
 
 import os
 import re
 import json
-from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturesTimeoutError
-import google.generativeai as genai
+import time
+import uuid
+import zlib
+import queue
+import asyncio
+import itertools
+import threading
+from collections import OrderedDict, deque
+from datetime import datetime
+from contextlib import closing
+from enum import Enum
+from typing import NamedTuple
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, TimeoutError as FuturesTimeoutError, wait
+
+from cantonese_contact import extract_contact
+from cantonese_text import CANONICAL_TABLE, normalize_utterance
+from cantonese_time import format_booking_time, parse_booking_time
+from llm_backends import create_backend, estimate_tokens
+
+# 注意：LLM SDK 同 numpy 都係第一次用先載入（見 get_llm_backend / SemanticCache），
+# 令快速路由同文字工具可以喺幾毫秒內 import，唔使 API key 都用得。
 
 # ==================== 環境變數載入 ====================
-GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
-if not GEMINI_API_KEY:
-    raise RuntimeError("❌ 請先設定環境變數 GEMINI_API_KEY")
-
-# 設定 Gemini
-if os.getenv("HTTPS_PROXY"):
-    genai.configure(api_key=GEMINI_API_KEY, transport="rest")
-else:
-    genai.configure(api_key=GEMINI_API_KEY)
+# LLM 後端：gemini / openai / stub（各自嘅超時見 llm_backends）
+LLM_BACKEND = os.getenv("LLM_BACKEND", "gemini")
 
 # 速度參數（從 . env 讀取，有預設值）
-GEMINI_TIMEOUT_S = int(os.getenv("GEMINI_TIMEOUT_S", "5"))
 GEMINI_MAX_TOKENS = int(os. getenv("GEMINI_MAX_TOKENS", "60"))
 GEMINI_TEMPERATURE = float(os.getenv("GEMINI_TEMPERATURE", "0.2"))
 GEMINI_TOP_P = float(os.getenv("GEMINI_TOP_P", "0.7"))
 
+# 串流回覆最多講幾多句（同 SYSTEM_PROMPT 一致；0 = 唔限）
+REPLY_MAX_SENTENCES = int(os.getenv("REPLY_MAX_SENTENCES", "3"))
+
+# 每輪延遲追蹤：""（關閉）/ "memory" / "jsonl:<檔案路徑>"
+TRACE_SINK = os.getenv("TRACE_SINK", "")
+
+# LLM 併發參數：共用線程數目，同埋超時後仍未完成嘅「孤兒」請求上限
+LLM_MAX_WORKERS = int(os.getenv("LLM_MAX_WORKERS", "8"))
+LLM_MAX_ORPHANS = int(os.getenv("LLM_MAX_ORPHANS", "4"))
+
+# 對沖請求（預設關閉）：主請求超過最近延遲嘅百分位仍未返，就再發一個，用先返嗰個
+LLM_HEDGE = os.getenv("LLM_HEDGE", "0") == "1"
+LLM_HEDGE_PERCENTILE = float(os.getenv("LLM_HEDGE_PERCENTILE", "0.95"))
+LLM_HEDGE_MIN_DELAY_S = float(os.getenv("LLM_HEDGE_MIN_DELAY_S", "0.3"))
+LLM_HEDGE_MAX_INFLIGHT = int(os.getenv("LLM_HEDGE_MAX_INFLIGHT", "2"))
+LLM_HEDGE_BACKEND = os.getenv("LLM_HEDGE_BACKEND", "")  # "" = 同主後端一樣
+LLM_HEDGE_API_KEY = os.getenv("LLM_HEDGE_API_KEY", "")  # "" = 用主後端嘅 key（gemini 只可以用一條 key）
+
+# LLM 配額（令牌桶）：每分鐘最多幾多個請求（0 = 唔限），最多儲幾多個，
+# 設定咗狀態檔就喺多個 process 之間共用；排隊最多等幾耐，等唔切就提早降級
+LLM_RATE_PER_MIN = float(os.getenv("LLM_RATE_PER_MIN", "0"))
+LLM_RATE_BURST = float(os.getenv("LLM_RATE_BURST", "5"))
+LLM_RATE_STATE_FILE = os.getenv("LLM_RATE_STATE_FILE", "")
+LLM_QUEUE_MAX_WAIT_S = float(os.getenv("LLM_QUEUE_MAX_WAIT_S", "1.0"))
+
+# 降級模式（淨係用規則，唔問 LLM）：auto / on / off；
+# auto 時 LLM 排隊延遲超過 ENTER 就進入，跌返落 EXIT 以下先離開
+LLM_DEGRADED_MODE = os.getenv("LLM_DEGRADED_MODE", "auto")
+LLM_DEGRADE_ENTER_S = float(os.getenv("LLM_DEGRADE_ENTER_S", "1.0"))
+LLM_DEGRADE_EXIT_S = float(os.getenv("LLM_DEGRADE_EXIT_S", "0.3"))
+LLM_DEGRADE_HALF_LIFE_S = float(os.getenv("LLM_DEGRADE_HALF_LIFE_S", "10"))
+
+# 相同 prompt 同時間只問一次 LLM（0 = 停用）
+LLM_SINGLE_FLIGHT = os.getenv("LLM_SINGLE_FLIGHT", "1") == "1"
+
+# 自適應超時：最近成功延遲嘅百分位 × 倍數，限制喺下限同後端超時（上限）之間
+LLM_ADAPTIVE_TIMEOUT = os.getenv("LLM_ADAPTIVE_TIMEOUT", "1") == "1"
+LLM_TIMEOUT_FLOOR_S = float(os.getenv("LLM_TIMEOUT_FLOOR_S", "1.0"))
+LLM_TIMEOUT_PERCENTILE = float(os.getenv("LLM_TIMEOUT_PERCENTILE", "0.99"))
+LLM_TIMEOUT_MULTIPLIER = float(os.getenv("LLM_TIMEOUT_MULTIPLIER", "2.0"))
+
+# 熔斷器：最近 N 輪錯誤率過高就停問 LLM 一段時間，之後放少量探測請求
+LLM_BREAKER_WINDOW = int(os.getenv("LLM_BREAKER_WINDOW", "20"))
+LLM_BREAKER_MIN_CALLS = int(os.getenv("LLM_BREAKER_MIN_CALLS", "10"))
+LLM_BREAKER_ERROR_RATE = float(os.getenv("LLM_BREAKER_ERROR_RATE", "0.5"))
+LLM_BREAKER_COOLDOWN_S = float(os.getenv("LLM_BREAKER_COOLDOWN_S", "30"))
+LLM_BREAKER_PROBES = int(os.getenv("LLM_BREAKER_PROBES", "1"))
+
+# LLM 回覆快取（0 = 停用）
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "512"))
+RESPONSE_CACHE_TTL_S = float(os.getenv("RESPONSE_CACHE_TTL_S", "900"))
+
+# 相似度快取（字元 n-gram + IDF；0 = 停用），只放已審核回覆（SEMANTIC_CACHE_VETTED_FILE，JSONL）
+SEMANTIC_CACHE_SIZE = int(os.getenv("SEMANTIC_CACHE_SIZE", "10000"))
+SEMANTIC_CACHE_DIM = int(os.getenv("SEMANTIC_CACHE_DIM", "1024"))
+SEMANTIC_CACHE_TOP_K = int(os.getenv("SEMANTIC_CACHE_TOP_K", "5"))
+# 門檻由 semantic_cache_pairs.jsonl 校準（python benchmark_replay.py 會報告）
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.58"))
+SEMANTIC_CACHE_VETTED_FILE = os.getenv("SEMANTIC_CACHE_VETTED_FILE", "")
+
+# ==================== 療程目錄 ====================
+
+# 療程目錄同價錢（港幣起價）：系統提示詞同快速回覆模板都由呢度渲染，改價錢之後要 reload_content()
+TREATMENTS = ("basic facial", "深層清潔 facial", "皮秒激光療程", "身體按摩")
+PRICE_CATALOGUE = {
+    "basic facial": 480,
+    "深層清潔 facial": 680,
+    "皮秒激光療程": 1800,
+    "身體按摩": 580,
+}
+
 # ==================== 系統提示詞 ====================
 VOICE_NAME = "zh-HK-HiuMaanNeural"
 
-SYSTEM_PROMPT = """
+# {services} 由 PRICE_CATALOGUE 渲染（見 _build_system_prompt）
+SYSTEM_PROMPT_TEMPLATE = """
 你而家係一間「香港美容院」嘅粵語客服職員。
 請用自然、親切、貼心、地道香港廣東話回應客人。
 
@@ -47,10 +130,7 @@ SYSTEM_PROMPT = """
 - 回覆入面不要讀括號入面的字、唔好讀標點符號
 
 服務範圍：
-- basic facial（$480 起）
-- 深層清潔 facial（$680 起）
-- 皮秒激光療程（$1,800 起）
-- 身體按摩（$580 起）
+{services}
 
 記憶指引：
 - 一旦客人講明療程選擇，就禁止再問邊款，只可確認
@@ -62,43 +142,1158 @@ SYSTEM_PROMPT = """
 - 唔好長篇介紹，直接有用訊息優先
 """
 
-GEN_CONFIG = genai.GenerationConfig(
-    max_output_tokens=GEMINI_MAX_TOKENS,
-    temperature=GEMINI_TEMPERATURE,
-    top_p=GEMINI_TOP_P,
-)
 
-gemini_model = genai.GenerativeModel(
-    model_name="gemini-1.5-flash",
-    system_instruction=SYSTEM_PROMPT,
+def _build_system_prompt() -> str:
+    services = "\n".join(f"- {name}（${PRICE_CATALOGUE[name]:,} 起）" for name in TREATMENTS)
+    return SYSTEM_PROMPT_TEMPLATE.format(services=services)
+
+
+SYSTEM_PROMPT = _build_system_prompt()
+
+# ==================== LLM 後端（延遲初始化） ====================
+
+# 第一次問 LLM 先建立；測試 / 基準測試可以用 set_llm_backend 換走
+llm_backend = None
+_backend_lock = threading.Lock()
+# get_*_backend 自己用 SYSTEM_PROMPT 建嘅後端；reload_content 會重建，set_*_backend 換入嘅唔郁
+_built_backends = []
+
+
+def get_llm_backend():
+    """
+    返回目前嘅 LLM 後端，第一次呼叫先按 LLM_BACKEND 建立（import SDK、檢查 API key）。
+    建立失敗會喺呢度拋錯（由 LLM 錯誤處理接住）。
+    """
+    global llm_backend
+    if llm_backend is not None:
+        return llm_backend
+
+    with _backend_lock:
+        if llm_backend is None:
+            llm_backend = create_backend(
+                LLM_BACKEND,
+                system_prompt=SYSTEM_PROMPT,
+                max_tokens=GEMINI_MAX_TOKENS,
+                temperature=GEMINI_TEMPERATURE,
+                top_p=GEMINI_TOP_P,
+            )
+            _built_backends.append(llm_backend)
+    return llm_backend
+
+
+def set_llm_backend(backend) -> None:
+    """換 LLM 後端（要符合 llm_backends.LLMBackend 介面）。"""
+    global llm_backend
+    llm_backend = backend
+
+
+# 對沖請求用嘅後端；冇另外設定後端 / key 就同主後端共用
+hedge_backend = None
+
+
+def get_hedge_backend():
+    """返回對沖請求用嘅後端，第一次呼叫先按 LLM_HEDGE_BACKEND / LLM_HEDGE_API_KEY 建立。"""
+    global hedge_backend
+    if hedge_backend is not None:
+        return hedge_backend
+    if not (LLM_HEDGE_BACKEND or LLM_HEDGE_API_KEY):
+        return get_llm_backend()
+
+    with _backend_lock:
+        if hedge_backend is None:
+            overrides = {"api_key": LLM_HEDGE_API_KEY} if LLM_HEDGE_API_KEY else {}
+            hedge_backend = create_backend(
+                LLM_HEDGE_BACKEND or LLM_BACKEND,
+                system_prompt=SYSTEM_PROMPT,
+                max_tokens=GEMINI_MAX_TOKENS,
+                temperature=GEMINI_TEMPERATURE,
+                top_p=GEMINI_TOP_P,
+                **overrides,
+            )
+            _built_backends.append(hedge_backend)
+    return hedge_backend
+
+
+def set_hedge_backend(backend) -> None:
+    """換對沖請求用嘅後端（None = 同主後端共用）。"""
+    global hedge_backend
+    hedge_backend = backend
+
+
+def _drop_built_backends() -> None:
+    """系統提示詞改咗：自己建嘅後端下次用先按新提示詞重建。"""
+    global llm_backend, hedge_backend
+    with _backend_lock:
+        if any(b is llm_backend for b in _built_backends):
+            llm_backend = None
+        if any(b is hedge_backend for b in _built_backends):
+            hedge_backend = None
+        _built_backends.clear()
+
+
+def warmup(background: bool = False):
+    """
+    預先建立 LLM 後端（同埋載入 numpy），避免第一個 LLM 輪次食晒初始化時間。
+    background=True 就喺 daemon 線程做，即刻返回個 Thread。
+    """
+    def _warm():
+        try:
+            get_llm_backend()
+            import numpy  # noqa: F401
+        except Exception as e:
+            print(f"❌ 預熱失敗：{e}")
+
+    if not background:
+        _warm()
+        return None
+    t = threading.Thread(target=_warm, name="llm-warmup", daemon=True)
+    t.start()
+    return t
+
+
+# ==================== LLM 調用層（有截止時間） ====================
+
+class LLMSaturatedError(RuntimeError):
+    """超時未完成嘅 LLM 請求太多，暫時唔再開新請求。"""
+
+
+class LLMRateLimitedError(RuntimeError):
+    """LLM 配額喺截止時間前輪唔到，提早降級（唔等到上游拋 429）。"""
+
+
+# 長駐共用 executor：唔會每輪開新線程，亦唔會喺超時後等舊請求完成
+_llm_executor = ThreadPoolExecutor(max_workers=LLM_MAX_WORKERS, thread_name_prefix="llm")
+_orphan_lock = threading.Lock()
+_orphan_count = 0
+
+
+def _release_orphan(_fut) -> None:
+    global _orphan_count
+    with _orphan_lock:
+        _orphan_count -= 1
+
+
+def orphaned_llm_requests() -> int:
+    """返回目前已超時但仍喺背景執行緊嘅 LLM 請求數目。"""
+    return _orphan_count
+
+
+def _check_saturation() -> None:
+    with _orphan_lock:
+        if _orphan_count >= LLM_MAX_ORPHANS:
+            raise LLMSaturatedError(f"已有 {_orphan_count} 個超時 LLM 請求未完成")
+
+
+def _abandon(fut) -> None:
+    """仲排緊隊就直接取消；已經開始咗就放手，由 callback 釋放名額。"""
+    global _orphan_count
+    if fut.cancel():
+        return
+    with _orphan_lock:
+        _orphan_count += 1
+    fut.add_done_callback(_release_orphan)
+
+
+class LatencyTracker:
+    """最近 window 個成功 LLM 請求嘅延遲（秒），用嚟計對沖門檻。"""
+
+    def __init__(self, window: int = 200, min_samples: int = 20):
+        self.min_samples = min_samples
+        self._samples = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._samples)
+
+    def record(self, seconds: float) -> None:
+        with self._lock:
+            self._samples.append(seconds)
+
+    def percentile(self, q: float, default: float) -> float:
+        """第 q（0–1）百分位；樣本唔夠 min_samples 就返回 default。"""
+        with self._lock:
+            data = sorted(self._samples)
+        if len(data) < self.min_samples:
+            return default
+        return data[min(len(data) - 1, int(q * len(data)))]
+
+
+llm_latency = LatencyTracker()
+
+
+def _timed(fn, submitted: float):
+    """喺 worker 線程執行 fn，記低排隊時間；成功就記低延遲（唔計排隊時間）。"""
+    start = time.monotonic()
+    degraded_mode.record_delay(start - submitted)
+    result = fn()
+    llm_latency.record(time.monotonic() - start)
+    return result
+
+
+async def _atimed(coro):
+    """_timed 嘅 asyncio 版本。"""
+    start = time.monotonic()
+    result = await coro
+    llm_latency.record(time.monotonic() - start)
+    return result
+
+
+def llm_timeout_s(backend) -> float:
+    """
+    今輪 LLM 請求嘅超時：最近成功延遲嘅 LLM_TIMEOUT_PERCENTILE 百分位 × LLM_TIMEOUT_MULTIPLIER，
+    唔低過 LLM_TIMEOUT_FLOOR_S，唔高過後端自己嘅 timeout_s。
+    樣本唔夠、熔斷器半開（探測）或者停用自適應就用返後端超時。
+    """
+    ceiling = backend.timeout_s
+    if not LLM_ADAPTIVE_TIMEOUT or llm_breaker.state == CircuitBreaker.HALF_OPEN:
+        return ceiling
+    adaptive = llm_latency.percentile(LLM_TIMEOUT_PERCENTILE, ceiling) * LLM_TIMEOUT_MULTIPLIER
+    return min(ceiling, max(LLM_TIMEOUT_FLOOR_S, adaptive))
+
+
+class CircuitBreaker:
+    """
+    LLM 熔斷器。最近 window 輪（最少 min_calls 輪）錯誤 / 超時比例到 error_rate 就打開，
+    cooldown_s 秒內唔再問 LLM；之後半開，最多放 probes 個探測請求，
+    成功就關返，失敗就再打開。
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(
+        self,
+        window: int = LLM_BREAKER_WINDOW,
+        min_calls: int = LLM_BREAKER_MIN_CALLS,
+        error_rate: float = LLM_BREAKER_ERROR_RATE,
+        cooldown_s: float = LLM_BREAKER_COOLDOWN_S,
+        probes: int = LLM_BREAKER_PROBES,
+        clock=time.monotonic,
+    ):
+        self.min_calls = min_calls
+        self.error_rate = error_rate
+        self.cooldown_s = cooldown_s
+        self.probes = probes
+        self._clock = clock
+        self._results = deque(maxlen=window)
+        self._lock = threading.Lock()
+        self.state = self.CLOSED
+        self._opened_at = 0.0
+        self._probing = 0
+        self.trips = 0
+        self.rejected = 0
+
+    def _open(self) -> None:
+        self.state = self.OPEN
+        self._opened_at = self._clock()
+        self._probing = 0
+        self._results.clear()
+        self.trips += 1
+
+    def allow(self) -> bool:
+        """今輪可唔可以問 LLM；熔斷中就返回 False（由 caller 即刻用後備回覆）。"""
+        with self._lock:
+            if self.state == self.OPEN:
+                if self._clock() - self._opened_at < self.cooldown_s:
+                    self.rejected += 1
+                    return False
+                self.state = self.HALF_OPEN
+            if self.state == self.HALF_OPEN:
+                if self._probing >= self.probes:
+                    self.rejected += 1
+                    return False
+                self._probing += 1
+            return True
+
+    def record(self, ok) -> None:
+        """記錄一輪 LLM 結果：True 成功、False 錯誤 / 超時、None 中途取消（只釋放探測名額）。"""
+        with self._lock:
+            if self.state == self.HALF_OPEN:
+                self._probing = max(0, self._probing - 1)
+                if ok is True:
+                    self.state = self.CLOSED
+                elif ok is False:
+                    self._open()
+                return
+            if ok is None or self.state == self.OPEN:
+                return
+            self._results.append(ok)
+            n = len(self._results)
+            if n >= self.min_calls and self._results.count(False) / n >= self.error_rate:
+                self._open()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"state": self.state, "trips": self.trips, "rejected": self.rejected}
+
+
+llm_breaker = CircuitBreaker()
+
+
+def _call_with_deadline(fn, timeout_s: float):
+    """
+    喺共用 executor 執行 fn，最多等 timeout_s 秒。
+    超時即刻拋 FuturesTimeoutError，caller 唔使等個慢請求完成；
+    個請求會變成孤兒，完成後自動釋放名額。
+    孤兒數目到咗 LLM_MAX_ORPHANS 就直接拋 LLMSaturatedError。
+    """
+    _check_saturation()
+    fut = _llm_executor.submit(_timed, fn, time.monotonic())
+    try:
+        return fut.result(timeout=timeout_s)
+    except FuturesTimeoutError:
+        _abandon(fut)
+        raise
+
+
+_STREAM_END = object()
+
+
+def _stream_with_deadline(open_stream, timeout_s: float, first_chunk_s: float = None):
+    """
+    喺共用 executor 讀 LLM 串流，逐個 chunk yield 出嚟，整體最多 timeout_s 秒；
+    有 first_chunk_s 就第一個 chunk 要喺呢個時間內到（自適應超時）。
+    超時拋 FuturesTimeoutError；consumer 提早停（close / 超時）就通知背景線程唔好再讀。
+    """
+    _check_saturation()
+    chunks = queue.Queue()
+    stop = threading.Event()
+
+    def _produce():
+        stream = None
+        try:
+            stream = open_stream()
+            for chunk in stream:
+                if stop.is_set():
+                    break
+                chunks.put(chunk)
+            chunks.put(_STREAM_END)
+        except Exception as e:
+            chunks.put(e)
+        finally:
+            # consumer 已經唔要 → 主動關閉上游串流，唔好再生成
+            close = getattr(stream, "close", None)
+            if stop.is_set() and close is not None:
+                close()
+
+    fut = _llm_executor.submit(_produce)
+    deadline = time.monotonic() + timeout_s
+    # 第一個 chunk 到之前用較短嘅期限
+    wait_until = deadline if first_chunk_s is None else min(deadline, time.monotonic() + first_chunk_s)
+    try:
+        while True:
+            remaining = wait_until - time.monotonic()
+            if remaining <= 0:
+                raise FuturesTimeoutError()
+            try:
+                item = chunks.get(timeout=remaining)
+            except queue.Empty:
+                raise FuturesTimeoutError() from None
+            if item is _STREAM_END:
+                return
+            if isinstance(item, Exception):
+                raise item
+            wait_until = deadline
+            yield item
+    finally:
+        stop.set()
+        if not fut.done():
+            _abandon(fut)
+
+
+# ==================== 對沖請求（hedging） ====================
+
+_hedge_counters = {"hedges_sent": 0, "hedge_wins": 0, "hedges_skipped": 0}
+_hedge_lock = threading.Lock()
+_hedges_in_flight = 0
+
+
+def hedge_stats() -> dict:
+    """返回對沖請求計數：發咗幾多、後發先至幾多次、因為預算上限冇發幾多次。"""
+    with _hedge_lock:
+        return dict(_hedge_counters, in_flight=_hedges_in_flight)
+
+
+def hedge_delay_s(timeout_s: float) -> float:
+    """主請求等幾耐未返先對沖：最近延遲嘅 LLM_HEDGE_PERCENTILE 百分位，唔低過 LLM_HEDGE_MIN_DELAY_S。"""
+    return max(LLM_HEDGE_MIN_DELAY_S, llm_latency.percentile(LLM_HEDGE_PERCENTILE, timeout_s / 2))
+
+
+def _acquire_hedge() -> bool:
+    global _hedges_in_flight
+    with _hedge_lock:
+        if _hedges_in_flight >= LLM_HEDGE_MAX_INFLIGHT or (
+            llm_rate_limiter is not None and not llm_rate_limiter.try_acquire()
+        ):
+            _hedge_counters["hedges_skipped"] += 1
+            return False
+        _hedges_in_flight += 1
+        _hedge_counters["hedges_sent"] += 1
+        return True
+
+
+def _release_hedge(_fut) -> None:
+    global _hedges_in_flight
+    with _hedge_lock:
+        _hedges_in_flight -= 1
+
+
+def _call_hedged(fn, hedge_fn, timeout_s: float):
+    """
+    同 _call_with_deadline 一樣有截止時間，但主請求過咗 hedge_delay_s 仍未返，
+    就喺預算內（LLM_HEDGE_MAX_INFLIGHT，而且有空閒配額）用 hedge_fn 再發一個，用先成功返嗰個，
+    另一個即刻放手（排緊隊就取消，已開始就當孤兒）。兩個都失敗就拋最後嗰個錯誤。
+    """
+    _check_saturation()
+    deadline = time.monotonic() + timeout_s
+    primary = _llm_executor.submit(_timed, fn, time.monotonic())
+
+    delay = hedge_delay_s(timeout_s)
+    if delay >= timeout_s or wait([primary], timeout=delay).done or not _acquire_hedge():
+        # 唔使 / 唔可以對沖 → 照舊等主請求
+        try:
+            return primary.result(timeout=max(0.0, deadline - time.monotonic()))
+        except FuturesTimeoutError:
+            _abandon(primary)
+            raise
+
+    hedge = _llm_executor.submit(_timed, hedge_fn, time.monotonic())
+    hedge.add_done_callback(_release_hedge)
+    pending = {primary, hedge}
+    error = None
+    while pending:
+        done, pending = wait(pending, timeout=max(0.0, deadline - time.monotonic()), return_when=FIRST_COMPLETED)
+        if not done:
+            break
+        for fut in done:
+            if fut.exception() is not None:
+                error = fut.exception()
+                continue
+            for loser in pending:
+                _abandon(loser)
+            if fut is hedge:
+                with _hedge_lock:
+                    _hedge_counters["hedge_wins"] += 1
+            return fut.result()
+
+    if pending:
+        for fut in pending:
+            _abandon(fut)
+        raise FuturesTimeoutError()
+    raise error
+
+
+async def _acall_hedged(make_call, make_hedge, timeout_s: float):
+    """
+    _call_hedged 嘅 asyncio 版本：make_call / make_hedge 返回 coroutine。
+    輸咗嗰個 task 會真正 cancel（上游請求一齊取消）。
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout_s
+    primary = asyncio.ensure_future(_atimed(make_call()))
+    tasks = {primary}
+    hedge = None
+    try:
+        delay = hedge_delay_s(timeout_s)
+        if delay < timeout_s:
+            await asyncio.wait(tasks, timeout=delay)
+            if not primary.done() and _acquire_hedge():
+                hedge = asyncio.ensure_future(_atimed(make_hedge()))
+                hedge.add_done_callback(_release_hedge)
+                tasks.add(hedge)
+
+        error = None
+        while tasks:
+            done, tasks = await asyncio.wait(
+                tasks, timeout=max(0.0, deadline - loop.time()), return_when=asyncio.FIRST_COMPLETED
+            )
+            if not done:
+                raise asyncio.TimeoutError()
+            for task in done:
+                if task.exception() is not None:
+                    error = task.exception()
+                    continue
+                if task is hedge:
+                    with _hedge_lock:
+                        _hedge_counters["hedge_wins"] += 1
+                return task.result()
+        raise error
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+# ==================== 相同請求合併（single-flight） ====================
+
+class SingleFlight:
+    """
+    同一時間相同 prompt 嘅 LLM 請求只發一次，其他 caller 等同一個結果（包括錯誤 / 超時）。
+    用 prompt 字串本身做 dict key（即係按 hash 查，再比較內容），唔會因為 hash 撞咗而錯配回覆。
+    請求一完成就移除，唔係快取。
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self._tasks = {}
+        self._lock = threading.Lock()
+        self.leaders = 0
+        self.coalesced = 0
+
+    def do(self, key: str, fn):
+        """同步版：第一個 caller 執行 fn，同時間嘅相同 key 等佢個結果。"""
+        with self._lock:
+            fut = self._calls.get(key)
+            leader = fut is None
+            if leader:
+                fut = self._calls[key] = Future()
+                self.leaders += 1
+            else:
+                self.coalesced += 1
+        if not leader:
+            return fut.result()
+
+        try:
+            result = fn()
+        except BaseException as e:
+            fut.set_exception(e)
+            raise
+        else:
+            fut.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                del self._calls[key]
+
+    async def ado(self, key: str, make_coro):
+        """
+        asyncio 版：共用一個 task；個別 caller 被 cancel 唔影響其他人，
+        最後一個 caller 都走咗先取消上游請求。
+        """
+        key = (id(asyncio.get_running_loop()), key)
+        with self._lock:
+            entry = self._tasks.get(key)
+            if entry is None or entry[0].done():
+                entry = self._tasks[key] = [asyncio.ensure_future(make_coro()), 0]
+                entry[0].add_done_callback(lambda _t, k=key, e=entry: self._forget(k, e))
+                self.leaders += 1
+            else:
+                self.coalesced += 1
+            entry[1] += 1
+        task = entry[0]
+        try:
+            return await asyncio.shield(task)
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0 and not task.done():
+                task.cancel()
+
+    def _forget(self, key, entry) -> None:
+        with self._lock:
+            if self._tasks.get(key) is entry:
+                del self._tasks[key]
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"leaders": self.leaders, "coalesced": self.coalesced, "in_flight": len(self._calls) + len(self._tasks)}
+
+
+llm_single_flight = SingleFlight()
+
+
+# ==================== LLM 配額（令牌桶 + 優先隊列） ====================
+
+# 排隊優先次序：數字細嘅先
+PRIORITY_LIVE = 0  # 即場來電
+PRIORITY_BACKGROUND = 1  # 背景工作（例如批量跟進）
+
+
+class TokenBucketLimiter:
+    """
+    LLM 請求嘅令牌桶：每秒補 rate_per_s 個，最多儲 burst 個。
+    等令牌嘅請求按 (priority, rank, 排隊次序) 排隊：即場來電先過背景工作；
+    同級再按 rank（conversation_queue_rank：預約做到一半、傾咗耐嘅對話先），最後先到先得。
+    估計喺 max_wait_s 內輪唔到就即刻拋 LLMRateLimitedError，唔會白等。
+    設定咗 state_file 就用 fcntl 檔案鎖，多個 process 共用同一個桶（POSIX 先用得）。
+    """
+
+    def __init__(self, rate_per_s: float, burst: float, state_file: str = ""):
+        self.rate_per_s = rate_per_s
+        self.burst = max(1.0, burst)
+        self.state_file = state_file
+        if state_file:
+            import fcntl
+
+            self._fcntl = fcntl
+        # 跨 process 要用牆鐘時間，單 process 用 monotonic
+        self._clock = time.time if state_file else time.monotonic
+        self._tokens = self.burst
+        self._stamp = self._clock()
+        self._cond = threading.Condition()
+        self._waiters = []
+        self._seq = itertools.count()
+        self.granted = 0
+        self.rejected = 0
+        self._waited_s = 0.0
+
+    def _refill(self, tokens: float, stamp: float) -> tuple:
+        now = self._clock()
+        return min(self.burst, tokens + (now - stamp) * self.rate_per_s), now
+
+    def _take_local(self, take: bool) -> tuple:
+        self._tokens, self._stamp = self._refill(self._tokens, self._stamp)
+        taken = take and self._tokens >= 1
+        if taken:
+            self._tokens -= 1
+        return taken, self._tokens
+
+    def _take_shared(self, take: bool) -> tuple:
+        with open(self.state_file, "a+", encoding="utf-8") as f:
+            self._fcntl.flock(f, self._fcntl.LOCK_EX)
+            try:
+                f.seek(0)
+                try:
+                    saved = json.loads(f.read())
+                    tokens, stamp = float(saved["tokens"]), float(saved["stamp"])
+                except (ValueError, KeyError, TypeError):
+                    tokens, stamp = self.burst, self._clock()
+                tokens, stamp = self._refill(tokens, stamp)
+                taken = take and tokens >= 1
+                if taken:
+                    tokens -= 1
+                f.seek(0)
+                f.truncate()
+                f.write(json.dumps({"tokens": tokens, "stamp": stamp}))
+                return taken, tokens
+            finally:
+                self._fcntl.flock(f, self._fcntl.LOCK_UN)
+
+    def _poll(self, entry: tuple) -> tuple:
+        """排頭就試攞令牌；返回 (攞到未, 估計仲要等幾多秒)。要持有 self._cond。"""
+        ahead = sum(1 for w in self._waiters if w < entry)
+        take = self._take_shared if self.state_file else self._take_local
+        taken, tokens = take(ahead == 0)
+        if taken:
+            return True, 0.0
+        return False, max(0.001, (ahead + 1 - tokens) / self.rate_per_s)
+
+    def _granted(self, start: float) -> float:
+        waited = time.monotonic() - start
+        self.granted += 1
+        self._waited_s += waited
+        return waited
+
+    def _reject(self, priority: int, wait_s: float):
+        self.rejected += 1
+        return LLMRateLimitedError(f"LLM 配額要等 {wait_s:.2f}s（優先級 {priority}）")
+
+    def acquire(self, priority: int, max_wait_s: float, rank: tuple = ()) -> float:
+        """排隊攞一個令牌，返回排咗幾耐（秒）。"""
+        start = time.monotonic()
+        deadline = start + max_wait_s
+        entry = (priority, rank, next(self._seq))
+        with self._cond:
+            self._waiters.append(entry)
+            try:
+                while True:
+                    taken, wait_s = self._poll(entry)
+                    if taken:
+                        return self._granted(start)
+                    if wait_s > deadline - time.monotonic():
+                        raise self._reject(priority, wait_s)
+                    self._cond.wait(timeout=wait_s)
+            finally:
+                self._waiters.remove(entry)
+                self._cond.notify_all()
+
+    async def aacquire(self, priority: int, max_wait_s: float, rank: tuple = ()) -> float:
+        """acquire 嘅 asyncio 版本（用 sleep 等，唔阻塞 event loop）。"""
+        start = time.monotonic()
+        deadline = start + max_wait_s
+        entry = (priority, rank, next(self._seq))
+        with self._cond:
+            self._waiters.append(entry)
+        try:
+            while True:
+                with self._cond:
+                    taken, wait_s = self._poll(entry)
+                    if taken:
+                        return self._granted(start)
+                    if wait_s > deadline - time.monotonic():
+                        raise self._reject(priority, wait_s)
+                await asyncio.sleep(wait_s)
+        finally:
+            with self._cond:
+                self._waiters.remove(entry)
+                self._cond.notify_all()
+
+    def try_acquire(self) -> bool:
+        """唔排隊：冇人等緊而且有令牌先攞（對沖請求用，唔會搶正常請求嘅位）。"""
+        with self._cond:
+            if self._waiters:
+                return False
+            taken, _ = (self._take_shared if self.state_file else self._take_local)(True)
+            if taken:
+                self.granted += 1
+            return taken
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {
+                "queued": len(self._waiters),
+                "granted": self.granted,
+                "rejected": self.rejected,
+                "avg_wait_ms": round(1000 * self._waited_s / self.granted, 2) if self.granted else 0.0,
+            }
+
+
+llm_rate_limiter = (
+    TokenBucketLimiter(LLM_RATE_PER_MIN / 60.0, LLM_RATE_BURST, LLM_RATE_STATE_FILE) if LLM_RATE_PER_MIN > 0 else None
 )
 
+
+def _queue_budget_s(timeout_s: float) -> float:
+    # 最多用一半超時排隊，留返另一半俾 LLM 本身
+    return min(LLM_QUEUE_MAX_WAIT_S, timeout_s / 2)
+
+
+def _acquire_llm_quota(timeout_s: float, priority: int, rank: tuple = ()) -> float:
+    """有開配額就排隊攞令牌，返回扣除排隊時間之後剩低嘅 LLM 超時。"""
+    if llm_rate_limiter is None:
+        return timeout_s
+    budget = _queue_budget_s(timeout_s)
+    try:
+        waited = llm_rate_limiter.acquire(priority, budget, rank)
+    except LLMRateLimitedError:
+        degraded_mode.record_delay(budget)
+        raise
+    degraded_mode.record_delay(waited)
+    return timeout_s - waited
+
+
+async def _aacquire_llm_quota(timeout_s: float, priority: int, rank: tuple = ()) -> float:
+    """_acquire_llm_quota 嘅 asyncio 版本。"""
+    if llm_rate_limiter is None:
+        return timeout_s
+    budget = _queue_budget_s(timeout_s)
+    try:
+        waited = await llm_rate_limiter.aacquire(priority, budget, rank)
+    except LLMRateLimitedError:
+        degraded_mode.record_delay(budget)
+        raise
+    degraded_mode.record_delay(waited)
+    return timeout_s - waited
+
+
+# ==================== 降級模式（淨係規則） ====================
+
+class DegradedMode:
+    """
+    負載過高時嘅「淨係規則」模式：唔再問 LLM，用最接近嘅規則模板或者澄清問題回覆。
+    自動模式睇 LLM 排隊延遲（配額排隊 + 線程池排隊）嘅指數移動平均：
+    超過 enter_s 就進入，跌返落 exit_s 以下先離開（滯後，唔會喺門檻附近來回切換）。
+    降級期間冇新樣本，所以平均值會按 half_life_s 隨時間衰減，隊列清咗就會自動恢復。
+    force：'on' 強制降級、'off' 永不降級、'auto' 自動。
+    """
+
+    def __init__(
+        self,
+        enter_s: float = LLM_DEGRADE_ENTER_S,
+        exit_s: float = LLM_DEGRADE_EXIT_S,
+        half_life_s: float = LLM_DEGRADE_HALF_LIFE_S,
+        force: str = LLM_DEGRADED_MODE,
+        alpha: float = 0.3,
+        clock=time.monotonic,
+    ):
+        self.enter_s = enter_s
+        self.exit_s = exit_s
+        self.half_life_s = half_life_s
+        self.alpha = alpha
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._delay = 0.0
+        self._stamp = clock()
+        self._auto_active = False
+        self.entered = 0
+        self.set_force(force)
+
+    def set_force(self, force: str) -> None:
+        force = (force or "auto").lower()
+        if force not in ("auto", "on", "off"):
+            raise ValueError(f"唔識嘅降級模式：{force}（可選：auto / on / off）")
+        self.force = force
+
+    def _decayed(self, now: float) -> float:
+        if self.half_life_s <= 0:
+            return self._delay
+        return self._delay * 0.5 ** ((now - self._stamp) / self.half_life_s)
+
+    def _update(self, now: float) -> None:
+        # 要持有 self._lock
+        delay = self._decayed(now)
+        if not self._auto_active and delay > self.enter_s:
+            self._auto_active = True
+            self.entered += 1
+            print(f"⚠️ LLM 排隊延遲 {delay:.2f}s，進入降級模式（淨係規則）")
+        elif self._auto_active and delay < self.exit_s:
+            self._auto_active = False
+            print("✅ LLM 排隊已清，離開降級模式")
+
+    def record_delay(self, seconds: float) -> None:
+        """記錄一次 LLM 排隊延遲（秒）。"""
+        with self._lock:
+            now = self._clock()
+            self._delay = self._decayed(now) * (1 - self.alpha) + seconds * self.alpha
+            self._stamp = now
+            self._update(now)
+
+    @property
+    def active(self) -> bool:
+        if self.force != "auto":
+            return self.force == "on"
+        with self._lock:
+            self._update(self._clock())
+            return self._auto_active
+
+    def stats(self) -> dict:
+        active = self.active
+        with self._lock:
+            return {
+                "active": active,
+                "force": self.force,
+                "queue_delay_s": round(self._decayed(self._clock()), 4),
+                "entered": self.entered,
+            }
+
+
+degraded_mode = DegradedMode()
+
+
+def set_degraded_mode(force: str) -> None:
+    """運行中切換降級模式：'on' / 'off' / 'auto'。"""
+    degraded_mode.set_force(force)
+
+
+# ==================== 關鍵字自動機 ====================
+
+# 所有路由 / 狀態提取用到嘅關鍵字（一律小寫）。
+# 同一個關鍵字可以屬於多個訊號類別；加新療程或新租戶只需要加表，唔使改邏輯。
+KEYWORD_TABLES = {
+    # 療程偵測
+    "treatment_deep": ("深層清潔", "deep"),
+    "treatment_basic": ("basic",),
+    "treatment_pico": ("皮秒", "激光"),
+    "treatment_massage": ("按摩", "body"),
+    "facial_en": ("facial",),
+    # 時間由 cantonese_time 解析（標準化後嘅文字），唔再用關鍵字
+    # 預約流程（「約」已經涵蓋「預約」；英文已經係細楷）
+    "booking": ("約", "book"),
+    # 改期 / 取消已經登記嘅預約
+    "change": ("改期", "改時間", "改約", "轉期", "reschedule"),
+    "cancel": ("取消", "cancel", "唔約喇", "唔嚟喇"),
+    # 確認咗之後再約多個（唔係改舊嗰個）
+    "new_booking": ("約多個", "約多一個", "約多次", "多約一個", "另外約", "加約", "book多個"),
+    # 更正 / 否定：有呢啲先可以覆蓋已經登記嘅療程 / 時間（「係唔係」係問句，唔當否定）
+    "correction": ("改做", "改去", "改成", "改返", "改為", "換做", "換成", "換去", "轉做", "轉去"),
+    "negation": ("唔係", "唔要", "唔啱", "搞錯", "唔做"),
+    "yes_no_question": ("係唔係",),
+    # 問句：聯絡資料以外仲有問題要答，唔好淨係確認名 / 電話
+    "question": ("?", "嗎", "咩", "有冇", "可唔可以", "點樣", "點解", "幾耐", "邊個", "得唔得"),
+    # 價格查詢
+    "price": ("幾錢", "幾多錢", "價錢", "費用", "cost"),
+    # 療程確認
+    "facial": ("facial", "清潔", "皮膚", "面部", "做面"),
+    # 其他常見問題
+    "hours": ("營業時間", "幾時開", "幾時收"),
+    "location": ("位置", "地址", "邊度"),
+}
+
+
+# 子句分隔（關鍵字本身冇標點，喺度重設唔會漏中）
+_CLAUSE_BREAKS = frozenset(",.!?;~，。！？、；～")
+
+
+class KeywordAutomaton:
+    """
+    Aho–Corasick 多模式匹配器：啟動時由關鍵字表建一次，
+    之後每句說話只掃一次，就返回所有命中嘅訊號類別。
+    """
+
+    def __init__(self, tables: dict):
+        self._classes = list(tables)
+        self._goto = [{}]
+        self._out = [0]
+
+        # 1. 建 trie，每個結尾節點記住所屬類別（bitmask）
+        for bit, cls in enumerate(self._classes):
+            for kw in tables[cls]:
+                node = 0
+                for ch in kw.lower():
+                    nxt = self._goto[node].get(ch)
+                    if nxt is None:
+                        nxt = len(self._goto)
+                        self._goto[node][ch] = nxt
+                        self._goto.append({})
+                        self._out.append(0)
+                    node = nxt
+                self._out[node] |= 1 << bit
+
+        # 2. BFS 建 fail link，並將 fail 鏈上嘅輸出合併落每個節點
+        self._fail = [0] * len(self._goto)
+        queue = deque(self._goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for ch, nxt in self._goto[node].items():
+                f = self._fail[node]
+                while f and ch not in self._goto[f]:
+                    f = self._fail[f]
+                self._fail[nxt] = self._goto[f].get(ch, 0)
+                self._out[nxt] |= self._out[self._fail[nxt]]
+                queue.append(nxt)
+
+    def scan(self, text: str) -> frozenset:
+        """掃描一次 text（normalize_utterance 之後嘅標準文字），返回命中嘅訊號類別集合。"""
+        goto, fail, out = self._goto, self._fail, self._out
+        node = 0
+        mask = 0
+        for ch in text or "":
+            while node and ch not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(ch, 0)
+            mask |= out[node]
+
+        return self.classes_of(mask)
+
+    def scan_clauses(self, text: str) -> tuple:
+        """
+        同 scan 一樣只掃一次，但喺子句標點重新開始，
+        返回 (全句訊號, ((子句文字, 子句 bitmask), ...))，俾更正邏輯分辨邊個子句係否定。
+        子句 bitmask 要用先至經 classes_of 轉（大部分輪次用唔著）。
+        """
+        goto, fail, out = self._goto, self._fail, self._out
+        text = text or ""
+        node = 0
+        mask = total = 0
+        start = 0
+        clauses = []
+        for i, ch in enumerate(text):
+            if ch in _CLAUSE_BREAKS:
+                if i > start:
+                    clauses.append((text[start:i], mask))
+                total |= mask
+                node = mask = 0
+                start = i + 1
+                continue
+            while node and ch not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(ch, 0)
+            mask |= out[node]
+        if start < len(text):
+            clauses.append((text[start:], mask))
+        total |= mask
+        return self.classes_of(total), tuple(clauses)
+
+    def classes_of(self, mask: int) -> frozenset:
+        if not mask:
+            return frozenset()
+        return frozenset(cls for bit, cls in enumerate(self._classes) if mask >> bit & 1)
+
+
+KEYWORD_AUTOMATON = KeywordAutomaton(KEYWORD_TABLES)
+
+
+def scan_signals(user_text: str) -> frozenset:
+    """
+    將客人說話掃描一次，返回命中嘅訊號類別（供路由 / 狀態提取共用）。
+    user_text 要係 normalize_utterance 之後嘅標準文字。
+    """
+    return KEYWORD_AUTOMATON.scan(user_text)
+
+
+def scan_signal_clauses(user_text: str) -> tuple:
+    """同 scan_signals 一樣只掃一次，另外返回每個子句嘅 bitmask（更正 / 否定用）。"""
+    return KEYWORD_AUTOMATON.scan_clauses(user_text)
+
+
 # ==================== 狀態管理函數 ====================
 
-def update_conversation_state(current_state:  dict, user_text: str) -> dict:
+# 取消預約時清走嘅欄位
+BOOKING_SLOTS_CLEARED = {"treatment": None, "booking_time": None, "booking_start": None, "booking_end": None}
+
+def _detect_treatment(signals: frozenset) -> str:
+    """由訊號揀療程；冇提到就返回 None。"""
+    if "treatment_deep" in signals:
+        return "深層清潔 facial"
+    if "treatment_basic" in signals and "facial_en" in signals:
+        return "basic facial"
+    if "treatment_pico" in signals:
+        return "皮秒激光療程"
+    if "treatment_massage" in signals:
+        return "身體按摩"
+    return None
+
+
+def _wants_overwrite(signals: frozenset) -> bool:
+    """改期、「改做 / 換做」或者真正嘅否定（唔係問句「係唔係」）先可以覆蓋已登記嘅資料。"""
+    return bool(signals & {"change", "correction"}) or (
+        "negation" in signals and "yes_no_question" not in signals
+    )
+
+
+def _set_booking_time(state: dict, parsed) -> None:
+    state["booking_time"] = format_booking_time(parsed)
+    state["booking_start"] = parsed.start.isoformat(timespec="minutes")
+    state["booking_end"] = parsed.end.isoformat(timespec="minutes")
+
+
+# 否定子句喺否定詞度切開：前面係話題，後面到替換詞之前係被否定嘅值，替換詞之後係新值
+# （「唔係三點係四點」「我唔要basic facial要按摩」「唔係呀我想改做按摩」，ASR 冇加標點都得）
+_NEGATION_RE = re.compile("|".join(map(re.escape, KEYWORD_TABLES["negation"])))
+_REPLACEMENT_RE = re.compile("|".join(map(re.escape, KEYWORD_TABLES["correction"] + ("係", "要"))))
+
+
+def _split_negated(clause: str) -> tuple:
+    """將一個否定子句拆做 (話題, 被否定嘅部分, 新值)。"""
+    m = _NEGATION_RE.search(clause)
+    head, rest = clause[:m.start()], clause[m.end():]
+    r = _REPLACEMENT_RE.search(rest)
+    negated, replacement = (rest[:r.start()], rest[r.end():]) if r else (rest, "")
+    return head, negated, replacement
+
+
+def _same_time(negated, state: dict) -> bool:
+    """被否定嘅時間係咪講緊已登記嗰個（「唔係三點」而登記咗三點；「唔係聽日」而登記咗聽日）。"""
+    if not state.get("booking_start"):
+        return False
+    booked = datetime.fromisoformat(state["booking_start"])
+    if negated.has_date and negated.start.date() != booked.date():
+        return False
+    if negated.has_clock:
+        return (negated.start.hour, negated.start.minute) == (booked.hour, booked.minute)
+    return negated.start.time() <= booked.time() <= negated.end.time()
+
+
+def _apply_correction(state: dict, clauses: tuple, rescheduling: bool, now: datetime) -> None:
+    """
+    客人更正療程 / 時間（「唔係呀，我想改做按摩」「唔係三點係四點」）：
+    否定子句先喺否定詞度切開，然後由最後一段向前搵，冇被否定嘅片段有新值就覆蓋；
+    被否定嘅值要同已登記嗰個一樣先清走（「我朋友唔係做按摩」唔會郁到登記咗嘅 basic facial），等狀態機問返；
+    欄位仲係空嘅就當普通資料收低（冇標點嘅「唔係好急聽日三點得唔得」）。
+    """
+    segments = []
+    for clause, mask in clauses:
+        clause_signals = KEYWORD_AUTOMATON.classes_of(mask)
+        if "negation" in clause_signals and "yes_no_question" not in clause_signals:
+            head, negated, replacement = _split_negated(clause)
+            if head and not negated.strip(" 呀啊喎囉喇"):
+                # 話題行先：「按摩唔要喇」「三點唔係」
+                head, negated = "", head
+            segments += [(head, False), (negated, True), (replacement, False)]
+        else:
+            segments.append((clause, False))
+
+    treatment = parsed = None
+    treatment_negated = time_negated = False
+    for segment, negated in reversed(segments):
+        if not segment:
+            continue
+        segment_treatment = _detect_treatment(KEYWORD_AUTOMATON.scan(segment))
+        segment_time = parse_booking_time(segment, now)
+        if negated:
+            # 同已登記嗰個一樣先算否定；欄位仲係空就照收（「唔係好急聽日三點得唔得」），其他值唔理
+            if segment_treatment is not None:
+                if segment_treatment == state.get("treatment"):
+                    treatment_negated = True
+                elif not state.get("treatment"):
+                    treatment = treatment or segment_treatment
+            if segment_time is not None:
+                if _same_time(segment_time, state):
+                    time_negated = True
+                elif not state.get("booking_start") and parsed is None:
+                    parsed = segment_time
+            continue
+        treatment = treatment or segment_treatment
+        if parsed is None and segment_time is not None:
+            parsed = segment_time
+            if not parsed.has_date and state.get("booking_start"):
+                # 淨係改鐘點 → 保留原本個日子
+                day = datetime.fromisoformat(state["booking_start"]).replace(hour=0, minute=0)
+                parsed = parse_booking_time(segment, day)
+
+    if treatment:
+        state["treatment"] = treatment
+    elif treatment_negated:
+        state["treatment"] = None
+
+    if parsed is not None:
+        _set_booking_time(state, parsed)
+    elif time_negated or (rescheduling and not treatment):
+        # 「我想改期」/「唔係聽日」但未講新時間 → 清走舊時間
+        state.update(booking_time=None, booking_start=None, booking_end=None)
+
+
+def update_conversation_state(
+    current_state:  dict, user_text: str, signals: frozenset = None, now: datetime = None, clauses: tuple = None
+) -> dict:
     """
     從客人說話中提取關鍵資訊並更新狀態。
     返回更新後的 state dict。
+    signals 係 scan_signals() 嘅結果；唔傳就即場掃描。
+    clauses 係 scan_signal_clauses() 嘅子句訊號；要更正時先用，唔傳就即場掃描。
+    療程 / 時間一經登記就唔會被覆蓋，除非有改期 / 更正 / 否定；「取消」會清走兩者。
+    確認咗之後「約多個」會將舊預約存入 bookings，再由頭收集新預約。
+    now 係解析相對時間（聽日、下個禮拜二）嘅參考時鐘，預設而家。
+    有傳 signals 即係 user_text 已經標準化；冇就喺度做一次 normalize_utterance。
     """
     new_state = current_state.copy()
     u = user_text or ""
-
-    # 🔹 療程偵測
-    if not new_state.get("treatment"):
-        if "深層清潔" in u or "deep" in u.lower():
-            new_state["treatment"] = "深層清潔 facial"
-        elif "basic facial" in u. lower() or ("basic" in u.lower() and "facial" in u.lower()):
-            new_state["treatment"] = "basic facial"
-        elif "皮秒" in u or "激光" in u: 
-            new_state["treatment"] = "皮秒激光療程"
-        elif "按摩" in u or "body" in u.lower():
-            new_state["treatment"] = "身體按摩"
-
-    # 🔹 時間偵測
-    if not new_state.get("booking_time"):
-        time_keywords = ["星期", "禮拜", "聽日", "後日", "今日", "今晚", "下晝", "夜晚", "點", "am", "pm"]
-        if any(k in u for k in time_keywords):
-            new_state["booking_time"] = u.strip()[:50]
+    if signals is None:
+        u = normalize_utterance(u)
+        signals = scan_signals(u)
+
+    # 🔹 取消：清走療程同時間（名字 / 電話留返，下次約唔使再問）
+    if "cancel" in signals:
+        new_state.update(BOOKING_SLOTS_CLEARED)
+        return new_state
+
+    # 🔹 約多個：確認咗嘅預約存檔（唔好改原本個 list），清走療程同時間、階段返去問候再由頭收集；名字 / 電話留返
+    new_booking = "new_booking" in signals and current_stage(new_state) in BOOKED_STAGES
+    if new_booking:
+        new_state["bookings"] = [*new_state.get("bookings", ()), {k: new_state.get(k) for k in BOOKING_SLOTS_CLEARED}]
+        new_state.update(BOOKING_SLOTS_CLEARED, booking_stage=BookingStage.GREETING.value)
+
+    if _wants_overwrite(signals) and not new_booking:
+        # 🔹 改期 / 更正：按子句決定覆蓋定清走
+        if clauses is None:
+            signals, clauses = scan_signal_clauses(u)
+        _apply_correction(new_state, clauses, "change" in signals, now)
+    else:
+        # 🔹 療程偵測：已經揀咗就唔再郁
+        treatment = _detect_treatment(signals)
+        if treatment and not new_state.get("treatment"):
+            new_state["treatment"] = treatment
+
+        # 🔹 時間偵測：解析成準確時間 / 範圍，booking_time 存標準讀法
+        parsed = None
+        # 啱啱取消咗又淨係講時間（「係聽日嗰個」）→ 講緊取消咗嗰個，唔當新預約
+        after_cancel = current_stage(new_state) is BookingStage.CANCELLED and not treatment and "booking" not in signals
+        if not new_state.get("booking_time") and not after_cancel:
+            parsed = parse_booking_time(u, now)
+        elif new_state.get("booking_start") and new_state.get("booking_start") != new_state.get("booking_end"):
+            # 之前只講咗日子 / 時段（範圍）→ 今次淨係講鐘點就補返落同一日
+            day = datetime.fromisoformat(new_state["booking_start"]).replace(hour=0, minute=0)
+            parsed = parse_booking_time(u, day)
+            if parsed is not None and (parsed.has_date or not parsed.has_clock):
+                parsed = None
+        if parsed is not None:
+            _set_booking_time(new_state, parsed)
+
+    # 🔹 名字 / 電話：客人再講一次就當更正，用最新嗰個；啱啱問咗名先認淨係稱呼（「陳小姐」）
+    contact = extract_contact(u, asked_for_name=current_stage(current_state) is BookingStage.CONTACT)
+    if contact.customer_name:
+        new_state["customer_name"] = contact.customer_name
+    if contact.phone:
+        new_state["phone"] = contact.phone
 
     return new_state
 
@@ -121,6 +1316,24 @@ def build_memory_context(state: dict) -> str:
             "唔好再問幾時方便，只可以重複確認。"
         )
 
+    if state.get("bookings"):
+        earlier = "、".join(f"{b['booking_time']} 做 {b['treatment']}" for b in state["bookings"])
+        items.append(f"客人今次之前已經約咗：{earlier}。而家係另外約多個。")
+
+    stage = state.get("booking_stage")
+    if stage in BOOKED_STAGES:
+        items.append("預約已經確認。唔好再問資料，只可以重複確認。")
+    elif stage == BookingStage.CANCELLED:
+        items.append("客人啱啱取消咗預約。")
+
+    # 只講有冇，唔放實際名字 / 電話（LLM 回覆會入共用快取）
+    if state.get("customer_name") and state.get("phone"):
+        items.append("客人已經留低名字同電話。唔好再問，唔好重複朗讀。")
+    elif state.get("customer_name"):
+        items.append("客人已經留低名字，仲未有電話。")
+    elif state.get("phone"):
+        items.append("客人已經留低電話，仲未有名字。")
+
     if not items:
         return ""
 
@@ -133,73 +1346,480 @@ def build_memory_context(state: dict) -> str:
 
 # ==================== 【最高優先】快速路由規則 ====================
 
-def _should_use_quick_path(user_text: str, state: dict) -> bool:
+class Intent(str, Enum):
+    """快速路由可以識別嘅意圖。UNKNOWN 表示無規則可答，要交由 LLM。"""
+    BOOKING = "booking"
+    PRICE = "price"
+    TREATMENT_CONFIRM = "treatment_confirm"
+    HOURS = "hours"
+    LOCATION = "location"
+    CONTACT = "contact"
+    CHANGE = "change"
+    CANCEL = "cancel"
+    UNKNOWN = "unknown"
+
+
+class BookingStage(str, Enum):
+    """預約流程階段：問候 → 問療程 → 問時間 → 問名字 / 電話 → 已確認 →（改咗 / 取消咗）。"""
+    GREETING = "greeting"
+    TREATMENT = "treatment"  # 問緊療程
+    TIME = "time"  # 問緊時間
+    CONTACT = "contact"  # 問緊名字 / 電話
+    CONFIRMED = "confirmed"
+    CHANGED = "changed"  # 確認咗之後再改
+    CANCELLED = "cancelled"
+
+
+# 已經有確認咗嘅預約（可以「約多個」）
+BOOKED_STAGES = (BookingStage.CONFIRMED, BookingStage.CHANGED)
+
+
+class TurnClassification(NamedTuple):
+    intent: Intent
+    reply: str  # 空字串 = 無規則可答，交由 LLM
+    stage: BookingStage = BookingStage.GREETING  # 今輪之後嘅預約階段
+
+
+# 模板入面要逐次填嘅動態欄位
+QUICK_REPLY_SLOT = "{booking_time}"
+NAME_SLOT = "{customer_name}"
+
+
+def _quick_reply_template(intent: Intent, treatment: str) -> str:
     """
-    判斷係必要用快速規則回覆（毋須 LLM），加快速度。
-    大約 70% 嘅對話會命中呢度，避免 Gemini 延遲。
+    渲染常見問題（價錢 / 營業時間 / 地址）對應嘅回覆模板，只喺啟動時建表用。
+    預約流程嘅回覆由狀態機每個階段嘅 prompt 負責。
+    返回空字串表示呢個組合無規則可答。
     """
-    u = user_text. lower()
+    p = PRICE_CATALOGUE
 
-    # 預約流程：直接規則處理（最快）
-    booking_signals = ["預約", "約", "book", "改期", "幾點", "幾時", "邊日", "時間"]
-    if any(sig in u for sig in booking_signals):
-        return True
+    # ===== 價格查詢規則 =====
+    if intent is Intent.PRICE:
+        if treatment == "basic facial":
+            return f"good，basic facial 係 ${p['basic facial']} 起。有咩皮膚問題想重點改善嗎？"
+        if treatment == "深層清潔 facial":
+            return f"deep facial 係 ${p['深層清潔 facial']} 起。幫你深層清潔同補水。"
+        if treatment in p:
+            return f"你揀嘅 {treatment} 係 ${p[treatment]} 起，根據療程時間唔同會有啲分別。"
+        if treatment:
+            return f"你揀嘅 {treatment} 根據療程時間唔同，約 ${min(p.values())}-${max(p.values())} 左右。"
+        return (
+            f"basic facial ${p['basic facial']} 起，深層清潔 ${p['深層清潔 facial']}，"
+            f"皮秒激光 ${p['皮秒激光療程']} 起。你想了解邊款呢？"
+        )
 
-    # 價格查詢：預設回覆
-    price_signals = ["幾錢", "幾多錢", "價錢", "費用", "cost"]
-    if any(sig in u for sig in price_signals):
-        return True
+    # ===== 其他常見問題 =====
+    if intent is Intent.HOURS:
+        return "我哋營業時間係早上十一點到夜晚九點，星期一休息。"
+
+    if intent is Intent.LOCATION:
+        return "我哋喺中環，具體地址你可以聯絡我時再畀你。你想先預約嗎？"
+
+    return ""
+
+
+def _build_quick_reply_table() -> dict:
+    table = {}
+    for intent in Intent:
+        for treatment in (None,) + TREATMENTS:
+            template = _quick_reply_template(intent, treatment)
+            if template:
+                table[(intent, treatment)] = template
+    return table
+
+
+# 啟動時一次過枚舉所有常見問題回覆：(意圖, 療程) → 模板。
+# 公開俾其他層用（TTS 預先合成、分析、測試）。
+QUICK_REPLY_TABLE = _build_quick_reply_table()
+
+
+# ==================== 預約流程狀態機 ====================
+
+# 推進預約流程嘅意圖；其他意圖（價錢、營業時間…）唔郁階段
+BOOKING_INTENTS = frozenset({Intent.BOOKING, Intent.TREATMENT_CONFIRM, Intent.CONTACT, Intent.CHANGE, Intent.CANCEL})
 
-    # 療程介紹 + 已有療程選擇：用規則確認
-    facial_signals = ["facial", "面部", "清潔", "皮膚", "做面"]
-    if any(sig in u for sig in facial_signals) and state.get("treatment"):
-        return True
 
-    return False
+def _booking_slots(state: dict) -> tuple:
+    """(有冇療程, 有冇時間, 名字同電話齊唔齊)"""
+    return (
+        bool(state.get("treatment")),
+        bool(state.get("booking_time")),
+        bool(state.get("customer_name") and state.get("phone")),
+    )
+
+
+def _next_stage(stage: BookingStage, intent: Intent, slots: tuple) -> BookingStage:
+    """狀態轉移規則，只喺啟動時建表用。"""
+    if intent is Intent.CANCEL:
+        return BookingStage.CANCELLED
+    if intent not in BOOKING_INTENTS:
+        return stage
+    has_treatment, has_time, has_contact = slots
+    # 確認咗之後再改：留喺「改咗」直到療程同時間再齊（補返資料嗰輪都當改期，見 _match_intent），
+    # 之後再講預約嘢就返去已確認
+    if stage in (BookingStage.CONFIRMED, BookingStage.CHANGED) and (
+        intent is Intent.CHANGE or (stage is BookingStage.CHANGED and not (has_treatment and has_time))
+    ):
+        return BookingStage.CHANGED
+    if not has_treatment:
+        return BookingStage.TREATMENT
+    if not has_time:
+        return BookingStage.TIME
+    if not has_contact:
+        return BookingStage.CONTACT
+    return BookingStage.CONFIRMED
+
+
+def _build_booking_transitions() -> dict:
+    slot_combos = list(itertools.product((False, True), repeat=3))
+    return {
+        (stage, intent, slots): _next_stage(stage, intent, slots)
+        for stage in BookingStage
+        for intent in Intent
+        for slots in slot_combos
+    }
 
 
-def quick_rule_reply(user_text: str, state: dict) -> str:
+# (階段, 意圖, 資料齊唔齊) → 下一個階段；啟動時枚舉晒，每輪 O(1) 查表
+BOOKING_TRANSITIONS = _build_booking_transitions()
+
+
+# 呢兩個階段嘅模板會先多謝客人留低嘅名 / 電話；只係嗰輪講咗先道謝，唔係之後每輪都講
+CONTACT_ACK_STAGES = (BookingStage.TREATMENT, BookingStage.TIME)
+
+
+def _contact_ack(has_name: bool, has_phone: bool) -> str:
+    if has_name and has_phone:
+        return f"多謝{NAME_SLOT}，資料已經記低～"
+    if has_name:
+        return f"多謝{NAME_SLOT}～"
+    if has_phone:
+        return "電話已經記低～"
+    return ""
+
+
+def _stage_prompt_template(stage: BookingStage, treatment: str, has_time: bool, has_name: bool, has_phone: bool) -> str:
     """
-    【最高優先優化】用硬規則快速回覆，避免 LLM 延遲。
-    返回空字串表示無法用規則處理，交由 LLM 處理。
+    每個階段嘅回覆模板，只喺啟動時建表用。
+    跟系統提示：名字 / 電話簡單確認，唔重複朗讀電話號碼。
     """
-    u = user_text.lower()
+    if stage is BookingStage.GREETING:
+        return "你好～想預約療程，定係想問價錢呢？"
+
+    if stage is BookingStage.CANCELLED:
+        return "好，已經幫你取消預約～有需要隨時再搵我哋。"
+
+    if stage is BookingStage.CHANGED:
+        if not treatment:
+            return "冇問題～你想改做邊款療程呢？"
+        if not has_time:
+            return f"冇問題～{treatment} 你想改去邊日幾點呢？"
+        return f"冇問題，已經幫你改做：{QUICK_REPLY_SLOT} 做 {treatment}，到時見～"
+
+    ack = _contact_ack(has_name, has_phone)
+    if stage is BookingStage.TREATMENT:
+        if has_time:
+            return f"{ack or '好～'}{QUICK_REPLY_SLOT} 可以幫你安排。你想做邊款療程呢？basic facial 定深層清潔 facial？"
+        return f"{ack or '好呀～'}你想預約邊款療程呢？basic facial 定深層清潔 facial？"
+
+    if stage is BookingStage.TIME:
+        return f"{ack or '明白～'}你想預約 {treatment}。你想約邊日同幾點呢？"
+
+    if stage is BookingStage.CONTACT:
+        if has_name:
+            return f"多謝{NAME_SLOT}～麻煩再留低電話號碼。"
+        if has_phone:
+            return "電話已經記低～請問點稱呼呢？"
+        return f"好～我幫你登記：{QUICK_REPLY_SLOT} 做 {treatment}。麻煩留低全名同電話號碼～"
+
+    # 已確認
+    return f"多謝{NAME_SLOT}！已經幫你登記：{QUICK_REPLY_SLOT} 做 {treatment}，到時見～"
+
+
+def _build_stage_prompt_table() -> dict:
+    table = {}
+    for stage in BookingStage:
+        for treatment in (None,) + TREATMENTS:
+            for has_time, has_name, has_phone in itertools.product((False, True), repeat=3):
+                key = (stage, treatment, has_time, has_name, has_phone)
+                table[key] = _stage_prompt_template(*key)
+    return table
+
+
+# (階段, 療程, 有冇時間, 有冇名, 有冇電話) → 模板；動態欄位係 NAME_SLOT 同 QUICK_REPLY_SLOT
+BOOKING_STAGE_PROMPTS = _build_stage_prompt_table()
+
+
+def current_stage(state: dict) -> BookingStage:
+    """state 入面記住嘅預約階段（舊 state 冇呢個欄位就當問候）。"""
+    return BookingStage(state.get("booking_stage") or BookingStage.GREETING)
+
+
+# LLM 配額排隊：預約做到越後嘅對話越前（數字細嘅先），問候 / 取消咗嘅新來電排最後
+STAGE_QUEUE_RANK = {
+    BookingStage.CONTACT: 0,
+    BookingStage.CHANGED: 0,
+    BookingStage.TIME: 1,
+    BookingStage.TREATMENT: 2,
+    BookingStage.CONFIRMED: 2,
+    BookingStage.GREETING: 3,
+    BookingStage.CANCELLED: 3,
+}
+
+# 輪數封頂，傾好耐嘅閒聊唔會無限排前
+QUEUE_RANK_MAX_TURNS = 20
+
+
+def conversation_queue_rank(state: dict) -> tuple:
+    """同一優先級之內嘅排隊次序：(階段排名, -輪數)，預約做到一半、傾咗耐嘅對話先攞 LLM 配額。"""
+    turns = min(state.get("turns") or 0, QUEUE_RANK_MAX_TURNS)
+    return STAGE_QUEUE_RANK[current_stage(state)], -turns
+
+
+def next_booking_stage(state: dict, intent: Intent) -> BookingStage:
+    """O(1) 查表：由今輪意圖同已知資料推算下一個預約階段。"""
+    return BOOKING_TRANSITIONS[(current_stage(state), intent, _booking_slots(state))]
+
+
+def render_stage_prompt(stage: BookingStage, state: dict, contact_given: bool = False) -> str:
+    """O(1) 查階段模板並填入動態欄位；contact_given = 今輪先講咗名 / 電話。"""
+    name = state.get("customer_name")
+    booking_time = state.get("booking_time")
     treatment = state.get("treatment")
+    has_name, has_phone = bool(name), bool(state.get("phone"))
+    if stage in CONTACT_ACK_STAGES and not contact_given:
+        has_name = has_phone = False
+    key = (stage, treatment, bool(booking_time), has_name, has_phone)
+    template = BOOKING_STAGE_PROMPTS.get(key)
+    if template is None:
+        # 目錄以外嘅療程（例如外部傳入嘅 state）→ 即場渲染
+        template = _stage_prompt_template(*key)
+    if name:
+        template = template.replace(NAME_SLOT, name)
+    if booking_time:
+        template = template.replace(QUICK_REPLY_SLOT, booking_time)
+    return template
+
+
+# 更正咗邊樣：療程 / 時間換咗新值，或者被否定之後清走
+CORRECTION_KINDS = ("treatment", "time", "cleared")
+CORRECTION_STAGES = (BookingStage.TREATMENT, BookingStage.TIME, BookingStage.CONTACT, BookingStage.CONFIRMED)
+
+
+def _correction_prompt_template(
+    stage: BookingStage, kind: str, treatment: str, has_time: bool, has_name: bool, has_phone: bool
+) -> str:
+    """
+    確認之前客人更正資料嘅回覆模板（先確認改咗乜，再問落一步），只喺啟動時建表用。
+    確認之後再改由 CHANGED 階段嘅 prompt 負責。
+    """
+    if kind != "cleared" and treatment and has_time:
+        ack = f"冇問題，改咗做：{QUICK_REPLY_SLOT} 做 {treatment}～"
+    elif kind == "treatment" and treatment:
+        ack = f"冇問題，改咗做 {treatment}～"
+    elif kind == "time" and has_time:
+        ack = f"冇問題，時間改咗做 {QUICK_REPLY_SLOT}～"
+    else:
+        ack = "冇問題～"
+
+    if stage is BookingStage.TREATMENT:
+        return f"{ack}咁你想做邊款療程呢？basic facial 定深層清潔 facial？"
+    if stage is BookingStage.TIME:
+        return f"{ack}你想約邊日同幾點呢？"
+    if stage is BookingStage.CONTACT:
+        if has_name:
+            return f"{ack}麻煩再留低電話號碼。"
+        if has_phone:
+            return f"{ack}請問點稱呼呢？"
+        return f"{ack}麻煩留低全名同電話號碼。"
+    return f"{ack}到時見～"
+
+
+def _build_correction_prompt_table() -> dict:
+    table = {}
+    for stage in CORRECTION_STAGES:
+        for kind in CORRECTION_KINDS:
+            for treatment in (None,) + TREATMENTS:
+                for has_time, has_name, has_phone in itertools.product((False, True), repeat=3):
+                    key = (stage, kind, treatment, has_time, has_name, has_phone)
+                    table[key] = _correction_prompt_template(*key)
+    return table
+
+
+# (階段, 更正類別, 療程, 有冇時間, 有冇名, 有冇電話) → 模板
+CORRECTION_PROMPTS = _build_correction_prompt_table()
+
+
+def render_correction_prompt(stage: BookingStage, kind: str, state: dict) -> str:
+    """O(1) 查更正確認模板並填入預約時間。"""
     booking_time = state.get("booking_time")
+    key = (stage, kind, state.get("treatment"), bool(booking_time), bool(state.get("customer_name")), bool(state.get("phone")))
+    template = CORRECTION_PROMPTS.get(key)
+    if template is None:
+        template = _correction_prompt_template(*key)
+    if booking_time:
+        template = template.replace(QUICK_REPLY_SLOT, booking_time)
+    return template
+
+
+def static_quick_replies() -> list:
+    """返回所有唔使填欄位嘅快速回覆（可以預先合成語音）。"""
+    templates = (*QUICK_REPLY_TABLE.values(), *BOOKING_STAGE_PROMPTS.values(), *CORRECTION_PROMPTS.values())
+    return sorted({t for t in templates if QUICK_REPLY_SLOT not in t and NAME_SLOT not in t})
+
+
+def _render_reply(
+    intent: Intent, stage: BookingStage, state: dict, correction: str = None, contact_given: bool = False
+) -> str:
+    if intent is Intent.CHANGE and correction and stage in CORRECTION_STAGES:
+        return render_correction_prompt(stage, correction, state)
+    if intent in BOOKING_INTENTS:
+        return render_stage_prompt(stage, state, contact_given)
+    treatment = state.get("treatment")
+    template = QUICK_REPLY_TABLE.get((intent, treatment))
+    if template is None and treatment is not None and treatment not in TREATMENTS:
+        template = _quick_reply_template(intent, treatment)
+    return template or ""
+
+
+def render_quick_reply(intent: Intent, state: dict) -> str:
+    """O(1) 查表並填入動態欄位；返回空字串表示無規則可答。"""
+    return _render_reply(intent, next_booking_stage(state, intent), state)
+
+
+# 本輪啱啱解析到預約時間 / 療程 / 聯絡資料（唔係關鍵字，由 _prepare_turn 加入）
+TIME_GIVEN_SIGNAL = "time_given"
+TREATMENT_GIVEN_SIGNAL = "treatment_given"
+CONTACT_GIVEN_SIGNAL = "contact_given"
+# 已登記嘅療程 / 時間今輪被更正（換咗或者清走）
+TREATMENT_CORRECTED_SIGNAL = "treatment_corrected"
+TIME_CORRECTED_SIGNAL = "time_corrected"
+# 今輪「約多個」：舊預約存咗檔，清走療程 / 時間唔算更正
+NEW_BOOKING_SIGNAL = "booking_archived"
+
+
+def _slot_signals(old: dict, new: dict) -> frozenset:
+    """比較今輪前後嘅 state，返回「講咗 / 改咗邊啲資料」嘅訊號。"""
+    out = set()
+    if len(new.get("bookings") or ()) > len(old.get("bookings") or ()):
+        out.add(NEW_BOOKING_SIGNAL)
+        old = BOOKING_SLOTS_CLEARED
+    if new.get("booking_time") and new.get("booking_time") != old.get("booking_time"):
+        out.add(TIME_GIVEN_SIGNAL)
+    if new.get("treatment") and new.get("treatment") != old.get("treatment"):
+        out.add(TREATMENT_GIVEN_SIGNAL)
+    if (new.get("customer_name"), new.get("phone")) != (old.get("customer_name"), old.get("phone")):
+        out.add(CONTACT_GIVEN_SIGNAL)
+    if old.get("treatment") and new.get("treatment") != old.get("treatment"):
+        out.add(TREATMENT_CORRECTED_SIGNAL)
+    old_start, old_end = old.get("booking_start"), old.get("booking_end")
+    if old.get("booking_time") and new.get("booking_time") != old.get("booking_time"):
+        # 由日子 / 時段（範圍）補到準確鐘點係補充，唔係更正
+        refined = (
+            new.get("booking_start") and old_start != old_end
+            and new["booking_start"][:10] == old_start[:10]
+        )
+        if not refined:
+            out.add(TIME_CORRECTED_SIGNAL)
+    return frozenset(out)
+
+
+def _correction_kind(signals: frozenset, state: dict) -> str:
+    """今輪更正咗乜（CORRECTION_KINDS 之一）；冇更正返回 None。"""
+    if TREATMENT_CORRECTED_SIGNAL in signals:
+        return "treatment" if state.get("treatment") else "cleared"
+    if TIME_CORRECTED_SIGNAL in signals:
+        return "time" if state.get("booking_time") else "cleared"
+    return None
+
+
+def _match_intent(signals: frozenset, state: dict) -> Intent:
+    """按優先次序由命中訊號揀意圖。"""
+    if "cancel" in signals:
+        return Intent.CANCEL
+    if NEW_BOOKING_SIGNAL in signals:
+        # 約多個：舊預約已經存檔，由頭行預約流程
+        return Intent.BOOKING
+    stage = current_stage(state)
+    contact_given = CONTACT_GIVEN_SIGNAL in signals
+    if contact_given and stage is BookingStage.CONTACT and "price" not in signals:
+        # 啱啱問咗名 / 電話，客人答咗 → 即刻確認（模板已經包埋預約進度）
+        return Intent.CONTACT
+    if "change" in signals or signals & {TREATMENT_CORRECTED_SIGNAL, TIME_CORRECTED_SIGNAL}:
+        return Intent.CHANGE
+    if stage is BookingStage.CHANGED and signals & {TIME_GIVEN_SIGNAL, TREATMENT_GIVEN_SIGNAL}:
+        # 「我想改期」之後補返新時間 / 療程 → 仲係改期嗰單
+        return Intent.CHANGE
+    if "booking" in signals:
+        return Intent.BOOKING
+    if "price" in signals:
+        return Intent.PRICE
+    if TIME_GIVEN_SIGNAL in signals:
+        # 客人講咗時間 → 當預約流程，即刻確認 / 追問療程
+        return Intent.BOOKING
+    if TREATMENT_GIVEN_SIGNAL in signals or ("facial" in signals and state.get("treatment")):
+        return Intent.TREATMENT_CONFIRM
+    if "hours" in signals:
+        return Intent.HOURS
+    if "location" in signals:
+        return Intent.LOCATION
+    if contact_given and "question" not in signals:
+        # 其他階段主動報名 / 電話：排喺所有問題後面，有問題就交俾 LLM
+        return Intent.CONTACT
+    return Intent.UNKNOWN
+
+
+def classify_turn(user_text: str, state: dict, signals: frozenset = None) -> TurnClassification:
+    """
+    單次分類：根據命中訊號同現有狀態，一次過決定意圖、下一個預約階段同規則回覆。
+    只有 reply 非空先會行快速路由，保證唔會揀咗快速路由但無規則可答。
+    """
+    if signals is None:
+        signals = scan_signals(normalize_utterance(user_text))
 
-    # ===== 預約流程規則 =====
-    if any(sig in u for sig in ["預約", "約", "book", "改期"]):
-        if not treatment:
-            return "好呀～你想預約邊款療程呢？basic facial 定深層清潔 facial？"
-        if not booking_time:
-            return f"明白～你想預約 {treatment}。你想約邊日同幾點呢？"
-        # 有療程 + 有時間 → 確認
-        return f"好～我幫你登記：{booking_time} 做 {treatment}。麻煩留低全名同電話號碼～"
+    intent = _match_intent(signals, state)
+    stage = next_booking_stage(state, intent)
+    if intent is Intent.UNKNOWN:
+        return TurnClassification(Intent.UNKNOWN, "", stage)  # 無法用規則處理，交由 LLM
+    reply = _render_reply(intent, stage, state, _correction_kind(signals, state), CONTACT_GIVEN_SIGNAL in signals)
+    return TurnClassification(intent, reply, stage)
 
-    # ===== 價格查詢規則 =====
-    if any(sig in u for sig in ["幾錢", "幾多錢", "價錢", "費用"]):
-        if treatment:
-            if treatment == "basic facial":
-                return f"good，basic facial 係 $480 起。有咩皮膚問題想重點改善嗎？"
-            elif treatment == "深層清潔 facial":
-                return f"deep facial 係 $680 起。幫你深層清潔同補水。"
-            else:
-                return f"你揀嘅 {treatment} 根據療程時間唔同，約 $680-$1800 左右。"
-        else: 
-            return "basic facial $480 起，深層清潔 $680，皮秒激光 $1800 起。你想了解邊款呢？"
 
-    # ===== 療程確認規則（已有療程選擇） =====
-    if any(sig in u for sig in ["facial", "清潔", "皮膚"]) and treatment:
-        return f"好呀，關於 {treatment}，我哋可以幫你安排。你想幾時嚟做呢？"
+def _should_use_quick_path(user_text: str, state: dict, signals: frozenset = None) -> bool:
+    """
+    判斷係必要用快速規則回覆（毋須 LLM），加快速度。
+    同 classify_turn 共用同一套規則，有規則可答先會返回 True。
+    """
+    return bool(classify_turn(user_text, state, signals).reply)
 
-    # ===== 其他常見問題 =====
-    if "營業時間" in u or "幾時開" in u or "幾時收" in u:
-        return "我哋營業時間係早上十一點到夜晚九點，星期一休息。"
 
-    if "位置" in u or "地址" in u or "邊度" in u:
-        return "我哋喺中環，具體地址你可以聯絡我時再畀你。你想先預約嗎？"
+def quick_rule_reply(user_text: str, state: dict, signals: frozenset = None) -> str:
+    """
+    【最高優先優化】用硬規則快速回覆，避免 LLM 延遲。
+    返回空字串表示無法用規則處理，交由 LLM 處理。
+    """
+    return classify_turn(user_text, state, signals).reply
 
-    return ""  # 無法用規則處理，交由 LLM
+
+# 降級時完全估唔到意圖就問返客人想做咩
+CLARIFY_REPLY = "唔好意思，想確認多少少：你係想問價錢、預約，定係想了解療程呢？"
+
+
+def degraded_rule_reply(user_text: str, state: dict, signals: frozenset = None) -> str:
+    """
+    唔問 LLM 時（降級 / 熔斷 / 配額唔夠）用嘅放寬版快速路由，一定有回覆：
+    有規則就照用；否則有預約資料或者提到 facial → 行預約狀態機，
+    用當前階段嘅 prompt；乜都唔知就問澄清問題。
+    """
+    if signals is None:
+        signals = scan_signals(normalize_utterance(user_text))
+    reply = quick_rule_reply(user_text, state, signals)
+    if reply:
+        return reply
+
+    if not (state.get("treatment") or state.get("booking_time") or signals & {"facial", "facial_en"}):
+        return CLARIFY_REPLY
+    return render_quick_reply(Intent.BOOKING, state) or CLARIFY_REPLY
 
 
 # ==================== 文本清理函數 ====================
@@ -217,6 +1837,72 @@ def strip_brackets_and_symbols(text: str) -> str:
     return text.strip()
 
 
+# 回覆過濾用嘅關鍵字：已知療程 / 時間之後，LLM 唔可以再問
+REPLY_RULE_TABLES = {
+    "ask_treatment": ("想做咩", "邊款療程", "做邊款", "邊隻 facial"),
+    "ask_time": ("幾點", "幾時", "邊日", "咩時間"),
+    "ask_contact": ("全名", "電話號碼", "點稱呼", "聯絡電話"),
+}
+REPLY_RULE_AUTOMATON = KeywordAutomaton(REPLY_RULE_TABLES)
+
+_SENTENCE_END_RE = re.compile(r"[。！？!?]+")
+_SENTENCE_PUNCT = "。！？!?，,、 \n\t"
+
+
+class HardRuleStreamFilter:
+    """
+    串流硬規則過濾：逐段 feed LLM 文字，一見到句尾標點就返回已批准嘅句子。
+    只會保留未完結嘅尾巴，已輸出嘅文字唔會再掃描。
+    根據建立時嘅 state 刪走重複問療程 / 時間 / 聯絡資料嘅句子。
+    """
+
+    def __init__(self, state: dict):
+        self._has_treatment = state.get("treatment") is not None
+        self._has_time = state.get("booking_time") is not None
+        self._has_contact = bool(state.get("customer_name") and state.get("phone"))
+        self._tail = ""
+        self.emitted = 0  # 已批准句子數目
+        self.dropped = 0  # 被硬規則刪走嘅句子數目
+
+    def _approve(self, sentence: str) -> str:
+        sentence = sentence.strip()
+        if not sentence.strip(_SENTENCE_PUNCT):
+            return ""
+        signals = REPLY_RULE_AUTOMATON.scan(sentence.translate(CANONICAL_TABLE))
+        if (
+            (self._has_treatment and "ask_treatment" in signals)
+            or (self._has_time and "ask_time" in signals)
+            or (self._has_contact and "ask_contact" in signals)
+        ):
+            self.dropped += 1
+            return ""
+        self.emitted += 1
+        return sentence
+
+    def feed(self, chunk: str) -> list:
+        """加入新文字，返回今次完結而且批准咗嘅句子。"""
+        if not chunk:
+            return []
+        # 舊尾巴已經確認冇句尾標點，只需要由新文字開始搵
+        scan_from = len(self._tail)
+        self._tail += chunk
+        out = []
+        start = 0
+        for m in _SENTENCE_END_RE.finditer(self._tail, scan_from):
+            sentence = self._approve(self._tail[start:m.end()])
+            if sentence:
+                out.append(sentence)
+            start = m.end()
+        self._tail = self._tail[start:]
+        return out
+
+    def flush(self) -> list:
+        """串流完結：處理最後一句（可能冇句尾標點）。"""
+        sentence = self._approve(self._tail)
+        self._tail = ""
+        return [sentence] if sentence else []
+
+
 def apply_hard_rules_to_reply(raw_reply: str, state: dict) -> str:
     """
     硬規則層：根據已知狀態過濾 LLM 回覆，避免重複提問。
@@ -224,115 +1910,1154 @@ def apply_hard_rules_to_reply(raw_reply: str, state: dict) -> str:
     if not raw_reply:
         return raw_reply
 
-    sentences = re.split(r"(? <=[。！？\?! ])\s*", raw_reply)
-    filtered = []
+    f = HardRuleStreamFilter(state)
+    filtered = f.feed(raw_reply) + f.flush()
 
-    has_treatment = state.get("treatment") is not None
-    has_time = state.get("booking_time") is not None
+    cleaned = "".join(filtered).strip()
+    if cleaned and not _SENTENCE_END_RE.search(cleaned[-1]):
+        cleaned += "。"
 
-    for s in sentences:
-        if not s.strip():
-            continue
+    return strip_brackets_and_symbols(cleaned)
 
-        skip = False
 
-        # 已有療程 → 禁止再問療程
-        if has_treatment and any(kw in s for kw in ["想做咩", "邊款療程", "做邊款", "邊隻 facial"]):
-            skip = True
+# ==================== LLM 回覆快取 ====================
 
-        # 已有時間 → 禁止再問時間
-        if has_time and any(kw in s for kw in ["幾點", "幾時", "邊日", "咩時間"]):
-            skip = True
+_CACHE_NORMALIZE_RE = re.compile(r"[\s，。！？、,.!?~～「」\"']+")
 
-        if not skip:
-            filtered.append(s. strip())
 
-    cleaned = "。".join(filtered).strip()
-    if not cleaned. endswith("。") and cleaned:
-        cleaned += "。"
+def normalize_cache_text(text: str) -> str:
+    """快取用嘅標準化：喺 normalize_utterance 之上再去空白同標點。"""
+    return _CACHE_NORMALIZE_RE.sub("", text or "")
 
-    return strip_brackets_and_symbols(cleaned)
 
+def _response_cache_key(user_text: str, state: dict) -> tuple:
+    # 只包括 build_memory_context 用到嘅欄位，其他 state 唔影響 LLM 回覆
+    return (
+        normalize_cache_text(user_text),
+        state.get("treatment"),
+        state.get("booking_time"),
+        state.get("booking_stage"),
+        bool(state.get("customer_name")),
+        bool(state.get("phone")),
+        # 之前嘅預約會列喺 LLM 嘅記憶入面
+        tuple((b["booking_time"], b["treatment"]) for b in state.get("bookings") or ()),
+    )
 
-def _extract_text_from_response(response) -> str:
-    """安全抽取 Gemini 回應"""
-    try:
-        if hasattr(response, "text") and response.text:
-            return response.text. strip()
-    except Exception:
-        pass
 
-    try:
-        for cand in getattr(response, "candidates", []):
-            for part in getattr(cand, "content", {}).parts: 
-                if hasattr(part, "text") and part.text:
-                    return part.text.strip()
-    except Exception:
-        pass
+class ResponseCache:
+    """
+    LLM 回覆精確匹配快取（LRU + TTL）。
+    儲存嘅係已經過 apply_hard_rules_to_reply 嘅最終回覆。
+    """
 
-    return ""
+    def __init__(self, max_size: int, ttl_s: float):
+        self.max_size = max_size
+        self.ttl_s = ttl_s
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, key: tuple):
+        """命中返回回覆文字，否則返回 None。"""
+        if self.max_size <= 0:
+            return None
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            reply, expires_at = entry
+            if expires_at < time.monotonic():
+                del self._data[key]
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return reply
+
+    def put(self, key: tuple, reply: str) -> None:
+        if self.max_size <= 0 or not reply:
+            return
+        with self._lock:
+            self._data[key] = (reply, time.monotonic() + self.ttl_s)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def invalidate(self) -> None:
+        """價錢 / 系統提示詞改咗（reload_content）：舊回覆全部作廢。"""
+        with self._lock:
+            self._data.clear()
+            self.invalidations += 1
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+        }
+
+
+response_cache = ResponseCache(RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL_S)
+
+
+# 語氣詞同客套字對意思冇幫助，計相似度前先刪走
+_SEMANTIC_FILLER_RE = re.compile(r"請問|想問|你哋|我哋|[呀啊吖嗎呢啦喇喎嘅咩囉嘛吓]")
+
+# 正反問（「有冇」「可唔可以」「收唔收」）唔係否定：計相似度同數否定詞之前收返做肯定講法（「有」「可以」「收」）
+_SEMANTIC_A_NOT_A_RE = re.compile(r"(有)冇|(.)唔\2")
+_SEMANTIC_NEGATION_CHARS = frozenset("唔冇未無不")
+# 中文逐個字，英文 / 數字成個詞（「facial」唔好拆做六個字母）
+_SEMANTIC_TOKEN_RE = re.compile(r"[a-z0-9]+|[^a-z0-9]")
+
+
+def _semantic_text(text: str) -> str:
+    t = _SEMANTIC_FILLER_RE.sub("", normalize_cache_text(text))
+    return _SEMANTIC_A_NOT_A_RE.sub(lambda m: m.group(1) or m.group(2), t)
+
+# 內容名詞：兩條問題提到嘅類別唔一樣（「小朋友」對「狗」、「八達通」對「現金」）就唔可以共用回覆
+SEMANTIC_TOPIC_TABLES = {
+    **{cls: KEYWORD_TABLES[cls] for cls in (
+        "treatment_deep", "treatment_basic", "treatment_pico", "treatment_massage", "facial",
+        "price", "hours", "location",
+    )},
+    "child": ("小朋友", "細路", "小童", "兒童", "bb", "baby", "嬰兒"),
+    "pet": ("狗", "貓", "寵物"),
+    "pregnant": ("懷孕", "孕婦", "大肚"),
+    "elderly": ("老人", "長者"),
+    "male": ("男士", "男仔", "男人", "男朋友", "老公"),
+    "parking": ("泊車", "車位", "停車"),
+    "card": ("碌卡", "信用卡", "visa", "master"),
+    "octopus": ("八達通",),
+    "cash": ("現金",),
+    "transfer": ("轉數快", "fps", "payme"),
+    "pain": ("痛",),
+    "redness": ("紅", "敏感"),
+}
+_SEMANTIC_TOPIC_AUTOMATON = KeywordAutomaton(SEMANTIC_TOPIC_TABLES)
+
+
+def _semantic_guard(text: str) -> tuple:
+    """(否定詞, 內容類別)：兩條問題呢兩樣要完全一樣，相似度再高都要先過呢關。"""
+    t = _semantic_text(text)
+    negations = "".join(sorted(ch for ch in t if ch in _SEMANTIC_NEGATION_CHARS))
+    return negations, _SEMANTIC_TOPIC_AUTOMATON.scan(t)
+
+
+class SemanticCache:
+    """
+    本地相似度快取：字元 unigram + bigram 雜湊向量（NumPy），按 IDF 加權計 cosine，
+    令 ASR 講法唔同但意思一樣嘅問題（例如「你哋有冇泊車位」同「有冇地方泊車呀」）
+    都可以重用已審核嘅回覆。完全唔使網絡。
+
+    只會有 add() / vetted_file 加入嘅已審核回覆，LLM 即場生成嘅回覆唔會入嚟（見 _store_llm_reply）。
+    相似度過咗門檻之外，兩條問題嘅否定詞同內容類別要一樣（_semantic_guard），
+    「懷孕可以做嗎」同「懷孕唔可以做嗎」、「小朋友可以做嗎」同「狗可以做嗎」都唔會當同一條。
+
+    矩陣按維度儲存原始詞頻（dim × capacity），IDF 同每條記錄嘅長度喺加完記錄之後第一次查詢先重算；
+    查詢只讀命中嗰幾個維度，所以幾萬條記錄都可以喺一毫秒內搵到 top-k 最近鄰。
+    """
+
+    def __init__(self, capacity: int, dim: int, threshold: float, top_k: int, vetted_file: str = ""):
+        self.capacity = capacity
+        self.dim = dim
+        self.threshold = threshold
+        self.top_k = top_k
+        self.vetted_file = vetted_file
+        self._vetted_loaded = False
+        self._matrix = None  # 第一次 add 先分配（同時載入 numpy）
+        self._df = None  # 每個維度有幾多條記錄用到
+        self._idf = None  # None = 要重算（連 _norms）
+        self._norms = None
+        self._contexts = []
+        self._replies = []
+        self._guards = []
+        self._size = 0
+        self._next = 0  # 環形緩衝：滿咗就覆蓋最舊嗰條
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.guarded = 0
+        self.invalidations = 0
+
+    def _features(self, text: str):
+        """返回 (非零維度, 詞頻)；無內容就返回 None。"""
+        import numpy as np
+
+        tokens = _SEMANTIC_TOKEN_RE.findall(_semantic_text(text))
+        if not tokens:
+            return None
+        feats = {}
+        grams = tokens + [a + b for a, b in zip(tokens, tokens[1:])]
+        for g in grams:
+            b = zlib.crc32(g.encode("utf-8")) % self.dim
+            feats[b] = feats.get(b, 0.0) + 1.0
+        idx = np.fromiter(feats.keys(), dtype=np.intp, count=len(feats))
+        tf = np.fromiter(feats.values(), dtype=np.float32, count=len(feats))
+        return idx, tf
+
+    def _refresh_idf(self) -> None:
+        """加完記錄之後重算 IDF 同每條記錄嘅加權長度（要持有 self._lock）。"""
+        import numpy as np
+
+        if self._idf is not None:
+            return
+        # 冇記錄用過嘅維度當只出現過一次：唔會因為已審核問題少而令查詢入面嘅生字重到壓低晒相似度
+        self._idf = (np.log((1.0 + self._size) / (1.0 + np.maximum(self._df, 1.0))) + 1.0).astype(np.float32)
+        weighted = self._matrix[:, :self._size] * self._idf[:, None]
+        self._norms = np.sqrt(np.einsum("ij,ij->j", weighted, weighted))
+
+    def _ensure_vetted(self) -> None:
+        if self.vetted_file and not self._vetted_loaded:
+            self._vetted_loaded = True
+            self.load_vetted(self.vetted_file)
+
+    def lookup(self, text: str, context: tuple):
+        """
+        搵最相似、context 一致（記錄冇 context 就乜都啱）而且過到 _semantic_guard 嘅記錄；
+        相似度過咗門檻先返回回覆，否則 None。
+        """
+        if self.capacity <= 0:
+            return None
+        self._ensure_vetted()
+        if not self._size:
+            self.misses += 1
+            return None
+
+        import numpy as np
+
+        feats = self._features(text)
+        guard = _semantic_guard(text)
+        with self._lock:
+            if feats is None or not self._size:
+                self.misses += 1
+                return None
+            self._refresh_idf()
+            # 查詢向量乘兩次 IDF（一次係佢自己、一次代記錄），同原始詞頻矩陣點積再除記錄長度就係 cosine
+            idx, tf = feats
+            w = tf * self._idf[idx]
+            q = w * self._idf[idx] / np.sqrt(np.dot(w, w))
+            sims = (q @ self._matrix[idx, :self._size]) / self._norms
+
+            k = min(self.top_k, self._size)
+            top = np.argpartition(-sims, k - 1)[:k] if k < self._size else np.arange(self._size)
+            for i in top[np.argsort(-sims[top])]:
+                if sims[i] < self.threshold:
+                    break
+                if self._contexts[i] is not None and self._contexts[i] != context:
+                    continue
+                if self._guards[i] != guard:
+                    self.guarded += 1
+                    continue
+                self.hits += 1
+                return self._replies[i]
+
+            self.misses += 1
+            return None
+
+    def similarity(self, a: str, b: str) -> float:
+        """兩條問題按目前 IDF 計嘅 cosine（唔理 _semantic_guard），校準門檻同測試用。"""
+        import numpy as np
+
+        fa, fb = self._features(a), self._features(b)
+        if fa is None or fb is None:
+            return 0.0
+        with self._lock:
+            if self._size:
+                self._refresh_idf()
+                idf = self._idf
+            else:
+                idf = np.ones(self.dim, dtype=np.float32)
+        va = np.zeros(self.dim, dtype=np.float32)
+        vb = np.zeros(self.dim, dtype=np.float32)
+        va[fa[0]] = fa[1] * idf[fa[0]]
+        vb[fb[0]] = fb[1] * idf[fb[0]]
+        return float(np.dot(va, vb) / np.sqrt(np.dot(va, va) * np.dot(vb, vb)))
+
+    @staticmethod
+    def matches(a: str, b: str) -> bool:
+        """兩條問題嘅否定詞同內容類別一樣（_semantic_guard）。"""
+        return _semantic_guard(a) == _semantic_guard(b)
+
+    def add(self, text: str, context: tuple, reply: str) -> None:
+        """加一條已審核嘅回覆；context=None 即係同預約狀態無關（泊車、付款之類），乜 context 都用得。"""
+        if self.capacity <= 0 or not reply:
+            return
+        feats = self._features(text)
+        if feats is None:
+            return
+        idx, tf = feats
+        guard = _semantic_guard(text)
+        with self._lock:
+            if self._matrix is None or self._matrix.shape != (self.dim, self.capacity):
+                import numpy as np
+
+                self._matrix = np.zeros((self.dim, self.capacity), dtype=np.float32)
+                self._df = np.zeros(self.dim, dtype=np.float32)
+                self._contexts = [None] * self.capacity
+                self._replies = [None] * self.capacity
+                self._guards = [None] * self.capacity
+                self._size = 0
+                self._next = 0
+            slot = self._next
+            if slot < self._size:
+                self._df -= self._matrix[:, slot] > 0
+            self._matrix[:, slot] = 0.0
+            self._matrix[idx, slot] = tf
+            self._df[idx] += 1.0
+            self._idf = None
+            self._contexts[slot] = context
+            self._replies[slot] = reply
+            self._guards[slot] = guard
+            self._next = (slot + 1) % self.capacity
+            self._size = min(self._size + 1, self.capacity)
+
+    def load_vetted(self, path: str) -> int:
+        """
+        由 JSONL 載入已審核回覆，每行 {"questions": [講法, ...], "reply": 回覆}，返回加咗幾多條講法。
+        呢啲回覆同預約狀態無關（context=None）。
+        """
+        added = 0
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                entry = json.loads(line)
+                for question in entry["questions"]:
+                    self.add(normalize_utterance(question), None, entry["reply"])
+                    added += 1
+        return added
+
+    def invalidate(self) -> None:
+        """價錢 / 系統提示詞改咗（reload_content）：舊回覆全部作廢，已審核檔案下次查詢再載入。"""
+        with self._lock:
+            self._size = 0
+            self._next = 0
+            if self._df is not None:
+                self._df[:] = 0.0
+            self._idf = None
+            self._vetted_loaded = False
+            self.invalidations += 1
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": self._size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "guarded": self.guarded,
+            "invalidations": self.invalidations,
+        }
+
+
+semantic_cache = SemanticCache(
+    SEMANTIC_CACHE_SIZE, SEMANTIC_CACHE_DIM, SEMANTIC_CACHE_THRESHOLD, SEMANTIC_CACHE_TOP_K, SEMANTIC_CACHE_VETTED_FILE
+)
+
+
+# ==================== 內容重新載入 ====================
+
+def reload_content(price_catalogue: dict = None) -> None:
+    """
+    改價錢（或者 SYSTEM_PROMPT_TEMPLATE）之後叫一次：重新渲染系統提示詞同所有模板表，
+    自己建嘅 LLM 後端下次用先按新提示詞重建，兩個回覆快取作廢。每輪唔使再檢查內容有冇變。
+    price_catalogue 係 {療程: 起價}，只可以改 TREATMENTS 入面已有嘅療程。
+    """
+    global SYSTEM_PROMPT
+    if price_catalogue:
+        unknown = set(price_catalogue) - set(TREATMENTS)
+        if unknown:
+            raise ValueError(f"目錄冇呢啲療程：{'、'.join(sorted(unknown))}")
+        PRICE_CATALOGUE.update(price_catalogue)
+
+    SYSTEM_PROMPT = _build_system_prompt()
+    # 就地更新（其他層可能 import 咗個 dict）；key 組合固定，逐個覆蓋唔會有查唔到嘅空窗
+    QUICK_REPLY_TABLE.update(_build_quick_reply_table())
+    BOOKING_STAGE_PROMPTS.update(_build_stage_prompt_table())
+    CORRECTION_PROMPTS.update(_build_correction_prompt_table())
+    _drop_built_backends()
+    response_cache.invalidate()
+    semantic_cache.invalidate()
+
+
+# ==================== 每輪延遲追蹤 ====================
+# 未設定 sink 時唔會建 TurnTrace，每個階段只係多一個 `is not None` 判斷。
+
+class TurnTrace:
+    """
+    一輪對話嘅延遲記錄：每個階段用單調時鐘計時，連同 trace_id 同出口路線交俾 sink。
+    階段：state / routing / cache / llm / hard_rules / sanitize
+    """
+
+    __slots__ = ("trace_id", "stages", "outcome", "started_at", "_t0", "_last")
+
+    def __init__(self):
+        self.trace_id = uuid.uuid4().hex[:16]
+        self.stages = {}
+        self.outcome = ""
+        self.started_at = time.time()
+        self._t0 = self._last = time.perf_counter()
+
+    def mark(self, stage: str) -> None:
+        """將上一個 mark 之後嘅時間計入 stage（同一階段可以累加，例如串流）。"""
+        now = time.perf_counter()
+        self.stages[stage] = self.stages.get(stage, 0.0) + (now - self._last)
+        self._last = now
+
+    def skip(self) -> None:
+        """唔計入任何階段（例如等消費端讀下一句嘅時間）。"""
+        self._last = time.perf_counter()
+
+    def total(self) -> float:
+        return time.perf_counter() - self._t0
+
+    def to_dict(self, total: float) -> dict:
+        return {
+            "trace_id": self.trace_id,
+            "ts": self.started_at,
+            "outcome": self.outcome,
+            "total_ms": round(total * 1000, 3),
+            "stages_ms": {k: round(v * 1000, 3) for k, v in self.stages.items()},
+        }
+
+
+# 直方圖桶（秒），同 Prometheus 預設相近
+LATENCY_BUCKETS_S = (0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class LatencyHistogramSink:
+    """記憶體直方圖：每個階段（連 total）累計桶數、總和同次數，可以輸出 Prometheus 文字格式。"""
+
+    def __init__(self, buckets: tuple = LATENCY_BUCKETS_S):
+        self.buckets = buckets
+        self._hist = {}  # stage → [每桶次數..., 總和, 次數]
+        self._lock = threading.Lock()
+
+    def _observe(self, stage: str, seconds: float) -> None:
+        h = self._hist.get(stage)
+        if h is None:
+            h = self._hist[stage] = [0] * len(self.buckets) + [0.0, 0]
+        for i, le in enumerate(self.buckets):
+            if seconds <= le:
+                h[i] += 1
+                break
+        h[-2] += seconds
+        h[-1] += 1
+
+    def record(self, trace: TurnTrace, total: float) -> None:
+        with self._lock:
+            for stage, seconds in trace.stages.items():
+                self._observe(stage, seconds)
+            self._observe("total", total)
+
+    def snapshot(self) -> dict:
+        """返回 {stage: {"count", "mean_ms", "buckets"}}（buckets 係累積次數）。"""
+        out = {}
+        with self._lock:
+            for stage, h in self._hist.items():
+                cumulative, running = [], 0
+                for n in h[:len(self.buckets)]:
+                    running += n
+                    cumulative.append(running)
+                out[stage] = {
+                    "count": h[-1],
+                    "mean_ms": round(h[-2] / h[-1] * 1000, 3) if h[-1] else 0.0,
+                    "buckets": dict(zip(self.buckets, cumulative)),
+                }
+        return out
+
+    def prometheus_text(self, name: str = "salon_turn_stage_seconds") -> str:
+        """Prometheus text exposition 格式。"""
+        lines = [
+            f"# HELP {name} Per-stage latency of generate_reply turns.",
+            f"# TYPE {name} histogram",
+        ]
+        for stage, snap in sorted(self.snapshot().items()):
+            for le, n in snap["buckets"].items():
+                lines.append(f'{name}_bucket{{stage="{stage}",le="{le}"}} {n}')
+            lines.append(f'{name}_bucket{{stage="{stage}",le="+Inf"}} {snap["count"]}')
+            with self._lock:
+                total = self._hist[stage][-2]
+            lines.append(f'{name}_sum{{stage="{stage}"}} {total}')
+            lines.append(f'{name}_count{{stage="{stage}"}} {snap["count"]}')
+        return "\n".join(lines) + "\n"
+
+
+class JsonlTraceSink:
+    """每輪寫一行 JSON（trace_id、出口路線、各階段毫秒數）。"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def record(self, trace: TurnTrace, total: float) -> None:
+        line = json.dumps(trace.to_dict(total), ensure_ascii=False)
+        with self._lock:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(line + "\n")
+
+
+def _sink_from_config(spec: str):
+    if not spec:
+        return None
+    if spec == "memory":
+        return LatencyHistogramSink()
+    if spec.startswith("jsonl:"):
+        return JsonlTraceSink(spec[len("jsonl:"):])
+    raise ValueError(f"唔識嘅 TRACE_SINK：{spec}")
+
+
+_trace_sink = _sink_from_config(TRACE_SINK)
+
+
+def set_trace_sink(sink) -> None:
+    """安裝追蹤 sink（要有 record(trace, total) 方法）；傳 None 即關閉。"""
+    global _trace_sink
+    _trace_sink = sink
+
+
+def get_trace_sink():
+    return _trace_sink
+
+
+def _start_trace():
+    return TurnTrace() if _trace_sink is not None else None
+
+
+def _end_trace(trace, outcome: str) -> None:
+    if trace is None:
+        return
+    trace.outcome = outcome
+    sink = _trace_sink
+    if sink is not None:
+        sink.record(trace, trace.total())
+
+
+# ==================== 出口路線計數 ====================
+
+# generate_reply 嘅出口路線（quick_no_rule 係中途事件：揀咗快速路由但冇規則，之後照問 LLM）
+TURN_OUTCOMES = (
+    "empty_input",
+    "quick_rule",
+    "quick_no_rule",
+    "cache_hit",
+    "semantic_cache_hit",
+    "llm_success",
+    "llm_empty",
+    "llm_cancelled",
+    "timeout_fallback",
+    "error_fallback",
+    "breaker_open",
+    "rate_limited",
+    "degraded_rules",
+)
+
+# 需要問 LLM 嘅出口，同埋每個出口對熔斷器嚟講算唔算成功（None = 唔計）
+LLM_OUTCOMES = {
+    "llm_success": True,
+    "llm_empty": True,
+    "llm_cancelled": None,
+    "timeout_fallback": False,
+    "error_fallback": False,
+    "breaker_open": None,
+    "rate_limited": None,
+    "degraded_rules": None,
+}
+
+# 冇真正問過 LLM 嘅出口（熔斷器唔使記錄）
+LLM_SKIPPED_OUTCOMES = frozenset({"breaker_open", "degraded_rules"})
+
+
+class TurnCounters:
+    """每個出口路線嘅計數，按命中意圖細分；一直開住，可以喺程序內讀或者匯出。"""
+
+    def __init__(self):
+        self._counts = {}  # (outcome, intent) → 次數
+        self._lock = threading.Lock()
+
+    def incr(self, outcome: str, intent: str) -> None:
+        key = (outcome, intent)
+        with self._lock:
+            self._counts[key] = self._counts.get(key, 0) + 1
+
+    def snapshot(self) -> dict:
+        """返回 {outcome: {intent: 次數}}。"""
+        out = {}
+        with self._lock:
+            for (outcome, intent), n in self._counts.items():
+                out.setdefault(outcome, {})[intent] = n
+        return out
+
+    def totals(self) -> dict:
+        """返回 {outcome: 次數}（所有 TURN_OUTCOMES 都有，未發生過係 0）。"""
+        out = dict.fromkeys(TURN_OUTCOMES, 0)
+        with self._lock:
+            for (outcome, _), n in self._counts.items():
+                out[outcome] = out.get(outcome, 0) + n
+        return out
+
+    def llm_fallback_rate(self) -> float:
+        """需要問 LLM 嘅輪數佔有效輪數（唔計空輸入）嘅比例。"""
+        t = self.totals()
+        answered = sum(t.values()) - t["empty_input"] - t["quick_no_rule"]
+        llm = sum(t[k] for k in LLM_OUTCOMES)
+        return llm / answered if answered else 0.0
+
+    def prometheus_text(self, name: str = "salon_turn_outcomes_total") -> str:
+        lines = [
+            f"# HELP {name} generate_reply exits by outcome and matched intent.",
+            f"# TYPE {name} counter",
+        ]
+        with self._lock:
+            items = sorted(self._counts.items())
+        for (outcome, intent), n in items:
+            lines.append(f'{name}{{outcome="{outcome}",intent="{intent}"}} {n}')
+        return "\n".join(lines) + "\n"
+
+    def reset(self) -> None:
+        with self._lock:
+            self._counts.clear()
+
+
+turn_counters = TurnCounters()
+
+
+def metrics_snapshot() -> dict:
+    """一次過讀晒程序內嘅計數（出口路線、快取、串流、對沖、請求合併、熔斷器、配額、降級模式）。"""
+    return {
+        "turn_outcomes": turn_counters.snapshot(),
+        "turn_totals": turn_counters.totals(),
+        "llm_fallback_rate": turn_counters.llm_fallback_rate(),
+        "response_cache": response_cache.stats(),
+        "semantic_cache": semantic_cache.stats(),
+        "stream": stream_stats(),
+        "hedge": hedge_stats(),
+        "single_flight": llm_single_flight.stats(),
+        "llm_breaker": llm_breaker.stats(),
+        "llm_rate_limiter": llm_rate_limiter.stats() if llm_rate_limiter is not None else None,
+        "degraded_mode": degraded_mode.stats(),
+    }
+
+
+def _end_turn(turn, outcome: str, leader: bool = True) -> None:
+    """
+    每個出口都要經呢度：計數、更新熔斷器，開咗追蹤就交俾 sink。
+    single-flight 跟住等結果嘅 caller（leader=False）冇自己問過上游，
+    只記 None 釋放探測名額，唔好將同一次超時記成幾次失敗。
+    """
+    turn_counters.incr(outcome, turn.intent.value)
+    if outcome in LLM_OUTCOMES and outcome not in LLM_SKIPPED_OUTCOMES:
+        llm_breaker.record(LLM_OUTCOMES[outcome] if leader else None)
+    _end_trace(turn.trace, outcome)
 
 
 # ==================== 【主函數】generate_reply ====================
 
-def generate_reply(user_text: str, current_state: dict) -> tuple[str, dict]:
+EMPTY_INPUT_REPLY = "唔好意思，我頭先好似聽唔清楚，可以再講多次嗎？"
+EMPTY_LLM_REPLY = "唔好意思，我暫時回應唔到，可以重新講嗎？"
+BUSY_REPLY = "系統暫時繁忙，可以稍後再試嗎？"
+ERROR_REPLY = "唔好意思，出咗啲技術問題，可以再講一次嗎？"
+
+
+class _PreparedTurn(NamedTuple):
+    state: dict
+    reply: str  # 非空 = 已經有答案（空輸入 / 快速路由 / 快取），唔使問 LLM
+    user_text: str = ""
+    prompt: str = ""
+    cache_key: tuple = ()
+    outcome: str = ""  # 唔使問 LLM 時嘅出口路線
+    trace: TurnTrace = None
+    intent: Intent = Intent.UNKNOWN
+
+
+def _prepare_turn(user_text: str, current_state: dict) -> _PreparedTurn:
+    """
+    同步 / 非同步版本共用：更新狀態、快速路由、查快取，
+    需要問 LLM 先砌好 prompt。
+    """
+    trace = _start_trace()
+    if not user_text:
+        return _PreparedTurn(
+            current_state, EMPTY_INPUT_REPLY, outcome="empty_input", trace=trace, intent=Intent.UNKNOWN
+        )
+
+    # 🔹 第一步：標準化一次（數字、全形、大細楷），之後所有匹配都用呢個版本
+    raw_text = user_text
+    user_text = normalize_utterance(user_text)
+
+    # 掃描一次關鍵字（連子句訊號，更正用），更新狀態
+    signals, clauses = scan_signal_clauses(user_text)
+    new_state = update_conversation_state(current_state, user_text, signals, clauses=clauses)
+    new_state["turns"] = (current_state.get("turns") or 0) + 1
+    signals = signals | _slot_signals(current_state, new_state)
+    if trace is not None:
+        trace.mark("state")
+
+    # 🔹 第二步：單次分類，有規則可答就行快速路由（最快，無 LLM 延遲）
+    turn = classify_turn(user_text, new_state, signals)
+    new_state["booking_stage"] = turn.stage.value
+    if trace is not None:
+        trace.mark("routing")
+    intent = turn.intent
+    if turn.reply:
+        return _PreparedTurn(new_state, turn.reply, outcome="quick_rule", trace=trace, intent=intent)
+    if intent is not Intent.UNKNOWN:
+        # 理論上唔會發生（classify_turn 保證有意圖就有規則），計數用嚟報警
+        turn_counters.incr("quick_no_rule", intent.value)
+
+    # 🔹 第三步：同樣問題問過 LLM 就直接用返快取
+    cache_key = _response_cache_key(user_text, new_state)
+    cached = response_cache.get(cache_key)
+    if cached:
+        if trace is not None:
+            trace.mark("cache")
+        return _PreparedTurn(new_state, cached, outcome="cache_hit", trace=trace, intent=intent)
+
+    # 講法唔同但意思相近 → 用相似度快取
+    cached = semantic_cache.lookup(user_text, cache_key[1:])
+    if trace is not None:
+        trace.mark("cache")
+    if cached:
+        response_cache.put(cache_key, cached)
+        return _PreparedTurn(new_state, cached, outcome="semantic_cache_hit", trace=trace, intent=intent)
+
+    memory_ctx = build_memory_context(new_state)
+    prompt = (
+        f"{memory_ctx}"
+        f"客人：「{raw_text.strip()}」\n你："
+    )
+    return _PreparedTurn(new_state, "", user_text, prompt, cache_key, trace=trace, intent=intent)
+
+
+def _finish_llm_reply(turn: _PreparedTurn, reply_text: str) -> str:
+    """LLM 回覆套用硬規則過濾並寫入快取；無內容就返回空字串。"""
+    if not reply_text:
+        return ""
+
+    # 套用硬規則過濾
+    reply_text = apply_hard_rules_to_reply(reply_text, turn.state)
+    if turn.trace is not None:
+        turn.trace.mark("hard_rules")
+    _store_llm_reply(turn, reply_text)
+    return reply_text
+
+
+def _store_llm_reply(turn: _PreparedTurn, reply_text: str) -> None:
+    # LLM 即場回覆未經審核，唔入相似度快取；叫咗客人名嘅回覆唔入任何快取（key 只記有冇名，會俾咗第個客）
+    name = turn.state.get("customer_name")
+    if name and name in reply_text:
+        return
+    response_cache.put(turn.cache_key, reply_text)
+
+
+def _llm_unavailable_reply(turn: _PreparedTurn) -> str:
+    """唔問 LLM 時嘅即時後備回覆（降級 / 熔斷中 / 配額等唔切）。"""
+    return degraded_rule_reply(turn.user_text, turn.state)
+
+
+def _skip_llm_outcome() -> str:
+    """今輪要唔要跳過 LLM：返回出口路線（降級 / 熔斷），可以問就返回空字串。"""
+    if degraded_mode.active:
+        return "degraded_rules"
+    if not llm_breaker.allow():
+        return "breaker_open"
+    return ""
+
+
+def _generate_llm(prompt: str, priority: int = PRIORITY_LIVE, rank: tuple = ()) -> str:
+    """問一次 LLM（先排隊攞配額，自適應超時，開咗就對沖）。"""
+    backend = get_llm_backend()
+    timeout_s = _acquire_llm_quota(llm_timeout_s(backend), priority, rank)
+    if LLM_HEDGE:
+        hedge = get_hedge_backend()
+        response = _call_hedged(lambda: backend.generate(prompt), lambda: hedge.generate(prompt), timeout_s)
+    else:
+        response = _call_with_deadline(lambda: backend.generate(prompt), timeout_s)
+    reply_lengths.record(estimate_tokens(response))
+    return response
+
+
+async def _agenerate_llm(prompt: str, priority: int = PRIORITY_LIVE, rank: tuple = ()) -> str:
+    """_generate_llm 嘅 asyncio 版本。"""
+    backend = get_llm_backend()
+    timeout_s = await _aacquire_llm_quota(llm_timeout_s(backend), priority, rank)
+    if LLM_HEDGE:
+        hedge = get_hedge_backend()
+        response = await _acall_hedged(lambda: backend.agenerate(prompt), lambda: hedge.agenerate(prompt), timeout_s)
+    else:
+        response = await asyncio.wait_for(_atimed(backend.agenerate(prompt)), timeout=timeout_s)
+    reply_lengths.record(estimate_tokens(response))
+    return response
+
+
+def generate_reply(user_text: str, current_state: dict, priority: int = PRIORITY_LIVE) -> tuple[str, dict]:
     """
     主函數：根據用戶輸入生成回覆。
     返回 (回覆文字, 更新後嘅狀態)
+    背景工作用 priority=PRIORITY_BACKGROUND，LLM 配額唔夠時讓即場來電先。
     
     流程：
     1. 更新狀態
-    2. 嘗試快速路由（70% 情況）
-    3. 若快速路由無效，才問 LLM
+    2. 嘗試快速路由（回放語料約 63% 輪次喺呢度答完）
+    3. 查 LLM 回覆快取（精確 → 相似度）
+    4. 若快速路由無效，才問 LLM
     """
-    if not user_text:
-        return "唔好意思，我頭先好似聽唔清楚，可以再講多次嗎？", current_state
+    turn = _prepare_turn(user_text, current_state)
+    if turn.reply:
+        _end_turn(turn, turn.outcome)
+        return turn.reply, turn.state
+    skip = _skip_llm_outcome()
+    if skip:
+        # 降級模式 / LLM 熔斷中 → 即刻用規則回覆，唔使等超時
+        _end_turn(turn, skip)
+        return _llm_unavailable_reply(turn), turn.state
+
+    # 🔹 第四步：若快速路由無效，問 LLM（複雜對話）；配額排隊時預約做到一半嘅對話排先
+    rank = conversation_queue_rank(turn.state)
+    led = []  # 真正執行咗上游請求先會有嘢，即係今輪係 single-flight 嘅 leader
+    try:
+        if LLM_SINGLE_FLIGHT:
+            response = llm_single_flight.do(
+                turn.prompt, lambda: led.append(True) or _generate_llm(turn.prompt, priority, rank)
+            )
+        else:
+            led.append(True)
+            response = _generate_llm(turn.prompt, priority, rank)
+        if turn.trace is not None:
+            turn.trace.mark("llm")
+        reply_text = _finish_llm_reply(turn, response)
+        outcome = "llm_success" if reply_text else "llm_empty"
+        reply_text = reply_text or EMPTY_LLM_REPLY
+
+    except LLMRateLimitedError:
+        # 配額等唔切 → 提早降級，唔使等到超時
+        outcome, reply_text = "rate_limited", _llm_unavailable_reply(turn)
+
+    except (FuturesTimeoutError, LLMSaturatedError):
+        # LLM 超時 / 孤兒請求太多 → 後備回覆（有規則可答嘅句子已經喺第二步處理）
+        outcome, reply_text = "timeout_fallback", BUSY_REPLY
+
+    except Exception as e:
+        print(f"❌ LLM 錯誤：{e}")
+        outcome, reply_text = "error_fallback", ERROR_REPLY
 
-    # 🔹 第一步：更新狀態
-    new_state = update_conversation_state(current_state, user_text)
+    _end_turn(turn, outcome, leader=bool(led))
+    return reply_text, turn.state
 
-    # 🔹 第二步：嘗試快速路由（最快，無 LLM 延遲）
-    if _should_use_quick_path(user_text, new_state):
-        fast_reply = quick_rule_reply(user_text, new_state)
-        if fast_reply:
-            return fast_reply, new_state
 
-    # 🔹 第三步：若快速路由無效，問 LLM（複雜對話）
+async def agenerate_reply(user_text: str, current_state: dict, priority: int = PRIORITY_LIVE) -> tuple[str, dict]:
+    """
+    generate_reply 嘅 asyncio 版本：路由、狀態同過濾邏輯完全共用，
+    LLM 用非同步 transport，唔使每輪佔一條線程。
+    Task 被 cancel 時 CancelledError 會照樣拋出，上游請求亦會一齊取消。
+    """
+    turn = _prepare_turn(user_text, current_state)
+    if turn.reply:
+        _end_turn(turn, turn.outcome)
+        return turn.reply, turn.state
+    skip = _skip_llm_outcome()
+    if skip:
+        _end_turn(turn, skip)
+        return _llm_unavailable_reply(turn), turn.state
+
+    rank = conversation_queue_rank(turn.state)
+    led = []
     try:
-        def _call_gemini():
-            memory_ctx = build_memory_context(new_state)
-            prompt = (
-                f"{memory_ctx}"
-                f"客人：「{user_text}」\n你："
-            )
-            return gemini_model.generate_content(
-                prompt,
-                generation_config=GEN_CONFIG,
-                request_options={"timeout":  GEMINI_TIMEOUT_S},
+        if LLM_SINGLE_FLIGHT:
+            response = await llm_single_flight.ado(
+                turn.prompt, lambda: led.append(True) or _agenerate_llm(turn.prompt, priority, rank)
             )
+        else:
+            led.append(True)
+            response = await _agenerate_llm(turn.prompt, priority, rank)
+        if turn.trace is not None:
+            turn.trace.mark("llm")
+        reply_text = _finish_llm_reply(turn, response)
+        outcome = "llm_success" if reply_text else "llm_empty"
+        reply_text = reply_text or EMPTY_LLM_REPLY
 
-        with ThreadPoolExecutor(max_workers=1) as ex:
-            fut = ex.submit(_call_gemini)
-            response = fut.result(timeout=GEMINI_TIMEOUT_S)
+    except LLMRateLimitedError:
+        outcome, reply_text = "rate_limited", _llm_unavailable_reply(turn)
 
-        reply_text = _extract_text_from_response(response)
+    except asyncio.TimeoutError:
+        outcome, reply_text = "timeout_fallback", BUSY_REPLY
 
-        if reply_text: 
-            # 套用硬規則過濾
-            reply_text = apply_hard_rules_to_reply(reply_text, new_state)
-            return reply_text, new_state
+    except Exception as e:
+        print(f"❌ LLM 錯誤：{e}")
+        outcome, reply_text = "error_fallback", ERROR_REPLY
 
-        return "唔好意思，我暫時回應唔到，可以重新講嗎？", new_state
+    _end_turn(turn, outcome, leader=bool(led))
+    return reply_text, turn.state
 
-    except FuturesTimeoutError:
-        # LLM 超時 → 用快速後備回覆
-        fallback = quick_rule_reply(user_text, new_state)
-        return fallback or "系統暫時繁忙，可以稍後再試嗎？", new_state
+
+# ==================== 串流回覆（逐句輸出） ====================
+
+# tokens_saved：按完整回覆長度估算；tokens_saved_upper_bound：當每次都會生成到 GEMINI_MAX_TOKENS 嘅上限
+_stream_counters = {"llm_streams": 0, "early_stops": 0, "tokens_saved": 0, "tokens_saved_upper_bound": 0}
+_stream_counters_lock = threading.Lock()
+
+
+class ReplyLengthTracker(LatencyTracker):
+    """最近 window 個冇截斷嘅 LLM 回覆長度（token），用嚟估算提早停止慳咗幾多 token。"""
+
+    def expected_remaining(self, generated: int) -> int:
+        """
+        已經生成咗 generated 個 token 嘅回覆平均仲會再生成幾多：
+        只睇比 generated 長嘅完整回覆；樣本唔夠或者冇咁長嘅回覆就返回 0（寧願少報）。
+        """
+        with self._lock:
+            if len(self._samples) < self.min_samples:
+                return 0
+            longer = [n for n in self._samples if n > generated]
+        if not longer:
+            return 0
+        return round(sum(longer) / len(longer)) - generated
+
+
+reply_lengths = ReplyLengthTracker()
+
+
+def stream_stats() -> dict:
+    """返回串流回覆嘅計數（提早停止次數、估算慳咗嘅 token）。"""
+    with _stream_counters_lock:
+        return dict(_stream_counters)
+
+
+def _count_stream(name: str, n: int = 1) -> None:
+    with _stream_counters_lock:
+        _stream_counters[name] += n
+
+
+def _budget_reached(emitted: list) -> bool:
+    return REPLY_MAX_SENTENCES > 0 and len(emitted) >= REPLY_MAX_SENTENCES
+
+
+def _record_early_stop(generated: int) -> None:
+    # generated 係已收到嘅 token（estimate_tokens 本地估算，唔使逐段問後端）
+    _count_stream("early_stops")
+    ceiling = max(0, GEMINI_MAX_TOKENS - generated)
+    _count_stream("tokens_saved", min(reply_lengths.expected_remaining(generated), ceiling))
+    _count_stream("tokens_saved_upper_bound", ceiling)
+
+
+def _speakable(sentences: list) -> list:
+    """已批准嘅句子再過 sanitize_tts_text，淨化後冇內容就唔要。"""
+    out = []
+    for sentence in sentences:
+        sentence = sanitize_tts_text(sentence)
+        if sentence:
+            out.append(sentence)
+    return out
+
+
+def _stream_total_s(backend, adaptive_s: float, first_chunk_s: float) -> float:
+    """
+    串流整體期限。第一個 chunk 用自適應超時 adaptive_s（排隊後剩低 first_chunk_s），
+    之後成段串流最長可以用到後端自己嘅 timeout_s，同樣扣除排咗隊嘅時間。
+    """
+    return max(first_chunk_s, backend.timeout_s - (adaptive_s - first_chunk_s))
+
+
+def _llm_sentence_stream(turn: _PreparedTurn):
+    """
+    逐句 yield 已過濾嘅 LLM 回覆；一句都未講就出錯 / 超時，改為 yield 後備回覆。
+    批准咗 REPLY_MAX_SENTENCES 句就即刻停止上游生成。
+    """
+    emitted = []
+    generated = 0
+    trace = turn.trace
+    outcome = "llm_cancelled"  # 消費端中途放棄
+
+    rules = HardRuleStreamFilter(turn.state)
+    _count_stream("llm_streams")
+    try:
+        backend = get_llm_backend()
+        adaptive_s = llm_timeout_s(backend)
+        first_chunk_s = _acquire_llm_quota(adaptive_s, PRIORITY_LIVE, conversation_queue_rank(turn.state))
+        timeout_s = _stream_total_s(backend, adaptive_s, first_chunk_s)
+        open_stream = lambda: backend.stream(turn.prompt)  # noqa: E731
+        with closing(_stream_with_deadline(open_stream, timeout_s, first_chunk_s)) as chunks:
+            for text in chunks:
+                if trace is not None:
+                    trace.mark("llm")
+                generated += estimate_tokens(text)
+                approved = rules.feed(text)
+                if trace is not None:
+                    trace.mark("hard_rules")
+                for sentence in _speakable(approved):
+                    if trace is not None:
+                        trace.mark("sanitize")
+                    emitted.append(sentence)
+                    yield sentence
+                    if trace is not None:
+                        trace.skip()
+                    if _budget_reached(emitted):
+                        break
+                if _budget_reached(emitted):
+                    _record_early_stop(generated)
+                    break
+            else:
+                reply_lengths.record(generated)
+                for sentence in _speakable(rules.flush()):
+                    emitted.append(sentence)
+                    yield sentence
+
+        if not emitted:
+            outcome = "llm_empty"
+            yield EMPTY_LLM_REPLY
+            return
+        outcome = "llm_success"
+        _store_llm_reply(turn, "".join(emitted))
+
+    except LLMRateLimitedError:
+        outcome = "rate_limited"
+        yield _llm_unavailable_reply(turn)
+
+    except (FuturesTimeoutError, LLMSaturatedError):
+        outcome = "timeout_fallback"
+        if not emitted:
+            yield BUSY_REPLY
+
+    except Exception as e:
+        print(f"❌ LLM 錯誤：{e}")
+        outcome = "error_fallback"
+        if not emitted:
+            yield ERROR_REPLY
+
+    finally:
+        _end_turn(turn, outcome)
+
+
+def generate_reply_stream(user_text: str, current_state: dict):
+    """
+    串流版 generate_reply：返回 (句子 iterator, 更新後嘅狀態)。
+    LLM 每講完一句，過完硬規則同 sanitize_tts_text 就即刻 yield，
+    TTS 可以喺模型仲生成緊嗰陣開始讀第一句；夠 REPLY_MAX_SENTENCES 句就停止生成。
+    快速路由 / 快取命中就直接 yield 成句回覆。
+    """
+    turn = _prepare_turn(user_text, current_state)
+    if turn.reply:
+        _end_turn(turn, turn.outcome)
+        return iter((turn.reply,)), turn.state
+    skip = _skip_llm_outcome()
+    if skip:
+        _end_turn(turn, skip)
+        return iter((_llm_unavailable_reply(turn),)), turn.state
+    return _llm_sentence_stream(turn), turn.state
+
+
+async def _allm_sentence_stream(turn: _PreparedTurn):
+    """_llm_sentence_stream 嘅 asyncio 版本。"""
+    loop = asyncio.get_running_loop()
+    emitted = []
+    generated = 0
+    trace = turn.trace
+    outcome = "llm_cancelled"
+    rules = HardRuleStreamFilter(turn.state)
+    chunks = None
+    _count_stream("llm_streams")
+
+    try:
+        backend = get_llm_backend()
+        adaptive_s = llm_timeout_s(backend)
+        first_chunk_s = await _aacquire_llm_quota(adaptive_s, PRIORITY_LIVE, conversation_queue_rank(turn.state))
+        timeout_s = _stream_total_s(backend, adaptive_s, first_chunk_s)
+        deadline = loop.time() + timeout_s
+        wait_until = min(deadline, loop.time() + first_chunk_s)
+        chunks = backend.astream(turn.prompt)
+        while True:
+            remaining = wait_until - loop.time()
+            if remaining <= 0:
+                raise asyncio.TimeoutError()
+            try:
+                text = await asyncio.wait_for(chunks.__anext__(), timeout=remaining)
+            except StopAsyncIteration:
+                reply_lengths.record(generated)
+                for sentence in _speakable(rules.flush()):
+                    emitted.append(sentence)
+                    yield sentence
+                break
+            wait_until = deadline
+            if trace is not None:
+                trace.mark("llm")
+            generated += estimate_tokens(text)
+            approved = rules.feed(text)
+            if trace is not None:
+                trace.mark("hard_rules")
+            for sentence in _speakable(approved):
+                if trace is not None:
+                    trace.mark("sanitize")
+                emitted.append(sentence)
+                yield sentence
+                if trace is not None:
+                    trace.skip()
+                if _budget_reached(emitted):
+                    break
+            if _budget_reached(emitted):
+                # 夠句數 → finally 會 aclose 上游串流
+                _record_early_stop(generated)
+                break
+
+        if not emitted:
+            outcome = "llm_empty"
+            yield EMPTY_LLM_REPLY
+            return
+        outcome = "llm_success"
+        _store_llm_reply(turn, "".join(emitted))
+
+    except LLMRateLimitedError:
+        outcome = "rate_limited"
+        yield _llm_unavailable_reply(turn)
+
+    except asyncio.TimeoutError:
+        outcome = "timeout_fallback"
+        if not emitted:
+            yield BUSY_REPLY
 
     except Exception as e:
         print(f"❌ LLM 錯誤：{e}")
-        fallback = quick_rule_reply(user_text, new_state)
-        return fallback or "唔好意思，出咗啲技術問題，可以再講一次嗎？", new_state
+        outcome = "error_fallback"
+        if not emitted:
+            yield ERROR_REPLY
+
+    finally:
+        _end_turn(turn, outcome)
+        aclose = getattr(chunks, "aclose", None)
+        if aclose is not None:
+            await aclose()
+
+
+async def _aiter_one(text: str):
+    yield text
+
+
+def agenerate_reply_stream(user_text: str, current_state: dict):
+    """
+    asyncio 串流版：返回 (句子 async iterator, 更新後嘅狀態)。
+    消費端 aclose() 或者 task 被 cancel，上游串流會一齊關閉。
+    """
+    turn = _prepare_turn(user_text, current_state)
+    if turn.reply:
+        _end_turn(turn, turn.outcome)
+        return _aiter_one(turn.reply), turn.state
+    skip = _skip_llm_outcome()
+    if skip:
+        _end_turn(turn, skip)
+        return _aiter_one(_llm_unavailable_reply(turn)), turn.state
+    return _allm_sentence_stream(turn), turn.state
 
 
 # ==================== 【輔助函數】重置記憶 ====================
@@ -341,7 +3066,14 @@ def reset_memory() -> dict:
     """重置對話狀態（供 Flask /api/reset 端點使用）"""
     return {
         "treatment": None,
-        "booking_time": None,
+        "booking_time": None,  # 標準讀法，例如「10月19號 星期一 下晝3點半」
+        "booking_start": None,  # ISO 時間
+        "booking_end": None,  # ISO 時間（準確時間 = booking_start）
+        "customer_name": None,  # 「陳小姐」「陳大文」
+        "phone": None,  # 「9123 4567」
+        "booking_stage": BookingStage.GREETING.value,
+        "bookings": [],  # 今次通話之前確認咗嘅預約（「約多個」時存檔）
+        "turns": 0,  # 客人講咗幾多輪（LLM 配額排隊用）
     }
 
 
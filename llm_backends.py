@@ -0,0 +1,375 @@
+# ========================================
+# LLM 後端介面
+# ========================================
+# 功能：
+# - LLMBackend：generate / stream / count_tokens（同步 + asyncio）
+# - GeminiBackend：Google Gemini（google-generativeai）
+# - OpenAICompatibleBackend：任何 OpenAI 兼容 HTTP endpoint（包括本地 server）
+# - StubBackend：確定性本地假後端（壓力測試用，唔使網絡）
+# - create_backend()：由設定揀後端，每個後端有自己嘅超時
+
+import os
+import re
+import json
+import time
+import zlib
+import asyncio
+import threading
+from typing import AsyncIterator, Iterator, Protocol
+
+# 每個後端嘅超時（秒）
+GEMINI_TIMEOUT_S = float(os.getenv("GEMINI_TIMEOUT_S", "5"))
+OPENAI_TIMEOUT_S = float(os.getenv("OPENAI_TIMEOUT_S", "5"))
+STUB_TIMEOUT_S = float(os.getenv("STUB_TIMEOUT_S", "5"))
+
+# OpenAI 兼容 endpoint
+OPENAI_API_KEY = os.getenv("OPENAI_API_KEY", "")
+OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL", "https://api.openai.com/v1")
+OPENAI_MODEL_NAME = os.getenv("MODEL_NAME", "gpt-4o-mini")
+
+# 假後端延遲（毫秒）
+STUB_LATENCY_MS = float(os.getenv("STUB_LATENCY_MS", "0"))
+
+
+class LLMBackend(Protocol):
+    """
+    LLM 後端介面。所有方法返回 / yield 純文字，唔會返回 SDK 物件。
+    stream / astream yield 原文片段（唔 strip，避免英文字黐埋）。
+    """
+
+    name: str
+    timeout_s: float
+
+    def generate(self, prompt: str) -> str: ...
+
+    def stream(self, prompt: str) -> Iterator[str]: ...
+
+    async def agenerate(self, prompt: str) -> str: ...
+
+    def astream(self, prompt: str) -> AsyncIterator[str]: ...
+
+    def count_tokens(self, text: str) -> int: ...
+
+
+_ASCII_WORD_RE = re.compile(r"[A-Za-z0-9]+")
+
+
+def estimate_tokens(text: str) -> int:
+    """本地粗略估算 token：英文 / 數字每個字算一個，其餘（中文）每個字算一個。"""
+    if not text:
+        return 0
+    words = _ASCII_WORD_RE.findall(text)
+    others = len(_ASCII_WORD_RE.sub("", text).replace(" ", ""))
+    return len(words) + others
+
+
+# ==================== Gemini ====================
+
+def _extract_text_from_response(response) -> str:
+    """安全抽取 Gemini 回應"""
+    try:
+        if hasattr(response, "text") and response.text:
+            return response.text. strip()
+    except Exception:
+        pass
+
+    try:
+        for cand in getattr(response, "candidates", []):
+            for part in getattr(cand, "content", {}).parts:
+                if hasattr(part, "text") and part.text:
+                    return part.text.strip()
+    except Exception:
+        pass
+
+    return ""
+
+
+def _chunk_text(chunk) -> str:
+    """抽取串流 chunk 嘅原文"""
+    try:
+        return chunk.text or ""
+    except Exception:
+        return ""
+
+
+# genai.configure 設定咗嘅 key（全域，見 GeminiBackend）
+_gemini_api_key = None
+_gemini_lock = threading.Lock()
+
+
+class GeminiBackend:
+    """Google Gemini。建立時先 import SDK 同檢查 API key。"""
+
+    name = "gemini"
+
+    def __init__(
+        self,
+        system_prompt: str,
+        max_tokens: int,
+        temperature: float,
+        top_p: float,
+        timeout_s: float = GEMINI_TIMEOUT_S,
+        model_name: str = None,
+        api_key: str = None,
+    ):
+        api_key = api_key or os.getenv("GEMINI_API_KEY")
+        if not api_key:
+            raise RuntimeError("❌ 請先設定環境變數 GEMINI_API_KEY")
+
+        import google.generativeai as genai
+
+        # 設定 Gemini：genai.configure 係成個 process 共用嘅，
+        # 第二個後端換 key 會連已經建好嘅後端都一齊換走，所以唔俾用第二條 key
+        global _gemini_api_key
+        with _gemini_lock:
+            if _gemini_api_key is not None and api_key != _gemini_api_key:
+                raise RuntimeError("❌ google-generativeai 一個 process 只可以用一條 API key（對沖請求唔好另設 LLM_HEDGE_API_KEY）")
+            if os.getenv("HTTPS_PROXY"):
+                genai.configure(api_key=api_key, transport="rest")
+            else:
+                genai.configure(api_key=api_key)
+            _gemini_api_key = api_key
+
+        self.timeout_s = timeout_s
+        self.generation_config = genai.GenerationConfig(
+            max_output_tokens=max_tokens,
+            temperature=temperature,
+            top_p=top_p,
+        )
+        self.model = genai.GenerativeModel(
+            model_name=model_name or os.getenv("GEMINI_MODEL_NAME", "gemini-1.5-flash"),
+            system_instruction=system_prompt,
+        )
+
+    def _kwargs(self) -> dict:
+        return {
+            "generation_config": self.generation_config,
+            "request_options": {"timeout": self.timeout_s},
+        }
+
+    def generate(self, prompt: str) -> str:
+        return _extract_text_from_response(self.model.generate_content(prompt, **self._kwargs()))
+
+    def stream(self, prompt: str) -> Iterator[str]:
+        for chunk in self.model.generate_content(prompt, stream=True, **self._kwargs()):
+            text = _chunk_text(chunk)
+            if text:
+                yield text
+
+    async def agenerate(self, prompt: str) -> str:
+        response = await self.model.generate_content_async(prompt, **self._kwargs())
+        return _extract_text_from_response(response)
+
+    async def astream(self, prompt: str) -> AsyncIterator[str]:
+        response = await self.model.generate_content_async(prompt, stream=True, **self._kwargs())
+        async for chunk in response:
+            text = _chunk_text(chunk)
+            if text:
+                yield text
+
+    def count_tokens(self, text: str) -> int:
+        return self.model.count_tokens(text).total_tokens
+
+
+# ==================== OpenAI 兼容 HTTP ====================
+
+_STREAM_END = object()
+
+
+class OpenAICompatibleBackend:
+    """
+    任何 OpenAI 兼容嘅 /chat/completions endpoint（OpenAI、本地 vLLM / llama.cpp server 等）。
+    用 requests 傳輸；asyncio 版本喺預設 executor 行同步請求。
+    """
+
+    name = "openai"
+
+    def __init__(
+        self,
+        system_prompt: str,
+        max_tokens: int,
+        temperature: float,
+        top_p: float,
+        timeout_s: float = OPENAI_TIMEOUT_S,
+        base_url: str = OPENAI_BASE_URL,
+        model_name: str = OPENAI_MODEL_NAME,
+        api_key: str = OPENAI_API_KEY,
+    ):
+        import requests
+
+        self._session = requests.Session()
+        if api_key:
+            self._session.headers["Authorization"] = f"Bearer {api_key}"
+        self.url = base_url.rstrip("/") + "/chat/completions"
+        self.timeout_s = timeout_s
+        self.system_prompt = system_prompt
+        self.model_name = model_name
+        self.max_tokens = max_tokens
+        self.temperature = temperature
+        self.top_p = top_p
+
+    def _payload(self, prompt: str, stream: bool) -> dict:
+        return {
+            "model": self.model_name,
+            "messages": [
+                {"role": "system", "content": self.system_prompt},
+                {"role": "user", "content": prompt},
+            ],
+            "max_tokens": self.max_tokens,
+            "temperature": self.temperature,
+            "top_p": self.top_p,
+            "stream": stream,
+        }
+
+    def generate(self, prompt: str) -> str:
+        resp = self._session.post(self.url, json=self._payload(prompt, False), timeout=self.timeout_s)
+        resp.raise_for_status()
+        choices = resp.json().get("choices") or []
+        if not choices:
+            return ""
+        return ((choices[0].get("message") or {}).get("content") or "").strip()
+
+    def stream(self, prompt: str) -> Iterator[str]:
+        # Server-Sent Events：每行 "data: {...}"，以 "data: [DONE]" 結束
+        with self._session.post(
+            self.url, json=self._payload(prompt, True), timeout=self.timeout_s, stream=True
+        ) as resp:
+            resp.raise_for_status()
+            for line in resp.iter_lines(decode_unicode=True):
+                if not line or not line.startswith("data:"):
+                    continue
+                data = line[len("data:"):].strip()
+                if data == "[DONE]":
+                    return
+                choices = json.loads(data).get("choices") or []
+                text = (choices[0].get("delta") or {}).get("content") if choices else None
+                if text:
+                    yield text
+
+    async def agenerate(self, prompt: str) -> str:
+        return await asyncio.get_running_loop().run_in_executor(None, self.generate, prompt)
+
+    async def astream(self, prompt: str) -> AsyncIterator[str]:
+        # 成個串流喺同一條 worker 線程讀同關：consumer 超時 / 取消只係 set stop，
+        # 唔會喺第二條線程 close 緊行緊嘅 generator（會 ValueError，HTTP 回應亦冇人關）
+        loop = asyncio.get_running_loop()
+        chunks = asyncio.Queue()
+        stop = threading.Event()
+
+        def _put(item) -> None:
+            try:
+                loop.call_soon_threadsafe(chunks.put_nowait, item)
+            except RuntimeError:
+                pass  # event loop 已經關咗，冇人收
+
+        def _produce() -> None:
+            it = self.stream(prompt)
+            try:
+                for text in it:
+                    if stop.is_set():
+                        break
+                    _put(text)
+                _put(_STREAM_END)
+            except BaseException as e:
+                _put(e)
+            finally:
+                it.close()  # 觸發 stream() 嘅 with，喺讀緊嘅線程關 HTTP 回應
+
+        loop.run_in_executor(None, _produce)
+        try:
+            while True:
+                item = await chunks.get()
+                if item is _STREAM_END:
+                    return
+                if isinstance(item, BaseException):
+                    raise item
+                yield item
+        finally:
+            stop.set()
+
+    def count_tokens(self, text: str) -> int:
+        return estimate_tokens(text)
+
+
+# ==================== 本地假後端 ====================
+
+STUB_REPLIES = (
+    "明白，我幫你記低。仲有冇其他可以幫到你？",
+    "我哋有位可以安排，到時見。",
+    "好呀，我會轉告同事跟進。多謝你嘅查詢。",
+)
+
+
+class StubBackend:
+    """
+    確定性本地假後端：同一個 prompt 永遠返回同一句回覆，延遲固定。
+    壓力測試 / 離線開發用，完全唔使網絡。
+    """
+
+    name = "stub"
+
+    def __init__(
+        self,
+        system_prompt: str = "",
+        max_tokens: int = 60,
+        temperature: float = 0.0,
+        top_p: float = 1.0,
+        timeout_s: float = STUB_TIMEOUT_S,
+        latency_ms: float = STUB_LATENCY_MS,
+        replies: tuple = STUB_REPLIES,
+        **_unused,
+    ):
+        # 其他後端嘅設定（api_key、model_name 等）對假後端冇意思，收咗唔理
+        self.timeout_s = timeout_s
+        self.latency_s = latency_ms / 1000.0
+        self.replies = replies
+        self.calls = 0
+
+    def _reply(self, prompt: str) -> str:
+        self.calls += 1
+        return self.replies[zlib.crc32(prompt.encode("utf-8")) % len(self.replies)]
+
+    @staticmethod
+    def _pieces(text: str, n: int = 4) -> list:
+        step = max(1, len(text) // n)
+        return [text[i:i + step] for i in range(0, len(text), step)]
+
+    def generate(self, prompt: str) -> str:
+        time.sleep(self.latency_s)
+        return self._reply(prompt)
+
+    def stream(self, prompt: str) -> Iterator[str]:
+        reply = self._reply(prompt)
+        time.sleep(self.latency_s)
+        yield from self._pieces(reply)
+
+    async def agenerate(self, prompt: str) -> str:
+        await asyncio.sleep(self.latency_s)
+        return self._reply(prompt)
+
+    async def astream(self, prompt: str) -> AsyncIterator[str]:
+        reply = self._reply(prompt)
+        await asyncio.sleep(self.latency_s)
+        for piece in self._pieces(reply):
+            yield piece
+
+    def count_tokens(self, text: str) -> int:
+        return estimate_tokens(text)
+
+
+BACKENDS = {
+    "gemini": GeminiBackend,
+    "openai": OpenAICompatibleBackend,
+    "stub": StubBackend,
+}
+
+
+def create_backend(name: str, system_prompt: str, max_tokens: int, temperature: float, top_p: float, **overrides):
+    """
+    按名建立後端（gemini / openai / stub）；超時等後端專屬設定由各自嘅環境變數讀，
+    overrides（例如 api_key）會直接傳俾後端。
+    """
+    cls = BACKENDS.get((name or "").lower())
+    if cls is None:
+        raise ValueError(f"唔識嘅 LLM_BACKEND：{name}（可選：{', '.join(BACKENDS)}）")
+    return cls(system_prompt=system_prompt, max_tokens=max_tokens, temperature=temperature, top_p=top_p, **overrides)
@@ -0,0 +1,5 @@
+# 模組都係平放喺 repo 根目錄（冇 package），測試由根目錄 import
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,91 @@
+import pytest
+
+import core_logic
+from core_logic import BOOKING_TRANSITIONS, BookingStage as S, Intent as I
+
+
+@pytest.mark.parametrize("stage, intent, slots, expected", [
+    (S.GREETING, I.BOOKING, (False, False, False), S.TREATMENT),
+    (S.TREATMENT, I.TREATMENT_CONFIRM, (True, False, False), S.TIME),
+    (S.TIME, I.BOOKING, (True, True, False), S.CONTACT),
+    (S.CONTACT, I.CONTACT, (True, True, True), S.CONFIRMED),
+    (S.CONTACT, I.PRICE, (True, True, False), S.CONTACT),
+    (S.CONFIRMED, I.CHANGE, (True, False, True), S.CHANGED),
+    (S.CONFIRMED, I.CHANGE, (True, True, True), S.CHANGED),
+    # 改緊期仲未講新時間 → 留喺改咗
+    (S.CHANGED, I.BOOKING, (True, False, True), S.CHANGED),
+    # 資料再齊、唔係再改 → 返去已確認
+    (S.CHANGED, I.BOOKING, (True, True, True), S.CONFIRMED),
+    (S.CHANGED, I.UNKNOWN, (True, True, True), S.CHANGED),
+    (S.CONFIRMED, I.CANCEL, (True, True, True), S.CANCELLED),
+    (S.CANCELLED, I.BOOKING, (False, False, True), S.TREATMENT),
+])
+def test_transitions(stage, intent, slots, expected):
+    assert BOOKING_TRANSITIONS[(stage, intent, slots)] is expected
+
+
+def _run(texts):
+    state = core_logic.reset_memory()
+    stages = []
+    for text in texts:
+        state = core_logic._prepare_turn(text, state).state
+        stages.append(state["booking_stage"])
+    return state, stages
+
+
+@pytest.mark.parametrize("texts, stages", [
+    (
+        ["我想約basic facial", "聽日三點", "我叫陳大文，電話91234567"],
+        ["time", "contact", "confirmed"],
+    ),
+    (
+        ["我想約", "深層清潔", "後日下晝三點", "陳小姐", "91234567"],
+        ["treatment", "time", "contact", "contact", "confirmed"],
+    ),
+    # 確認咗再改期：補返新時間嗰輪仲係「改咗」，之後再講預約嘢就返去已確認
+    (
+        ["我想約basic facial", "聽日三點", "我叫陳大文，電話91234567", "我想改期", "後日四點", "好呀多謝", "basic facial"],
+        ["time", "contact", "confirmed", "changed", "changed", "changed", "confirmed"],
+    ),
+    (
+        ["我想約basic facial", "聽日三點", "我叫陳大文，電話91234567", "唔該幫我取消預約", "係聽日嗰個"],
+        ["time", "contact", "confirmed", "cancelled", "cancelled"],
+    ),
+])
+def test_conversation_stages(texts, stages):
+    assert _run(texts)[1] == stages
+
+
+def test_another_booking_after_confirmed():
+    state, stages = _run([
+        "我想約basic facial", "聽日三點", "我叫陳大文，電話91234567", "我想約多個按摩", "後日五點",
+    ])
+    assert stages[3:] == ["time", "confirmed"]
+    assert state["treatment"] == "身體按摩"
+    assert [b["treatment"] for b in state["bookings"]] == ["basic facial"]
+    assert (state["customer_name"], state["phone"]) == ("陳大文", "9123 4567")
+
+
+def test_another_booking_does_not_replay_old_confirmation():
+    state, _ = _run(["我想約basic facial", "聽日三點", "我叫陳大文，電話91234567"])
+    turn = core_logic._prepare_turn("我想約多個", state)
+    assert turn.state["booking_stage"] == "treatment"
+    assert "已經幫你登記" not in turn.reply
+    # 原本嘅 state 唔會被改
+    assert state["bookings"] == [] and state["treatment"] == "basic facial"
+
+
+
+def test_contact_ack_only_on_the_turn_it_was_given():
+    state = core_logic.reset_memory()
+    turn = core_logic._prepare_turn("我叫陳大文，想約", state)
+    assert turn.reply.startswith("多謝陳大文")
+    turn = core_logic._prepare_turn("深層清潔", turn.state)
+    assert turn.state["booking_stage"] == "time"
+    assert "多謝" not in turn.reply
+
+
+def test_cache_key_includes_earlier_bookings():
+    state, _ = _run(["我想約basic facial", "聽日三點", "我叫陳大文，電話91234567", "我想約多個"])
+    fresh = dict(state, bookings=[])
+    assert core_logic._response_cache_key("有冇泊車位", state) != core_logic._response_cache_key("有冇泊車位", fresh)
@@ -0,0 +1,69 @@
+import pytest
+
+import core_logic
+from cantonese_contact import extract_name, extract_phone
+from cantonese_text import normalize_utterance
+
+
+@pytest.mark.parametrize("text, asked_for_name, name", [
+    ("我叫陳大文", False, "陳大文"),
+    ("喂，我叫李嘉欣呀", False, "李嘉欣"),
+    ("我叫阿欣", False, "阿欣"),
+    ("叫我 Amy", False, "Amy"),
+    ("my name is amy wong", False, "Amy Wong"),
+    ("我係陳小姐", False, "陳小姐"),
+    ("我姓歐陽，歐陽太", False, "歐陽太"),
+    ("陳大文，叫我陳生得喇", False, "陳生"),
+    # 啱啱問完名先認淨係稱呼
+    ("陳小姐", True, "陳小姐"),
+    ("陳小姐", False, None),
+    # 冇自稱：唔係名
+    ("你可以叫我幫手嗎", False, None),
+    ("叫我等幾耐", False, None),
+    ("係陳小姐介紹我嚟嘅", False, None),
+    ("我想搵何生幫我做", False, None),
+    ("我係想搵陳小姐", False, None),
+    ("陳生日快樂", True, None),
+])
+def test_extract_name(text, asked_for_name, name):
+    assert extract_name(normalize_utterance(text), asked_for_name) == name
+
+
+@pytest.mark.parametrize("text, phone", [
+    ("我電話係9123 4567", "9123 4567"),
+    ("91234567", "9123 4567"),
+    ("+852 6123-4567", "6123 4567"),
+    ("九一二三四五六七", "9123 4567"),
+    ("電話係二三四五 六七八九", "2345 6789"),
+    # 香港號碼唔會 1 字頭；唔夠 8 位；長卡號中間唔截
+    ("1234 5678", None),
+    ("9123456", None),
+    ("我張卡係 4123 4567 8901 2345", None),
+])
+def test_extract_phone(text, phone):
+    assert extract_phone(normalize_utterance(text)) == phone
+
+
+BOOKED = dict(
+    core_logic.reset_memory(),
+    treatment="basic facial",
+    booking_time="10月23號 星期五 下晝3點",
+    booking_start="2026-10-23T15:00",
+    booking_end="2026-10-23T15:00",
+)
+
+
+@pytest.mark.parametrize("stage, text, intent, next_stage, name, phone", [
+    ("contact", "陳小姐", "contact", "contact", "陳小姐", None),
+    ("contact", "我叫陳大文，電話91234567", "contact", "confirmed", "陳大文", "9123 4567"),
+    # 報名之外仲有問題：唔好淨係確認名，照答問題
+    ("contact", "我叫陳大文，幾錢呀", "price", "contact", "陳大文", None),
+    ("time", "我叫陳大文，你哋有冇泊車位", "unknown", "time", "陳大文", None),
+    ("greeting", "叫我等幾耐", "unknown", "greeting", None, None),
+    ("time", "陳小姐", "unknown", "time", None, None),
+])
+def test_contact_turns(stage, text, intent, next_stage, name, phone):
+    turn = core_logic._prepare_turn(text, dict(BOOKED, booking_stage=stage))
+    assert turn.intent.value == intent
+    assert turn.state["booking_stage"] == next_stage
+    assert (turn.state["customer_name"], turn.state["phone"]) == (name, phone)
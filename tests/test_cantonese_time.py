@@ -0,0 +1,70 @@
+from datetime import datetime
+
+import pytest
+
+from cantonese_text import normalize_utterance
+from cantonese_time import format_booking_time, parse_booking_time
+
+# 2026-10-22 星期四 中午
+NOW = datetime(2026, 10, 22, 12, 0)
+
+
+def _parse(text):
+    return parse_booking_time(normalize_utterance(text), NOW)
+
+
+@pytest.mark.parametrize("text, start, end, has_date, has_clock", [
+    ("聽日三點", "2026-10-23 15:00", "2026-10-23 15:00", True, True),
+    ("三點半", "2026-10-22 15:30", "2026-10-22 15:30", False, True),
+    ("三點零五分", "2026-10-22 15:05", "2026-10-22 15:05", False, True),
+    ("三點零五", "2026-10-22 15:05", "2026-10-22 15:05", False, True),
+    ("三點五", "2026-10-22 15:25", "2026-10-22 15:25", False, True),
+    ("3pm", "2026-10-22 15:00", "2026-10-22 15:00", False, True),
+    # 淨係講鐘點而今日已經過咗 → 聽日
+    ("十一點", "2026-10-23 11:00", "2026-10-23 11:00", False, True),
+    ("今晚八點", "2026-10-22 20:00", "2026-10-22 20:00", True, True),
+    ("後日下晝", "2026-10-24 14:00", "2026-10-24 18:00", True, False),
+    ("呢個禮拜六三點", "2026-10-24 15:00", "2026-10-24 15:00", True, True),
+    ("週六三點", "2026-10-24 15:00", "2026-10-24 15:00", True, True),
+    ("周六三點", "2026-10-24 15:00", "2026-10-24 15:00", True, True),
+    ("星期日十點", "2026-10-25 10:00", "2026-10-25 10:00", True, True),
+    ("下個禮拜二下晝兩點", "2026-10-27 14:00", "2026-10-27 14:00", True, True),
+    ("10月30號兩點", "2026-10-30 14:00", "2026-10-30 14:00", True, True),
+    # 今年已經過咗嘅月日 → 出年
+    ("10月1號兩點", "2027-10-01 14:00", "2027-10-01 14:00", True, True),
+    # 講明幾多個月之後，唔好當咗今個月
+    ("我想約下個月二十五號", "2026-11-25 11:00", "2026-11-25 21:00", True, False),
+    ("下個月3號下晝兩點", "2026-11-03 14:00", "2026-11-03 14:00", True, True),
+    ("下下個月一號三點", "2026-12-01 15:00", "2026-12-01 15:00", True, True),
+    ("今個月30號兩點", "2026-10-30 14:00", "2026-10-30 14:00", True, True),
+])
+def test_parses(text, start, end, has_date, has_clock):
+    parsed = _parse(text)
+    assert parsed is not None
+    assert parsed.start == datetime.fromisoformat(start)
+    assert parsed.end == datetime.fromisoformat(end)
+    assert (parsed.has_date, parsed.has_clock) == (has_date, has_clock)
+
+
+@pytest.mark.parametrize("text", [
+    # 講明咗日子但已經過咗，唔好靜靜雞推去下個禮拜 / 聽日
+    "呢個禮拜二三點",
+    "今個星期二三點",
+    "今日十一點",
+    "今日上晝",
+    "今個月一號兩點",
+    # 冇時間
+    "我想約facial",
+    "",
+])
+def test_no_booking_time(text):
+    assert _parse(text) is None
+
+
+@pytest.mark.parametrize("text, spoken", [
+    ("聽日三點半", "10月23號 星期五 下晝3點半"),
+    ("三點零五分", "10月22號 星期四 下晝3點05分"),
+    ("後日下晝", "10月24號 星期六 下晝"),
+])
+def test_format(text, spoken):
+    assert format_booking_time(_parse(text)) == spoken
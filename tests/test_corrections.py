@@ -0,0 +1,69 @@
+from datetime import datetime
+
+import pytest
+
+import core_logic
+
+# 2026-10-19 星期一 上晝
+NOW = datetime(2026, 10, 19, 10, 0)
+TUESDAY_3PM = "10月20號 星期二 下晝3點"
+
+
+def _update(state, text):
+    return core_logic.update_conversation_state(state, text, now=NOW)
+
+
+@pytest.fixture
+def booked():
+    state = _update(core_logic.reset_memory(), "我想做basic facial")
+    state = _update(state, "聽日三點")
+    assert (state["treatment"], state["booking_time"]) == ("basic facial", TUESDAY_3PM)
+    return state
+
+
+@pytest.mark.parametrize("text, treatment, booking_time", [
+    # ASR 冇加標點：喺否定詞度切開，後面嗰個係新值
+    ("唔係呀我想改做按摩", "身體按摩", TUESDAY_3PM),
+    ("唔係三點係四點", "basic facial", "10月20號 星期二 下晝4點"),
+    ("我唔要basic facial要按摩", "身體按摩", TUESDAY_3PM),
+    ("唔係呀，係四點", "basic facial", "10月20號 星期二 下晝4點"),
+    # 否定咗已登記嗰個 → 清走等狀態機問返
+    ("唔係三點", "basic facial", None),
+    ("唔係聽日", "basic facial", None),
+    ("basic facial唔要喇", None, TUESDAY_3PM),
+    # 否定嘅唔係已登記嗰個 → 唔郁
+    ("我朋友唔係做按摩", "basic facial", TUESDAY_3PM),
+    ("唔係五點", "basic facial", TUESDAY_3PM),
+    ("唔要深層清潔", "basic facial", TUESDAY_3PM),
+    # 問句唔係否定
+    ("係唔係三點呀", "basic facial", TUESDAY_3PM),
+    # 改期未講新時間
+    ("我想改期", "basic facial", None),
+    # 「不如」係提議，唔係更正
+    ("不如你介紹下深層清潔", "basic facial", TUESDAY_3PM),
+])
+def test_correction(booked, text, treatment, booking_time):
+    state = _update(booked, text)
+    assert (state["treatment"], state["booking_time"]) == (treatment, booking_time)
+
+
+@pytest.mark.parametrize("text, booking_time", [
+    # 否定嘅唔係預約資料：後面嘅時間照收
+    ("唔係好急聽日三點得唔得", TUESDAY_3PM),
+    ("唔係好急，聽日三點得唔得", TUESDAY_3PM),
+])
+def test_negation_keeps_value_for_empty_slot(text, booking_time):
+    state = _update(core_logic.reset_memory(), text)
+    assert state["booking_time"] == booking_time
+
+
+def test_correction_keeps_original_day(booked):
+    state = _update(booked, "改做五點")
+    assert state["booking_start"] == "2026-10-20T17:00"
+
+
+def test_correction_signals_route_to_change(booked):
+    state = dict(booked, booking_stage="contact")
+    turn = core_logic._prepare_turn("唔係三點係四點", state)
+    assert turn.intent is core_logic.Intent.CHANGE
+    assert "下晝4點" in turn.reply
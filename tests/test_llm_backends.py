@@ -0,0 +1,117 @@
+import asyncio
+import sys
+import threading
+import types
+
+import pytest
+
+import llm_backends
+from llm_backends import GeminiBackend, OpenAICompatibleBackend
+
+
+class SlowStreamBackend(OpenAICompatibleBackend):
+    """唔使 requests：stream() 換成逐個 chunk 慢慢出，記低喺邊條線程關。"""
+
+    def __init__(self, chunks, delay_s):
+        self.chunks = chunks
+        self.delay_s = delay_s
+        self.closed = threading.Event()
+        self.closed_by = None
+        self.read_by = None
+
+    def stream(self, prompt):
+        self.read_by = threading.get_ident()
+        try:
+            for text in self.chunks:
+                threading.Event().wait(self.delay_s)
+                yield text
+        finally:
+            self.closed_by = threading.get_ident()
+            self.closed.set()
+
+
+async def _collect(backend, prompt="hi"):
+    return [text async for text in backend.astream(prompt)]
+
+
+def test_astream_yields_all_chunks():
+    backend = SlowStreamBackend(["你好", "，", "請問"], 0)
+    assert asyncio.run(_collect(backend)) == ["你好", "，", "請問"]
+    assert backend.closed.wait(1)
+
+
+def test_astream_timeout_closes_stream_in_worker_thread():
+    backend = SlowStreamBackend(["你好", "慢", "慢", "慢"], 0.05)
+
+    async def main():
+        got = []
+
+        async def consume():
+            async for text in backend.astream("hi"):
+                got.append(text)
+
+        try:
+            await asyncio.wait_for(consume(), timeout=0.08)
+        except asyncio.TimeoutError:
+            return got
+        raise AssertionError("應該超時")
+
+    assert asyncio.run(main()) == ["你好"]
+    assert backend.closed.wait(1)
+    assert backend.closed_by == backend.read_by
+
+
+def test_astream_aclose_does_not_raise():
+    backend = SlowStreamBackend(["一", "二", "三"], 0.02)
+
+    async def main():
+        agen = backend.astream("hi")
+        first = await agen.__anext__()
+        await agen.aclose()
+        return first
+
+    assert asyncio.run(main()) == "一"
+    assert backend.closed.wait(1)
+
+
+def test_astream_propagates_errors():
+    class Broken(SlowStreamBackend):
+        def stream(self, prompt):
+            yield "半句"
+            raise ConnectionError("斷咗線")
+
+    backend = Broken([], 0)
+
+    async def main():
+        got = []
+        try:
+            async for text in backend.astream("hi"):
+                got.append(text)
+        except ConnectionError as e:
+            return got, str(e)
+
+    assert asyncio.run(main()) == (["半句"], "斷咗線")
+
+
+@pytest.fixture
+def fake_genai(monkeypatch):
+    genai = types.ModuleType("google.generativeai")
+    genai.keys = []
+    genai.configure = lambda api_key, **_: genai.keys.append(api_key)
+    genai.GenerationConfig = lambda **kw: kw
+    genai.GenerativeModel = lambda **kw: kw
+    google = types.ModuleType("google")
+    google.generativeai = genai
+    monkeypatch.setitem(sys.modules, "google", google)
+    monkeypatch.setitem(sys.modules, "google.generativeai", genai)
+    monkeypatch.setattr(llm_backends, "_gemini_api_key", None)
+    return genai
+
+
+def test_gemini_rejects_second_api_key(fake_genai):
+    GeminiBackend("系統", 60, 0.0, 1.0, api_key="primary")
+    GeminiBackend("系統", 60, 0.0, 1.0, api_key="primary")
+    with pytest.raises(RuntimeError):
+        GeminiBackend("系統", 60, 0.0, 1.0, api_key="hedge")
+    # 主後端嘅 key 冇俾換走
+    assert fake_genai.keys == ["primary", "primary"]
@@ -0,0 +1,292 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+import core_logic
+from core_logic import CircuitBreaker, LLMRateLimitedError, SingleFlight, TokenBucketLimiter
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+# ==================== 熔斷器 ====================
+
+def test_breaker_opens_at_error_rate_and_probes_after_cooldown():
+    clock = FakeClock()
+    breaker = CircuitBreaker(window=10, min_calls=4, error_rate=0.5, cooldown_s=30, probes=1, clock=clock)
+    for ok in (True, False, True):
+        assert breaker.allow()
+        breaker.record(ok)
+    assert breaker.state == CircuitBreaker.CLOSED
+
+    breaker.record(False)
+    assert breaker.state == CircuitBreaker.OPEN
+    assert not breaker.allow()
+
+    clock.now = 31
+    assert breaker.allow()
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    # 探測名額得一個
+    assert not breaker.allow()
+    breaker.record(True)
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.stats() == {"state": "closed", "trips": 1, "rejected": 2}
+
+
+def test_breaker_none_only_releases_probe():
+    clock = FakeClock()
+    breaker = CircuitBreaker(window=10, min_calls=1, error_rate=0.5, cooldown_s=30, probes=1, clock=clock)
+    breaker.record(False)
+    clock.now = 31
+    assert breaker.allow()
+    breaker.record(None)
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    assert breaker.allow()
+    breaker.record(False)
+    assert breaker.state == CircuitBreaker.OPEN
+
+
+# ==================== 令牌桶 ====================
+
+def test_limiter_rejects_when_wait_exceeds_budget():
+    limiter = TokenBucketLimiter(rate_per_s=1.0, burst=1)
+    assert limiter.acquire(core_logic.PRIORITY_LIVE, 0.1) < 0.05
+    with pytest.raises(LLMRateLimitedError):
+        limiter.acquire(core_logic.PRIORITY_LIVE, 0.1)
+    assert limiter.stats()["rejected"] == 1
+
+
+def test_limiter_serves_priority_then_rank():
+    limiter = TokenBucketLimiter(rate_per_s=5.0, burst=1)
+    limiter.acquire(core_logic.PRIORITY_LIVE, 1.0)  # 清空個桶，之後嘅請求要排隊
+    order = []
+    holder = threading.Event()
+
+    def waiter(name, priority, rank):
+        holder.wait()
+        limiter.acquire(priority, 2.0, rank)
+        order.append(name)
+
+    # 一齊入隊：先鎖住條件，等晒三個都排好先放令牌
+    with limiter._cond:
+        threads = [
+            threading.Thread(target=waiter, args=args)
+            for args in (
+                ("background", core_logic.PRIORITY_BACKGROUND, ()),
+                ("live_new", core_logic.PRIORITY_LIVE, (5,)),
+                ("live_booking", core_logic.PRIORITY_LIVE, (0,)),
+            )
+        ]
+        for t in threads:
+            t.start()
+        holder.set()
+        deadline = time.monotonic() + 2
+        while len(limiter._waiters) < 3 and time.monotonic() < deadline:
+            limiter._cond.wait(0.01)
+    for t in threads:
+        t.join(3)
+    assert order == ["live_booking", "live_new", "background"]
+
+
+# ==================== 相同請求合併 ====================
+
+def test_single_flight_shares_one_call():
+    flight = SingleFlight()
+    release = threading.Event()
+    calls = []
+
+    def fn():
+        calls.append(1)
+        release.wait(2)
+        return "reply"
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(flight.do("prompt", fn))) for _ in range(5)]
+    for t in threads:
+        t.start()
+    while flight.stats()["coalesced"] < 4:
+        time.sleep(0.005)
+    release.set()
+    for t in threads:
+        t.join(3)
+    assert results == ["reply"] * 5
+    assert len(calls) == 1
+    assert flight.stats() == {"leaders": 1, "coalesced": 4, "in_flight": 0}
+
+
+def test_single_flight_async_survives_one_caller_cancelling():
+    flight = SingleFlight()
+
+    async def upstream():
+        await asyncio.sleep(0.05)
+        return "reply"
+
+    async def main():
+        first = asyncio.ensure_future(flight.ado("prompt", upstream))
+        second = asyncio.ensure_future(flight.ado("prompt", upstream))
+        await asyncio.sleep(0)
+        first.cancel()
+        return await second
+
+    assert asyncio.run(main()) == "reply"
+    assert flight.stats()["leaders"] == 1
+
+
+# ==================== 合併之後熔斷器只記一次 ====================
+
+class BlockingBackend:
+    name = "blocking"
+    timeout_s = 0.3
+
+    def __init__(self):
+        self.release = threading.Event()
+        self.calls = 0
+
+    def generate(self, prompt):
+        self.calls += 1
+        self.release.wait(5)
+        return "遲咗"
+
+
+@pytest.fixture
+def llm_guards(monkeypatch):
+    breaker = CircuitBreaker(window=20, min_calls=5, error_rate=0.5, cooldown_s=30, probes=1)
+    backend = BlockingBackend()
+    monkeypatch.setattr(core_logic, "llm_breaker", breaker)
+    monkeypatch.setattr(core_logic, "llm_latency", core_logic.LatencyTracker())
+    monkeypatch.setattr(core_logic, "llm_single_flight", SingleFlight())
+    monkeypatch.setattr(core_logic, "LLM_SINGLE_FLIGHT", True)
+    monkeypatch.setattr(core_logic, "LLM_HEDGE", False)
+    monkeypatch.setattr(core_logic, "llm_rate_limiter", None)
+    monkeypatch.setattr(core_logic, "response_cache", core_logic.ResponseCache(10, 60))
+    monkeypatch.setattr(core_logic, "semantic_cache", core_logic.SemanticCache(10, 64, 0.99, 5))
+    monkeypatch.setattr(core_logic, "llm_backend", backend)
+    yield breaker, backend
+    backend.release.set()
+    # 等孤兒請求完成，唔好阻住後面嘅測試
+    deadline = time.monotonic() + 5
+    while core_logic._orphan_count and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+
+def test_coalesced_timeout_counts_once(llm_guards):
+    breaker, backend = llm_guards
+    n = 10
+    barrier = threading.Barrier(n)
+    replies = []
+
+    def caller():
+        barrier.wait()
+        replies.append(core_logic.generate_reply("你哋老闆係邊個", core_logic.reset_memory())[0])
+
+    threads = [threading.Thread(target=caller) for _ in range(n)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join(5)
+
+    assert replies == [core_logic.BUSY_REPLY] * n
+    assert backend.calls == 1
+    assert list(breaker._results) == [False]
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+# ==================== 提早停止慳咗幾多 token ====================
+
+def test_tokens_saved_uses_typical_reply_length(monkeypatch):
+    lengths = core_logic.ReplyLengthTracker(min_samples=3)
+    monkeypatch.setattr(core_logic, "reply_lengths", lengths)
+    monkeypatch.setattr(core_logic, "_stream_counters", dict.fromkeys(core_logic._stream_counters, 0))
+
+    # 樣本唔夠：唔估，只記上限
+    core_logic._record_early_stop(30)
+    stats = core_logic.stream_stats()
+    assert stats["tokens_saved"] == 0
+    assert stats["tokens_saved_upper_bound"] == core_logic.GEMINI_MAX_TOKENS - 30
+
+    for n in (20, 40, 60):
+        lengths.record(n)
+    # 比 30 長嘅完整回覆平均 50 → 慳咗大約 20
+    core_logic._record_early_stop(30)
+    assert core_logic.stream_stats()["tokens_saved"] == 20
+
+
+# ==================== 串流嘅自適應超時 ====================
+
+class DelayedStreamBackend:
+    name = "delayed"
+    timeout_s = 1.0
+
+    def __init__(self, first_delay_s, gap_s):
+        self.first_delay_s = first_delay_s
+        self.gap_s = gap_s
+
+    def stream(self, prompt):
+        time.sleep(self.first_delay_s)
+        yield "你好。"
+        for _ in range(3):
+            time.sleep(self.gap_s)
+            yield "請問"
+        yield "仲有咩幫到你？"
+
+    async def astream(self, prompt):
+        await asyncio.sleep(self.first_delay_s)
+        yield "你好。"
+        for _ in range(3):
+            await asyncio.sleep(self.gap_s)
+            yield "請問"
+        yield "仲有咩幫到你？"
+
+
+@pytest.fixture
+def adaptive_stream(monkeypatch):
+    latency = core_logic.LatencyTracker()
+    for _ in range(latency.min_samples):
+        latency.record(0.02)
+    monkeypatch.setattr(core_logic, "llm_latency", latency)
+    monkeypatch.setattr(core_logic, "LLM_TIMEOUT_FLOOR_S", 0.1)
+    monkeypatch.setattr(core_logic, "llm_breaker", CircuitBreaker())
+    monkeypatch.setattr(core_logic, "llm_rate_limiter", None)
+    monkeypatch.setattr(core_logic, "response_cache", core_logic.ResponseCache(10, 60))
+    monkeypatch.setattr(core_logic, "semantic_cache", core_logic.SemanticCache(10, 64, 0.99, 5))
+
+    def use(backend):
+        monkeypatch.setattr(core_logic, "llm_backend", backend)
+
+    yield use
+    deadline = time.monotonic() + 5
+    while core_logic._orphan_count and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+
+def _stream_reply(asynchronous):
+    if not asynchronous:
+        sentences, _ = core_logic.generate_reply_stream("你哋老闆係邊個", core_logic.reset_memory())
+        return list(sentences)
+
+    async def main():
+        sentences, _ = core_logic.agenerate_reply_stream("你哋老闆係邊個", core_logic.reset_memory())
+        return [s async for s in sentences]
+
+    return asyncio.run(main())
+
+
+@pytest.mark.parametrize("asynchronous", [False, True])
+def test_stream_first_chunk_uses_adaptive_timeout(adaptive_stream, asynchronous):
+    # 第一個 chunk 慢過自適應超時（0.1s）但快過後端 timeout_s → 即刻後備
+    adaptive_stream(DelayedStreamBackend(first_delay_s=0.4, gap_s=0))
+    assert _stream_reply(asynchronous) == [core_logic.BUSY_REPLY]
+
+
+@pytest.mark.parametrize("asynchronous", [False, True])
+def test_stream_after_first_chunk_uses_backend_timeout(adaptive_stream, asynchronous):
+    # 第一個 chunk 準時到，之後成段串流長過自適應超時都唔會截斷
+    adaptive_stream(DelayedStreamBackend(first_delay_s=0, gap_s=0.06))
+    assert _stream_reply(asynchronous) == ["你好。", "請問請問請問仲有咩幫到你？"]
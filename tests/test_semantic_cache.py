@@ -0,0 +1,85 @@
+import json
+
+import pytest
+
+import benchmark_replay
+import core_logic
+from cantonese_text import normalize_utterance
+
+PAIRS = benchmark_replay.load_semantic_pairs(benchmark_replay.DEFAULT_SEMANTIC_PAIRS)
+
+
+def _vetted_cache(threshold=core_logic.SEMANTIC_CACHE_THRESHOLD):
+    cache = core_logic.SemanticCache(
+        len(PAIRS), core_logic.SEMANTIC_CACHE_DIM, threshold, core_logic.SEMANTIC_CACHE_TOP_K
+    )
+    for pair in PAIRS:
+        cache.add(normalize_utterance(pair["a"]), None, pair["a"])
+    return cache
+
+
+def test_labelled_pairs_never_serve_wrong_reply():
+    report = benchmark_replay.calibrate_semantic_threshold(PAIRS)
+    assert report["wrong"] == 0
+    assert report["suggested_threshold"] <= core_logic.SEMANTIC_CACHE_THRESHOLD
+    assert report["hits"] >= report["matches"] // 2
+
+
+@pytest.mark.parametrize("pair", [p for p in PAIRS if not p["match"]], ids=lambda p: p["b"])
+def test_non_matching_pair_misses(pair):
+    assert _vetted_cache().lookup(normalize_utterance(pair["b"]), ()) != pair["a"]
+
+
+def test_request_example_hits():
+    cache = _vetted_cache()
+    assert cache.lookup(normalize_utterance("有冇地方泊車呀"), ()) == "你哋有冇泊車位"
+
+
+@pytest.mark.parametrize("stored, asked", [
+    ("懷孕可以做嗎", "懷孕唔可以做嗎"),
+    ("小朋友可以做嗎", "狗可以做嗎"),
+    ("收唔收八達通", "收唔收現金"),
+])
+def test_guard_refuses_even_without_threshold(stored, asked):
+    cache = core_logic.SemanticCache(10, core_logic.SEMANTIC_CACHE_DIM, 0.0, 5)
+    cache.add(normalize_utterance(stored), None, "reply")
+    assert cache.lookup(normalize_utterance(asked), ()) is None
+    assert cache.stats()["guarded"] == 1
+
+
+def test_a_not_a_question_is_not_negation():
+    assert core_logic.SemanticCache.matches("可唔可以做", "可以做嗎")
+    assert core_logic.SemanticCache.matches("你哋有冇泊車位", "有冇地方泊車呀")
+
+
+def test_context_must_match_unless_entry_is_context_free():
+    cache = core_logic.SemanticCache(10, core_logic.SEMANTIC_CACHE_DIM, 0.5, 5)
+    cache.add("幾時可以化妝", ("basic facial",), "facial")
+    cache.add("有冇泊車位", None, "parking")
+    assert cache.lookup("幾時可以化妝", ("身體按摩",)) is None
+    assert cache.lookup("幾時可以化妝", ("basic facial",)) == "facial"
+    assert cache.lookup("有冇泊車位", ("身體按摩",)) == "parking"
+
+
+def test_vetted_file_reloads_after_invalidate(tmp_path):
+    path = tmp_path / "vetted.jsonl"
+    path.write_text(json.dumps({"questions": ["你哋有冇泊車位"], "reply": "樓下有停車場。"}, ensure_ascii=False) + "\n")
+    cache = core_logic.SemanticCache(10, core_logic.SEMANTIC_CACHE_DIM, core_logic.SEMANTIC_CACHE_THRESHOLD, 5, str(path))
+    assert cache.lookup(normalize_utterance("有冇地方泊車呀"), ()) == "樓下有停車場。"
+    cache.invalidate()
+    assert cache.lookup(normalize_utterance("有冇地方泊車呀"), ()) == "樓下有停車場。"
+
+
+def test_llm_replies_are_not_added(monkeypatch):
+    monkeypatch.setattr(core_logic, "response_cache", core_logic.ResponseCache(10, 60))
+    monkeypatch.setattr(core_logic, "semantic_cache", core_logic.SemanticCache(10, 64, 0.5, 5))
+    state = dict(core_logic.reset_memory(), customer_name="陳小姐")
+    turn = core_logic._PreparedTurn(state, "", "有冇泊車位", "prompt", ("有冇泊車位",))
+
+    core_logic._store_llm_reply(turn, "有呀，樓下有停車場。")
+    assert core_logic.semantic_cache.stats()["size"] == 0
+    assert core_logic.response_cache.get(("有冇泊車位",)) == "有呀，樓下有停車場。"
+
+    # 叫咗客人名嘅回覆唔可以俾第個客
+    core_logic._store_llm_reply(turn._replace(cache_key=("名",)), "陳小姐，樓下有停車場。")
+    assert core_logic.response_cache.get(("名",)) is None